@@ -1,21 +1,113 @@
-import google.generativeai as genai
-import PIL.Image
-from tenacity import retry, stop_after_attempt, wait_exponential
-import time
-
-@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=20))
-def analyze_image(image_path):
-    """Analizza un'immagine con Gemini e genera una descrizione dettagliata."""
-    # Add a 6-second delay before each API call
-    time.sleep(6)
-    
-    model = genai.GenerativeModel('gemini-1.5-flash')
-    img = PIL.Image.open(image_path)
-    
-    prompt = """Analizza questa immagine che proviene da un libro di reti di telecomunicazioni.
+import contextvars
+import io
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from extract_images import count_pages, render_vision_images, VISION_MAX_SIDE
+from utils import compute_file_hash
+from metrics import timed, count_cache
+import gemini_client
+
+logger = logging.getLogger(__name__)
+
+DESCRIPTIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "page_descriptions")
+
+# Pages of one query analyzed at the same time (the API calls themselves are
+# rate limited by gemini_client)
+VISION_CONCURRENCY = int(os.environ.get("VISION_CONCURRENCY", 5))
+
+ANALYSIS_PROMPT = """Analizza questa immagine che proviene da un libro di reti di telecomunicazioni.
     Se è un diagramma tecnico, descrivi in dettaglio cosa rappresenta, i componenti presenti e i concetti illustrati.
     Se è una figura con testo, includi il testo nella tua descrizione.
     Fornisci una spiegazione tecnica e completa che possa essere utilizzata come contesto per un sistema RAG."""
-    
-    response = model.generate_content([prompt, img])
-    return response.text
\ No newline at end of file
+
+# Bump whenever ANALYSIS_PROMPT changes, so cached descriptions are regenerated
+PROMPT_VERSION = 1
+
+@timed("vision")
+def analyze_image(image):
+    """Analizza un'immagine con Gemini e genera una descrizione dettagliata.
+    `image` può essere un percorso o i byte dell'immagine."""
+    import PIL.Image
+    img = PIL.Image.open(io.BytesIO(image) if isinstance(image, bytes) else image)
+    return gemini_client.generate([ANALYSIS_PROMPT, img], kind="vision")
+
+def description_cache_path(pdf_path, page_num, max_side):
+    file_hash = compute_file_hash(pdf_path)
+    return os.path.join(DESCRIPTIONS_DIR, f"{file_hash}_p{page_num}_s{max_side}_v{PROMPT_VERSION}.json")
+
+def load_description(cache_file):
+    if os.path.exists(cache_file):
+        count_cache("page_description", True)
+        with open(cache_file, "r", encoding="utf-8") as f:
+            return json.load(f)["description"]
+    count_cache("page_description", False)
+    return None
+
+def save_description(cache_file, page_num, max_side, description):
+    os.makedirs(DESCRIPTIONS_DIR, exist_ok=True)
+    tmp_file = f"{cache_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump({"page": page_num, "max_side": max_side, "prompt_version": PROMPT_VERSION, "description": description}, f, ensure_ascii=False)
+    os.replace(tmp_file, cache_file)
+
+def describe_pages(pdf_path, page_nums, max_side=VISION_MAX_SIDE):
+    """
+    Returns the vision descriptions of PDF pages (0-based), in order, with
+    None for pages that don't exist. Pages that aren't cached yet are
+    rendered in parallel and analyzed concurrently, within the vision rate
+    limit. The cache is keyed by the PDF content hash, page, image size and
+    prompt version.
+    """
+    cache_files = [description_cache_path(pdf_path, page_num, max_side) for page_num in page_nums]
+    descriptions = [load_description(cache_file) for cache_file in cache_files]
+    missing = [i for i, description in enumerate(descriptions) if description is None]
+    if not missing:
+        return descriptions
+
+    images = render_vision_images(pdf_path, [page_nums[i] for i in missing], max_side=max_side)
+
+    def analyze(i, image_bytes):
+        description = analyze_image(image_bytes)
+        save_description(cache_files[i], page_nums[i], max_side, description)
+        return description
+
+    with ThreadPoolExecutor(max_workers=min(VISION_CONCURRENCY, len(missing))) as executor:
+        # Each page runs in a copy of this context, so it keeps the caller's API priority
+        futures = {
+            i: executor.submit(contextvars.copy_context().run, analyze, i, image_bytes)
+            for i, image_bytes in zip(missing, images) if image_bytes is not None
+        }
+    for i, future in futures.items():
+        descriptions[i] = future.result()
+    return descriptions
+
+def describe_page(pdf_path, page_num, max_side=VISION_MAX_SIDE):
+    """Returns the vision description of a PDF page (0-based), or None if it does not exist."""
+    return describe_pages(pdf_path, [page_num], max_side=max_side)[0]
+
+def describe_all_pages(pdf_path, max_side=VISION_MAX_SIDE):
+    """Describes every page of a PDF that isn't cached yet."""
+    page_count = count_pages(pdf_path)
+    logger.info(f"Pre-describing {page_count} pages of {os.path.basename(pdf_path)}...")
+    for start in range(0, page_count, VISION_CONCURRENCY):
+        page_nums = list(range(start, min(start + VISION_CONCURRENCY, page_count)))
+        try:
+            describe_pages(pdf_path, page_nums, max_side=max_side)
+        except Exception as e:
+            # Descriptions of the other pages of the group are saved as they finish
+            logger.warning(f"Could not describe pages {page_nums[0] + 1}-{page_nums[-1] + 1}: {e}")
+    logger.info(f"All pages of {os.path.basename(pdf_path)} described.")
+
+def start_page_description_job(pdf_path, max_side=VISION_MAX_SIDE):
+    """Starts describe_all_pages in a background thread and returns the thread."""
+    def run():
+        # Queries go first: the job only uses background API capacity
+        with gemini_client.background():
+            describe_all_pages(pdf_path, max_side)
+
+    thread = threading.Thread(target=run, daemon=True, name="page-descriptions")
+    thread.start()
+    return thread
@@ -0,0 +1,107 @@
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+ANSWER_CACHE_ENABLED = os.environ.get("ANSWER_CACHE_ENABLED", "1") != "0"
+ANSWER_CACHE_SIZE = int(os.environ.get("ANSWER_CACHE_SIZE", 2000))
+ANSWER_CACHE_TTL = float(os.environ.get("ANSWER_CACHE_TTL", 7 * 24 * 3600))
+ANSWER_CACHE_THRESHOLD = float(os.environ.get("ANSWER_CACHE_THRESHOLD", 0.92))
+
+
+def normalize_query(query):
+    """
+    Lowercases a query, collapses whitespace and strips trailing punctuation.
+    Other punctuation is kept: "C++" and "C" are different questions.
+    """
+    return re.sub(r"[\s?!.,;:]+$", "", " ".join(query.lower().split()))
+
+
+class AnswerCache:
+    """
+    In-memory cache of generated answers, scoped per book.
+    A lookup first tries the normalized query text, then the most similar
+    cached query embedding (cosine similarity >= threshold). Entries expire
+    after `ttl` seconds and the least recently used ones are evicted once
+    there are more than `max_entries`. Each entry remembers the collection
+    version it was answered from, so answers are dropped when a book is
+    re-indexed.
+    """
+
+    def __init__(self, max_entries=ANSWER_CACHE_SIZE, ttl=ANSWER_CACHE_TTL, threshold=ANSWER_CACHE_THRESHOLD):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _expired(self, entry, now):
+        return now - entry["created"] > self.ttl
+
+    def _touch(self, key):
+        self._entries.move_to_end(key)
+        return self._entries[key]
+
+    def get(self, book_id, version, query, embed=None):
+        """
+        Returns (entry, match) where match is "exact" or "semantic", or
+        (None, None) on a miss. `embed` is a callable returning the query
+        embedding; it is only called if the exact lookup misses.
+        """
+        key = (book_id, normalize_query(query))
+        now = time.time()
+        with self._lock:
+            self._drop_stale(book_id, version, now)
+            if key in self._entries:
+                return self._touch(key), "exact"
+            candidates = [k for k in self._entries if k[0] == book_id]
+        if not candidates or embed is None:
+            return None, None
+
+        embedding = np.asarray(embed(), dtype=np.float32)
+        embedding = embedding / (np.linalg.norm(embedding) or 1.0)
+        with self._lock:
+            candidates = [k for k in candidates if k in self._entries]
+            if not candidates:
+                return None, None
+            matrix = np.stack([self._entries[k]["embedding"] for k in candidates])
+            scores = matrix @ embedding
+            best = int(np.argmax(scores))
+            if scores[best] >= self.threshold:
+                return self._touch(candidates[best]), "semantic"
+        return None, None
+
+    def put(self, book_id, version, query, embedding, response, **extra):
+        """Stores an answer for a query; extra keyword arguments are kept in the entry."""
+        embedding = np.asarray(embedding, dtype=np.float32)
+        entry = {
+            "query": query,
+            "version": version,
+            "embedding": embedding / (np.linalg.norm(embedding) or 1.0),
+            "response": response,
+            "created": time.time(),
+            **extra,
+        }
+        with self._lock:
+            key = (book_id, normalize_query(query))
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, book_id):
+        """Drops every cached answer for a book."""
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == book_id]:
+                del self._entries[key]
+
+    def _drop_stale(self, book_id, version, now):
+        for key in [k for k, e in self._entries.items()
+                    if self._expired(e, now) or (k[0] == book_id and e["version"] != version)]:
+            del self._entries[key]
@@ -1,76 +1,369 @@
 import os
 import re
-from flask import Flask, request, jsonify
+import json
+import hmac
+import queue
+import threading
+import time
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from flask import Blueprint, Flask, Response, current_app, request, jsonify, stream_with_context
 from flask_cors import CORS
-from embeddings import logger, extract_text_from_pdf, chunk_text, generate_embeddings
-from embeddings import store_embeddings_in_chromadb, process_pdf_with_images
-from retrieval import rewrite_query, HyDERetriever, generate_response
-from utils import count_tokens
-from extract_images import render_pdf_pages
-from analyze_images import analyze_image
+from embeddings import logger, extract_text_from_pdf, chunk_text, embed_queries, QueryEmbedding
+from retrieval import generate_response, generate_response_stream
+from pipeline import retrieve_documents, retrieve_documents_batch, BATCH_CONCURRENCY, PIPELINE_MODES
+from utils import estimate_tokens
+from analyze_images import describe_pages
+from extract_images import warm_render_pool, RENDER_POOL_WARMUP
+from answer_cache import AnswerCache, ANSWER_CACHE_ENABLED
+from rag_system import READY_TIMEOUT
+from library import Library, BACKGROUND_INGESTION
+from metrics import span, count_cache, observe_request, start_request_timings, render_metrics
+from debug_capture import DebugCapture
+import gemini_client
 import logging
 
-# Initialize Flask app
-app = Flask(__name__)
-CORS(app, resources={r"/*": {"origins": "*"}}, supports_credentials=True)
+# API routes, registered on the app by create_app. Handlers reach the
+# per-app state (library of books, answer cache) through current_app.
+api = Blueprint("api", __name__)
 
-# Global variables to maintain state
-collection = None
-chunks = None
-pdf_path = None
+def create_app(role=None, start=False):
+    """
+    Creates the Flask app. `role` is "writer" to ingest books in this
+    process, or "reader" to serve the indexes published by ingest.py (the
+    default is $RAG_ROLE, or "writer"). With `start`, the default book starts
+    loading in the background right away instead of on the first request,
+    and a writer starts ingesting the library's new books in the background.
+    """
+    role = role or os.environ.get("RAG_ROLE", "writer")
+    app = Flask(__name__)
+    CORS(app, resources={r"/*": {"origins": "*"}}, supports_credentials=True)
+    
+    # Cache of generated answers, looked up before running the query pipeline
+    app.extensions["answer_cache"] = answer_cache = AnswerCache()
+    # Books (see library.py), each indexed in the background on first use so
+    # the server starts immediately; answers of closed books are dropped
+    app.extensions["library"] = library = Library(role, on_evict=answer_cache.invalidate)
+    # Recent prompts and responses, for /api/admin/debug-captures
+    app.extensions["debug_capture"] = DebugCapture()
+    app.register_blueprint(api)
+    
+    if start:
+        if library.default_book_id() is not None:
+            library.get()
+        if role == "writer" and BACKGROUND_INGESTION:
+            library.start_ingestion()
+        if RENDER_POOL_WARMUP:
+            warm_render_pool()
+    return app
+
+def get_library():
+    return current_app.extensions["library"]
+
+def get_rag(data):
+    """
+    Returns the RagSystem of the book a request names with "book_id" (the
+    default book if it names none). Raises KeyError for an unknown book.
+    """
+    return get_library().get((data or {}).get('book_id'))
+
+def book_not_found(book_id):
+    message = f"Book {book_id} not available" if book_id else "No books available"
+    return jsonify({"status": "error", "message": message}), 404
+
+def get_answer_cache():
+    return current_app.extensions["answer_cache"]
+
+def get_debug_capture():
+    return current_app.extensions["debug_capture"]
+
+def lookup_cached_answer(rag, answer_cache, query, embed):
+    """
+    Returns a cached answer entry for the current book, or None. `embed`
+    returns the query embedding (see embeddings.QueryEmbedding); it is only
+    called if the exact lookup misses.
+    """
+    if not ANSWER_CACHE_ENABLED:
+        return None
+    with span("answer_cache_lookup"):
+        entry, match = answer_cache.get(rag.book_id, rag.collection_version, query, embed=embed)
+    count_cache("answer", entry is not None)
+    if entry is not None:
+        logger.info(f"Answer cache hit ({match}) for query: {query}")
+    return entry
+
+def store_cached_answer(rag, answer_cache, query, response, tokens, pages, embed):
+    if ANSWER_CACHE_ENABLED:
+        answer_cache.put(
+            rag.book_id, rag.collection_version, query, embed(), response, tokenCount=tokens, pages=pages
+        )
+
+# Instructions placed before the retrieved documents in every prompt
+BASE_CONTEXT = (
+    "You're an expert who answers questions using information from the following documents. "
+    "Answer naturally and conversationally, as if you're explaining the topic to someone, but never explicitly mention the context or use phrases like 'according to the context' or 'the document says'. "
+    "Format your answer using Markdown syntax to improve readability. Use **bold** for important concepts, bullet or numbered lists for items, and headings where appropriate. "
+    "For mathematical formulas, use LaTeX notation enclosed in $ symbols for inline formulas or $$ for block formulas. "
+    "Example: $D_j = D_k + d_{kj}$ for an inline formula or $$D_j = D_k + d_{kj}$$ for a separate block formula. "
+    "Follow these guidelines:\n"
+    "1. Use exclusively information from the provided documents, without adding external details or making unsupported assumptions.\n"
+    "2. Never exclude important information that contributes to understanding the topic requested in the question.\n"
+    "3. Always answer in detail without ever limiting the length of your response.\n"
+    "4. Use appropriate technical language from the documents, maintaining terminological precision.\n"
+    "5. Structure the response in a fluid and conversational way, like a natural explanation.\n"
+    "6. If the documents don't contain sufficient information, honestly answer that you don't have enough information, but do so naturally.\n"
+    "7. Maintain a professional but accessible tone, avoiding rigid academic formulations.\n"
+
+    "Here are the reference documents: "
+)
+
+def build_prompt(similar_docs):
+    """Builds the generation prompt from the retrieved documents."""
+    return BASE_CONTEXT + " ".join(similar_docs)
+
+# Most pages one image-mode query can analyze
+IMAGE_MAX_PAGES = int(os.environ.get("IMAGE_MAX_PAGES", 10))
+
+def page_range(part):
+    """
+    Pages (1-based) of one element of a request: a number, or a string holding
+    a number or an inclusive range ("12-16"). Raises ValueError if invalid.
+    """
+    if isinstance(part, int) and not isinstance(part, bool):
+        return [part]
+    if not isinstance(part, str):
+        raise ValueError(f"Invalid page {part!r}: expected a page number or a range like '12-16'")
+    bounds = [bound.strip() for bound in part.split("-")]
+    if len(bounds) > 2 or not all(bound.isdigit() for bound in bounds):
+        raise ValueError(f"Invalid page range '{part.strip()}'")
+    first, last = int(bounds[0]), int(bounds[-1])
+    if first > last:
+        raise ValueError(f"Invalid page range '{part.strip()}': {first} comes after {last}")
+    if last - first >= IMAGE_MAX_PAGES:
+        raise ValueError(f"At most {IMAGE_MAX_PAGES} pages can be analyzed at once")
+    return range(first, last + 1)
+
+def requested_pages(data, page_count=None):
+    """
+    Pages (1-based) an image-mode request asks for: "pages" as a list of
+    numbers or ranges, or "page_number" as a number, a range ("12-16") or a
+    list ("3, 5, 7"). Returns an empty list when none is given; raises
+    ValueError if invalid or, given `page_count`, past the end of the book.
+    """
+    pages = data.get('pages')
+    if pages is None:
+        parts = [part for part in str(data.get('page_number') or "").split(",") if part.strip()]
+    elif isinstance(pages, list):
+        parts = pages
+    else:
+        raise ValueError("'pages' must be a list of page numbers or ranges")
+    pages = sorted({page for part in parts for page in page_range(part)})
+    if any(page < 1 for page in pages):
+        raise ValueError("Page numbers start at 1")
+    if page_count is not None and any(page > page_count for page in pages):
+        raise ValueError(f"The book has {page_count} pages")
+    if len(pages) > IMAGE_MAX_PAGES:
+        raise ValueError(f"At most {IMAGE_MAX_PAGES} pages can be analyzed at once")
+    return pages
+
+def pipeline_mode_error(data):
+    """Returns an error response if the request names an unknown "pipeline_mode", or None."""
+    mode = data.get('pipeline_mode')
+    if mode is None or mode in PIPELINE_MODES:
+        return None
+    return jsonify({
+        "status": "error",
+        "message": f"Unknown pipeline_mode {mode!r}, expected one of {', '.join(PIPELINE_MODES)}"
+    }), 400
+
+def get_page_context(rag, pages):
+    """Returns the vision descriptions of pages (1-based), formatted as context."""
+    # Render and analyze the pages together (cached by PDF content, page and image size)
+    logger.info(f"Describing pages {', '.join(map(str, pages))}...")
+    with span("page_description"):
+        descriptions = describe_pages(rag.pdf_path, [page - 1 for page in pages])
+    return "\n\n".join(
+        f"[PAGE DESCRIPTION {page}]: {description}"
+        for page, description in zip(pages, descriptions) if description is not None
+    )
+
+def not_ready_response(rag, data):
+    """
+    Waits for the RAG system unless the client asked not to (`"wait": false`).
+    Returns an error response if it isn't ready, or None once it is.
+    """
+    timeout = READY_TIMEOUT if (data or {}).get('wait', True) else 0
+    if rag.wait_until_ready(timeout):
+        return None
+    status = rag.status()
+    if status["state"] == "error":
+        return jsonify({"status": "error", "message": status["error"]}), 500
+    return jsonify({
+        "status": "initializing",
+        "message": "The book is still being indexed, please retry shortly.",
+        "progress": status["progress"]
+    }), 503
+
+def tokens_saved(pipeline_info):
+    """Prompt tokens saved by context assembly (None when it is turned off)"""
+    context = pipeline_info.get("context")
+    return context["tokens_saved"] if context else None
 
-def setup_rag_system():
-    """Initialize the RAG system with the configured PDF"""
-    global collection, chunks, pdf_path
+def timing_breakdown(timings, started):
+    """Per-request timing breakdown returned to clients that asked for it."""
+    return {"stages": timings, "total_ms": round((time.perf_counter() - started) * 1000, 1)}
+
+def sse_event(event, data):
+    """Formats a Server-Sent Event with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def stream_stages(func, *args, **kwargs):
+    """
+    Runs a retrieval function in a worker thread, yielding a "stage" event for
+    every stage it reports through its on_stage callback. The function's
+    return value becomes the value of the `yield from` expression.
+    """
+    events = queue.Queue()
+    result = {}
     
-    # Get PDF path from environment variable
-    pdf_path = os.environ.get("PDF_PATH")
-    if not pdf_path:
-        raise ValueError("The PDF_PATH environment variable is not set.")
-        
-    # Step 1: Extract and chunk text
-    logger.info(f"Starting process for PDF: {pdf_path}")
-    chunks = process_pdf_with_images(pdf_path)
+    def run():
+        try:
+            result["value"] = func(*args, on_stage=events.put, **kwargs)
+        except Exception as e:
+            result["error"] = e
+        finally:
+            events.put(None)
+    
+    # Copy the request context, so the stages are timed for this request
+    threading.Thread(target=contextvars.copy_context().run, args=(run,), daemon=True).start()
+    while (stage := events.get()) is not None:
+        yield sse_event("stage", {"stage": stage})
+    if "error" in result:
+        raise result["error"]
+    return result["value"]
 
-    # Step 2: Generate embeddings
-    chunk_embeddings = generate_embeddings(chunks)
+# Largest number of queries accepted by /api/query/batch, and number of
+# unique queries retrieved together (answers of one group are generated
+# while the next group is retrieved)
+BATCH_MAX_QUERIES = int(os.environ.get("BATCH_MAX_QUERIES", 500))
+BATCH_GROUP_SIZE = int(os.environ.get("BATCH_GROUP_SIZE", 32))
 
-    # Step 3: Store embeddings in ChromaDB
-    collection = store_embeddings_in_chromadb(chunks, chunk_embeddings)
+def answer_query_batch(rag, queries, answer_cache=None, debug_capture=None, concurrency=BATCH_CONCURRENCY):
+    """
+    Answers a list of queries against a ready RagSystem, yielding one result
+    dict per query (with its "index" in `queries`) as soon as it is answered.
+    Identical queries are answered once. Retrieval is batched (see
+    pipeline.retrieve_documents_batch) and at most `concurrency` answers
+    are generated at the same time. Once the consumer stops iterating (the
+    client went away), no new retrieval or answer is started.
+    """
+    unique = {}
+    for index, query in enumerate(queries):
+        unique.setdefault(query.strip(), []).append(index)
+    results = queue.Queue()
+    cancelled = threading.Event()
+    
+    def emit(query, result):
+        for index in unique[query]:
+            results.put({"index": index, "query": queries[index], **result})
     
-    return "RAG system successfully initialized"
+    # The answer cache lookups (and stores) share one embedding call for all the queries
+    use_cache = answer_cache is not None and ANSWER_CACHE_ENABLED
+    query_embeddings = dict(zip(unique, embed_queries(list(unique)))) if use_cache else {}
+    pending = []
+    for query in unique:
+        cached = lookup_cached_answer(rag, answer_cache, query, lambda: query_embeddings[query]) if use_cache else None
+        if cached is not None:
+            emit(query, {"status": "success", "response": cached["response"], "tokenCount": cached["tokenCount"],
+                         "pages": cached["pages"], "cache": "hit"})
+        else:
+            pending.append(query)
+    cache_status = "miss" if use_cache else "bypass"
+    
+    def answer(query, similar_docs, pipeline_info):
+        if cancelled.is_set():
+            return
+        try:
+            prompt = build_prompt(similar_docs)
+            tokens = estimate_tokens(prompt)
+            response = generate_response(query, prompt)
+            if cache_status == "miss":
+                store_cached_answer(rag, answer_cache, query, response, tokens, pipeline_info["pages"],
+                                    lambda: query_embeddings[query])
+            if debug_capture is not None:
+                debug_capture.record(
+                    query, prompt, similar_docs, response,
+                    endpoint="query_batch", book=rag.book_id, pages=pipeline_info["pages"], tokens=tokens, cache=cache_status,
+                    context=pipeline_info["context"]
+                )
+            emit(query, {"status": "success", "response": response, "tokenCount": tokens, "pages": pipeline_info["pages"],
+                         "tokensSaved": tokens_saved(pipeline_info), "cache": cache_status})
+        except Exception as e:
+            logger.error(f"Error answering batch query '{query}': {e}", exc_info=True)
+            emit(query, {"status": "error", "message": str(e)})
+    
+    def run():
+        try:
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                for start in range(0, len(pending), BATCH_GROUP_SIZE):
+                    if cancelled.is_set():
+                        logger.info(f"Batch abandoned by the client, {len(pending) - start} queries not answered")
+                        break
+                    group = pending[start:start + BATCH_GROUP_SIZE]
+                    try:
+                        retrieved = retrieve_documents_batch(
+                            group, rag.collection, lexical_index=rag.lexical_index, concurrency=concurrency,
+                            query_embeddings=[query_embeddings[query] for query in group] if use_cache else None
+                        )
+                    except Exception as e:
+                        logger.error(f"Batch retrieval failed: {e}", exc_info=True)
+                        for query in group:
+                            emit(query, {"status": "error", "message": str(e)})
+                        continue
+                    for query, (similar_docs, pipeline_info) in zip(group, retrieved):
+                        executor.submit(answer, query, similar_docs, pipeline_info)
+        finally:
+            results.put(None)
+    
+    threading.Thread(target=contextvars.copy_context().run, args=(run,), daemon=True).start()
+    try:
+        while (result := results.get()) is not None:
+            yield result
+    finally:
+        # Also reached when the response is closed early, e.g. on a client disconnect
+        cancelled.set()
 
-@app.route('/api/books', methods=['GET'])
+@api.route('/api/books', methods=['GET'])
 def get_books():
-    """Returns the list of available books"""
+    """Returns the books of the library (the default book first), with whether each one is indexed and loaded"""
     try:
-        # Currently we only support one book, but this allows future expansions
-        books_dir = os.path.dirname(os.path.abspath(__file__))
-        pdf_path = os.environ.get("PDF_PATH")
+        books = get_library().books()
         
-        if not pdf_path or not os.path.exists(pdf_path):
+        if not books:
             return jsonify({"status": "error", "message": "No books available"}), 404
-            
-        # Get filename from path
-        filename = os.path.basename(pdf_path)
-        book_name = os.path.splitext(filename)[0].replace("_", " ").title()
-        
-        books = [{
-            "id": os.path.splitext(filename)[0],
-            "name": book_name,
-            "path": pdf_path
-        }]
         
         return jsonify({"status": "success", "books": books})
     except Exception as e:
         logger.error(f"Error retrieving books: {e}")
         return jsonify({"status": "error", "message": str(e)}), 500
 
-@app.route('/api/select-book', methods=['POST'])
+@api.route('/api/status', methods=['GET'])
+def get_status():
+    """
+    Returns the initialization state and indexing progress of a book
+    (?book_id=, default: the default book), and the state of the library
+    """
+    library = get_library()
+    book_id = request.args.get('book_id')
+    try:
+        status = library.book_status(book_id)
+    except KeyError:
+        return book_not_found(book_id)
+    return jsonify({"status": "success", **status, "library": library.status(), "gemini": gemini_client.status()})
+
+@api.route('/api/select-book', methods=['POST'])
 def select_book():
-    """Select a book and initialize the RAG system"""
-    global pdf_path, collection, chunks
-    
+    """Select a book and start initializing the RAG system in the background"""
     try:
         data = request.json
         book_id = data.get('book_id')
@@ -78,66 +371,68 @@ def select_book():
         if not book_id:
             return jsonify({"status": "error", "message": "Book ID required"}), 400
         
-        # Currently we only support the configured book
-        env_pdf_path = os.environ.get("PDF_PATH")
-        filename = os.path.basename(env_pdf_path)
-        file_id = os.path.splitext(filename)[0]
-        
-        if book_id != file_id:
-            return jsonify({"status": "error", "message": "Book not available"}), 404
-        
-        # Set current PDF
-        pdf_path = env_pdf_path
-        
-        # Initialize the RAG system if it hasn't been done already
-        if collection is None:
-            setup_rag_system()
+        # Load the book if it isn't loaded already; clients poll
+        # /api/status?book_id= until it is ready
+        try:
+            rag = get_rag(data)
+        except KeyError:
+            return book_not_found(book_id)
+        status = rag.status()
         
         return jsonify({
             "status": "success", 
-            "message": f"Book {book_id} successfully loaded"
+            "message": f"Book {book_id} successfully loaded" if status["ready"] else f"Book {book_id} is being indexed",
+            "ready": status["ready"],
+            "progress": status["progress"]
         })
     except Exception as e:
         logger.error(f"Error selecting book: {e}")
         return jsonify({"status": "error", "message": str(e)}), 500
 
-@app.route('/api/query', methods=['POST'])
+@api.route('/api/query', methods=['POST'])
 def process_query():
     """Process a user query and return the response"""
-    global collection, pdf_path
+    started = time.perf_counter()
+    answer_cache = get_answer_cache()
     
     try:
-        # Check that the system is initialized
-        if collection is None:
-            setup_rag_system()  # Automatically initialize with the default PDF
-        
         data = request.json
+        # Clients can ask for a per-stage timing breakdown with "timings": true
+        timings = start_request_timings(bool(data.get('timings')))
+        
+        try:
+            rag = get_rag(data)
+        except KeyError:
+            return book_not_found(data.get('book_id'))
+        
+        # Wait (bounded) for the system to be initialized
+        error = not_ready_response(rag, data)
+        if error is not None:
+            return error
+        
         original_query = data.get('query')
         
         if not original_query:
             return jsonify({"status": "error", "message": "Query required"}), 400
         
+        error = pipeline_mode_error(data)
+        if error is not None:
+            return error
+        
         # Image context handling
         image_context = ""
         
         is_image_mode = data.get('is_image_mode', False)
         
         if is_image_mode:
-            # Check if page is specified in the request
-            page_number = data.get('page_number')
-            if page_number:
+            # Check if pages are specified in the request
+            try:
+                pages = requested_pages(data, rag.page_count)
+            except ValueError as e:
+                return jsonify({"status": "error", "message": str(e)}), 400
+            if pages:
                 try:
-                    page_to_analyze = int(page_number) - 1  
-                    
-                    # Render and analyze specific page
-                    logger.info(f"Rendering page {page_to_analyze + 1}...")
-                    rendered_pages = render_pdf_pages(pdf_path, pages=[page_to_analyze])
-                    
-                    if rendered_pages:
-                        page_image_path, _ = rendered_pages[0]
-                        logger.info(f"Analyzing page {page_to_analyze + 1}...")
-                        page_description = analyze_image(page_image_path)
-                        image_context = f"[PAGE DESCRIPTION {page_to_analyze + 1}]: {page_description}"
+                    image_context = get_page_context(rag, pages)
                 except Exception as e:
                     logger.error(f"Error analyzing image: {e}")
                     return jsonify({
@@ -151,68 +446,286 @@ def process_query():
                     "message": "To analyze an image, please specify the page number."
                 })
 
-        # Query rewriting
-        rewritten_query = rewrite_query(original_query)
-        logger.info(f"Rewritten Query: {rewritten_query}")
+        # Answers to page-specific questions depend on the page, so only
+        # plain queries go through the answer cache. The query is embedded
+        # at most once, for the cache and the direct search together.
+        query_embedding = QueryEmbedding(original_query)
+        cache_status = "bypass"
+        if not is_image_mode and ANSWER_CACHE_ENABLED:
+            cached = lookup_cached_answer(rag, answer_cache, original_query, query_embedding)
+            if cached is not None:
+                result = {
+                    "status": "success",
+                    "response": cached["response"],
+                    "tokenCount": cached["tokenCount"],
+                    "pages": cached["pages"],
+                    "cache": "hit"
+                }
+                if timings is not None:
+                    result["timings"] = timing_breakdown(timings, started)
+                observe_request("query", time.perf_counter() - started)
+                return jsonify(result)
+            cache_status = "miss"
 
-        # Retrieve relevant documents using HyDE
-        hyde_retriever = HyDERetriever(collection)
-        similar_docs, hypothetical_doc = hyde_retriever.retrieve(rewritten_query)
+        # Query rewriting and HyDE retrieval, overlapped by the query pipeline
+        with span("retrieval"):
+            similar_docs, pipeline_info = retrieve_documents(
+                original_query, rag.collection, mode=data.get('pipeline_mode'),
+                lexical_index=rag.lexical_index, embed_query=query_embedding
+            )
+        
+        retrieved_docs = similar_docs
         
         # Add image context if available
         if image_context:
             similar_docs = [image_context] + similar_docs
 
         # Generate a response
-        base_context = (
-            "You're an expert who answers questions using information from the following documents. "
-            "Answer naturally and conversationally, as if you're explaining the topic to someone, but never explicitly mention the context or use phrases like 'according to the context' or 'the document says'. "
-            "Format your answer using Markdown syntax to improve readability. Use **bold** for important concepts, bullet or numbered lists for items, and headings where appropriate. "
-            "For mathematical formulas, use LaTeX notation enclosed in $ symbols for inline formulas or $$ for block formulas. "
-            "Example: $D_j = D_k + d_{kj}$ for an inline formula or $$D_j = D_k + d_{kj}$$ for a separate block formula. "
-            "Follow these guidelines:\n"
-            "1. Use exclusively information from the provided documents, without adding external details or making unsupported assumptions.\n"
-            "2. Never exclude important information that contributes to understanding the topic requested in the question.\n"
-            "3. Always answer in detail without ever limiting the length of your response.\n"
-            "4. Use appropriate technical language from the documents, maintaining terminological precision.\n"
-            "5. Structure the response in a fluid and conversational way, like a natural explanation.\n"
-            "6. If the documents don't contain sufficient information, honestly answer that you don't have enough information, but do so naturally.\n"
-            "7. Maintain a professional but accessible tone, avoiding rigid academic formulations.\n"
-
-            "Here are the reference documents: "
-        )
-        prompt = base_context + " ".join(similar_docs)
+        prompt = build_prompt(similar_docs)
 
-        # Check number of tokens in the prompt
-        tokens = count_tokens(prompt)
+        # Check number of tokens in the prompt (local estimate, no API call)
+        tokens = estimate_tokens(prompt)
         logger.info(f"The prompt contains {tokens} tokens.")
 
-        # Save context to file for debugging
-        save_context_to_file(prompt)
-
         # Generate the response
         response = generate_response(original_query, prompt)
         logger.info(f"Generated Response: {response}")
+        if cache_status == "miss":
+            store_cached_answer(rag, answer_cache, original_query, response, tokens, pipeline_info["pages"],
+                                query_embedding)
         
-        return jsonify({
+        # Keep the prompt and response for debugging (in memory, written in the background)
+        get_debug_capture().record(
+            original_query, prompt, retrieved_docs, response,
+            endpoint="query", book=rag.book_id, pages=pipeline_info["pages"], tokens=tokens, cache=cache_status,
+            context=pipeline_info["context"],
+            image_pages=pages if is_image_mode else None
+        )
+        
+        result = {
             "status": "success", 
             "response": response,
-            "tokenCount": tokens
-        })
+            "tokenCount": tokens,
+            "pages": pipeline_info["pages"],
+            "tokensSaved": tokens_saved(pipeline_info),
+            "cache": cache_status
+        }
+        if timings is not None:
+            result["timings"] = timing_breakdown(timings, started)
+        observe_request("query", time.perf_counter() - started)
+        return jsonify(result)
         
     except Exception as e:
         logger.error(f"An error occurred: {e}", exc_info=True)
         return jsonify({"status": "error", "message": str(e)}), 500
 
-def save_context_to_file(context, filename="last_context.txt"):
-    """Save context to a text file, overwriting the previous file."""
+@api.route('/api/query/stream', methods=['POST'])
+def stream_query():
+    """Process a user query and stream the response as Server-Sent Events"""
+    started = time.perf_counter()
+    answer_cache = get_answer_cache()
+    debug_capture = get_debug_capture()
+    data = request.json or {}
+    timings = start_request_timings(bool(data.get('timings')))
+    
     try:
-        with open(filename, "w", encoding="utf-8") as f:
-            f.write(context)
-        logger.info(f"Context saved in {filename}")
-    except Exception as e:
-        logger.error(f"Error saving context: {e}")
+        rag = get_rag(data)
+    except KeyError:
+        return book_not_found(data.get('book_id'))
+    
+    # Wait (bounded) for the system to be initialized
+    error = not_ready_response(rag, data)
+    if error is not None:
+        return error
+    
+    original_query = data.get('query')
+    
+    if not original_query:
+        return jsonify({"status": "error", "message": "Query required"}), 400
+    
+    error = pipeline_mode_error(data)
+    if error is not None:
+        return error
+    
+    try:
+        pages = requested_pages(data, rag.page_count) if data.get('is_image_mode', False) else []
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    
+    def generate():
+        try:
+            image_context = ""
+            if data.get('is_image_mode', False):
+                if not pages:
+                    yield sse_event("page_required", {
+                        "message": "To analyze an image, please specify the page number."
+                    })
+                    return
+                yield sse_event("stage", {"stage": "analyzing_image"})
+                image_context = get_page_context(rag, pages)
+            
+            query_embedding = QueryEmbedding(original_query)
+            cache_status = "bypass"
+            if not data.get('is_image_mode', False) and ANSWER_CACHE_ENABLED:
+                cached = lookup_cached_answer(rag, answer_cache, original_query, query_embedding)
+                if cached is not None:
+                    done = {"tokenCount": cached["tokenCount"], "pages": cached["pages"], "cache": "hit"}
+                    if timings is not None:
+                        done["timings"] = timing_breakdown(timings, started)
+                    yield sse_event("token", {"text": cached["response"]})
+                    yield sse_event("done", done)
+                    observe_request("query_stream", time.perf_counter() - started)
+                    return
+                cache_status = "miss"
+            
+            with span("retrieval"):
+                similar_docs, pipeline_info = yield from stream_stages(
+                    retrieve_documents, original_query, rag.collection, mode=data.get('pipeline_mode'),
+                    lexical_index=rag.lexical_index, embed_query=query_embedding
+                )
+            retrieved_docs = similar_docs
+            if image_context:
+                similar_docs = [image_context] + similar_docs
+            
+            prompt = build_prompt(similar_docs)
+            tokens = estimate_tokens(prompt)
+            logger.info(f"The prompt contains {tokens} tokens.")
+            
+            yield sse_event("stage", {"stage": "generating"})
+            response_parts = []
+            for text in generate_response_stream(original_query, prompt):
+                response_parts.append(text)
+                yield sse_event("token", {"text": text})
+            
+            response = "".join(response_parts)
+            if cache_status == "miss":
+                store_cached_answer(rag, answer_cache, original_query, response, tokens, pipeline_info["pages"],
+                                    query_embedding)
+            debug_capture.record(
+                original_query, prompt, retrieved_docs, response,
+                endpoint="query_stream", book=rag.book_id, pages=pipeline_info["pages"], tokens=tokens, cache=cache_status,
+                context=pipeline_info["context"],
+                image_pages=pages or None
+            )
+            done = {"tokenCount": tokens, "pages": pipeline_info["pages"], "tokensSaved": tokens_saved(pipeline_info),
+                    "cache": cache_status}
+            if timings is not None:
+                done["timings"] = timing_breakdown(timings, started)
+            yield sse_event("done", done)
+            observe_request("query_stream", time.perf_counter() - started)
+        except Exception as e:
+            logger.error(f"An error occurred while streaming: {e}", exc_info=True)
+            yield sse_event("error", {"message": str(e)})
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
+@api.route('/api/query/batch', methods=['POST'])
+def batch_query():
+    """
+    Answers a list of queries about one book ({"queries": [...], "book_id": ...})
+    and streams the results as NDJSON, one line per query in the order they
+    finish, then a summary line
+    """
+    started = time.perf_counter()
+    answer_cache = get_answer_cache()
+    debug_capture = get_debug_capture()
+    data = request.json or {}
+    
+    try:
+        rag = get_rag(data)
+    except KeyError:
+        return book_not_found(data.get('book_id'))
+    
+    error = not_ready_response(rag, data)
+    if error is not None:
+        return error
+    
+    queries = data.get('queries')
+    if not isinstance(queries, list) or not queries or not all(isinstance(query, str) and query.strip() for query in queries):
+        return jsonify({"status": "error", "message": "A non-empty list of queries is required"}), 400
+    if len(queries) > BATCH_MAX_QUERIES:
+        return jsonify({"status": "error", "message": f"At most {BATCH_MAX_QUERIES} queries per batch"}), 400
+    
+    def generate():
+        errors = 0
+        for result in answer_query_batch(rag, queries, answer_cache, debug_capture):
+            errors += result["status"] == "error"
+            yield json.dumps(result) + "\n"
+        seconds = time.perf_counter() - started
+        observe_request("query_batch", seconds)
+        yield json.dumps({
+            "status": "done",
+            "book_id": rag.book_id,
+            "queries": len(queries),
+            "unique": len({query.strip() for query in queries}),
+            "errors": errors,
+            "seconds": round(seconds, 3)
+        }) + "\n"
+    
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+@api.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus metrics of this process (stage latencies, cache and API counters)"""
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+def admin_denied():
+    """
+    Admin endpoints expose prompts and book content. They require the
+    X-Admin-Token header to match $ADMIN_TOKEN, and are closed when no token
+    is configured (behind a reverse proxy every request looks local, so the
+    client address proves nothing).
+    """
+    token = os.environ.get("ADMIN_TOKEN")
+    if not token:
+        return jsonify({"status": "error", "message": "Admin endpoints are disabled (ADMIN_TOKEN is not set)"}), 403
+    if hmac.compare_digest(request.headers.get("X-Admin-Token", ""), token):
+        return None
+    return jsonify({"status": "error", "message": "Forbidden"}), 403
+
+@api.route('/api/admin/debug-captures', methods=['GET'])
+def list_debug_captures():
+    """Recent query captures (without prompts and responses) and the capture settings"""
+    denied = admin_denied()
+    if denied is not None:
+        return denied
+    debug_capture = get_debug_capture()
+    limit = request.args.get('limit', type=int)
+    return jsonify({"settings": debug_capture.settings(), "captures": debug_capture.recent(limit)})
+
+@api.route('/api/admin/debug-captures/<int:capture_id>', methods=['GET'])
+def get_debug_capture_entry(capture_id):
+    """One capture with its full prompt and response"""
+    denied = admin_denied()
+    if denied is not None:
+        return denied
+    capture = get_debug_capture().get(capture_id)
+    if capture is None:
+        return jsonify({"status": "error", "message": "Capture not found (it may have been evicted)"}), 404
+    return jsonify(capture)
+
+@api.route('/api/admin/debug-captures/settings', methods=['POST'])
+def configure_debug_capture():
+    """Turns capturing or writing to disk on and off, or changes the sampling rate"""
+    denied = admin_denied()
+    if denied is not None:
+        return denied
+    data = request.json or {}
+    try:
+        settings = get_debug_capture().configure(
+            enabled=data.get('enabled'), sample_rate=data.get('sample_rate'), flush=data.get('flush')
+        )
+    except (TypeError, ValueError) as e:
+        return jsonify({"status": "error", "message": f"Invalid settings: {e}"}), 400
+    return jsonify({"status": "success", "settings": settings})
 
 if __name__ == "__main__":
+    # Development server. Start indexing right away rather than on the first
+    # request; with the debug reloader, only the child process that serves
+    # requests does it. See wsgi.py for the production entry point.
+    app = create_app(start=os.environ.get("WERKZEUG_RUN_MAIN") == "true")
     app.run(debug=True, host='0.0.0.0', port=5001)  
@@ -0,0 +1,305 @@
+"""
+Offline end-to-end benchmark: ingestion, single queries and concurrent load.
+
+Runs the real backend against synthetic PDFs (see fixtures.py) with the
+Gemini API replaced by fake_genai, so no key or network is needed. Writes
+the results as JSON (stdout, or --output) and a short summary to stderr.
+
+Scenarios:
+  ingest      cold (empty caches) and warm (restart with caches) ingestion
+  query       latency of one streamed query per pipeline mode, split by stage
+  throughput  concurrent /api/query requests against the Flask app over HTTP
+  timeouts    retrieval with rewrite and HyDE calls slower than their
+              timeouts, which must return without waiting for them
+
+Usage (from the backend directory):
+    python benchmarks/bench_e2e.py --sizes small,medium --output results.json
+    python benchmarks/bench_e2e.py --latency-scale 0    # CPU cost only
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import fake_genai
+from fixtures import FIXTURE_SIZES, fixture_pdf
+
+import analyze_images
+import debug_capture
+import embeddings
+import gemini_client
+import extract_images
+import utils
+from rag_system import RagSystem
+
+# Query scenario inputs: one naming an exact term of the book, one vague
+QUERIES = {
+    "exact_term": "Dijkstra shortest path algorithm",
+    "vague": "Why do some networks get slower when many people use them?",
+}
+
+
+def use_workdir(directory):
+    """Points every on-disk cache and store of the backend at `directory`."""
+    embeddings.CACHE_DIR = os.path.join(directory, "cache")
+    embeddings.PERSIST_DIR = os.path.join(directory, "chromadb_store")
+    embeddings.SYNC_STATE_FILE = os.path.join(embeddings.PERSIST_DIR, "sync_state.json")
+    embeddings.PUBLISHED_DIR = os.path.join(embeddings.PERSIST_DIR, "published")
+    embeddings.MANIFEST_DIR = os.path.join(directory, "pdf_chunks")
+    embeddings.MANIFEST_INDEX = os.path.join(embeddings.MANIFEST_DIR, "index.json")
+    utils.CALIBRATION_FILE = os.path.join(embeddings.CACHE_DIR, "token_calibration.json")
+    analyze_images.DESCRIPTIONS_DIR = os.path.join(embeddings.CACHE_DIR, "page_descriptions")
+    debug_capture.DEBUG_CAPTURE_FILE = os.path.join(embeddings.CACHE_DIR, "debug_captures.jsonl")
+    os.makedirs(embeddings.CACHE_DIR, exist_ok=True)
+    os.makedirs(embeddings.PERSIST_DIR, exist_ok=True)
+    reset_process_state()
+
+
+def reset_process_state():
+    """Forgets in-memory caches, as if the process had been restarted."""
+    embeddings._embedding_store = None
+    embeddings._chroma_client = None
+    utils._token_weights = None
+    utils._file_hashes.clear()
+    with extract_images._render_lock:
+        extract_images._render_cache.clear()
+
+
+def calls_since(fake, before):
+    return {kind: count - before.get(kind, 0) for kind, count in fake.calls.items() if count != before.get(kind, 0)}
+
+
+def bench_ingest(fake, pdf_path, size, phase):
+    os.environ["PDF_PATH"] = pdf_path
+    reset_process_state()
+    before = dict(fake.calls)
+    rag = RagSystem(role="writer")
+    start = time.perf_counter()
+    rag.start().join()
+    seconds = time.perf_counter() - start
+    if not rag.ready:
+        raise RuntimeError(f"Ingestion failed: {rag.error}")
+    return {
+        "size": size,
+        "pages": FIXTURE_SIZES[size],
+        "phase": phase,
+        "seconds": round(seconds, 3),
+        "stage_seconds": rag.stage_timings,
+        "chunks": len(rag.chunks),
+        "api_calls": calls_since(fake, before),
+    }
+
+
+def read_sse(response):
+    """Yields (event, data, seconds since the request) from a streamed test client response."""
+    start = time.perf_counter()
+    buffer = ""
+    for chunk in response.response:
+        buffer += chunk.decode("utf-8") if isinstance(chunk, bytes) else chunk
+        while "\n\n" in buffer:
+            raw, buffer = buffer.split("\n\n", 1)
+            fields = dict(line.split(": ", 1) for line in raw.splitlines() if ": " in line)
+            yield fields.get("event"), json.loads(fields.get("data", "null")), time.perf_counter() - start
+
+
+def bench_query(fake, client, mode, name, query):
+    before = dict(fake.calls)
+    response = client.post("/api/query/stream", json={"query": query, "pipeline_mode": mode}, buffered=False)
+    stages = {}
+    first_token = None
+    total = None
+    for event, data, elapsed in read_sse(response):
+        if event == "stage":
+            stages.setdefault(data["stage"], round(elapsed * 1000, 1))
+        elif event == "token" and first_token is None:
+            first_token = elapsed
+        elif event == "error":
+            raise RuntimeError(f"Query failed: {data['message']}")
+        elif event == "done":
+            total = elapsed
+    return {
+        "mode": mode,
+        "query": name,
+        "retrieval_ms": stages.get("generating"),
+        "ttft_ms": round(first_token * 1000, 1),
+        "total_ms": round(total * 1000, 1),
+        "stage_start_ms": stages,
+        "api_calls": calls_since(fake, before),
+    }
+
+
+def bench_throughput(app, concurrency, requests_per_client):
+    from werkzeug.serving import make_server
+
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/api/query"
+
+    def send(index):
+        body = json.dumps({"query": f"{QUERIES['vague']} (variant {index})"}).encode("utf-8")
+        request = urllib.request.Request(url, data=body, headers={"Content-Type": "application/json"})
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request, timeout=120) as response:
+                ok = response.status == 200
+        except Exception:
+            ok = False
+        return time.perf_counter() - start, ok
+
+    total_requests = concurrency * requests_per_client
+    try:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(send, range(total_requests)))
+        seconds = time.perf_counter() - start
+    finally:
+        server.shutdown()
+
+    latencies = np.array([latency for latency, _ in results]) * 1000
+    return {
+        "concurrency": concurrency,
+        "requests": total_requests,
+        "errors": sum(1 for _, ok in results if not ok),
+        "seconds": round(seconds, 3),
+        "requests_per_second": round(total_requests / seconds, 2),
+        "p50_ms": round(float(np.percentile(latencies, 50)), 1),
+        "p95_ms": round(float(np.percentile(latencies, 95)), 1),
+    }
+
+
+def bench_timeouts(fake, rag, mode, slow_seconds=5.0, timeout=1.0):
+    """
+    Retrieves with every generation call taking `slow_seconds` and the
+    rewrite and HyDE stages timing out after `timeout`: the stages are
+    dropped, and retrieval must return without waiting for their calls.
+    """
+    import pipeline
+
+    latency = dict(fake.latency)
+    timeouts = dict(pipeline.STAGE_TIMEOUTS)
+    fake.latency["generate"] = slow_seconds
+    pipeline.STAGE_TIMEOUTS.update(rewrite=timeout, hyde=timeout)
+    try:
+        start = time.perf_counter()
+        _, info = pipeline.retrieve_documents(
+            QUERIES["vague"], rag.collection, mode=mode, lexical_index=rag.lexical_index
+        )
+        seconds = time.perf_counter() - start
+    finally:
+        fake.latency.update(latency)
+        pipeline.STAGE_TIMEOUTS.update(timeouts)
+    if seconds >= slow_seconds:
+        raise RuntimeError(f"{mode} retrieval took {seconds:.1f}s, waiting for stages that timed out after {timeout}s")
+    return {
+        "mode": mode,
+        "slow_call_seconds": slow_seconds,
+        "stage_timeout_seconds": timeout,
+        "retrieval_ms": round(seconds * 1000, 1),
+        "dropped_stages": info["dropped_stages"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default="small,medium", help=f"fixture sizes to ingest ({', '.join(FIXTURE_SIZES)})")
+    parser.add_argument("--query-size", default="medium", help="fixture used by the query and throughput scenarios")
+    parser.add_argument("--modes", default="sync,full,fast", help="pipeline modes of the query scenario")
+    parser.add_argument("--concurrency", default="1,4,16", help="client counts of the throughput scenario")
+    parser.add_argument("--requests-per-client", type=int, default=3)
+    parser.add_argument("--latency-scale", type=float, default=1.0, help="multiplies every simulated API latency")
+    parser.add_argument("--scenarios", default="ingest,query,throughput,timeouts")
+    parser.add_argument("--answer-cache", action="store_true", help="keep the answer cache on (off by default)")
+    parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+    args = parser.parse_args()
+    # Relative to where the benchmark was started, not to the temporary directory it runs in
+    if args.output:
+        args.output = os.path.abspath(args.output)
+
+    latency = {kind: seconds * args.latency_scale for kind, seconds in fake_genai.DEFAULT_LATENCY.items()}
+    fake = fake_genai.install(latency)
+    gemini_client.GEMINI_RATE_LIMIT = 0
+    scenarios = args.scenarios.split(",")
+    sizes = args.sizes.split(",")
+
+    results = {
+        "benchmark": "e2e",
+        "schema_version": 1,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "environment": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+        "config": {"latency": latency, "sizes": sizes, "query_size": args.query_size, "answer_cache": args.answer_cache},
+        "ingest": [],
+        "query": [],
+        "throughput": [],
+        "timeouts": [],
+    }
+
+    with tempfile.TemporaryDirectory() as directory:
+        # Files written relative to the working directory stay in the temp dir
+        os.chdir(directory)
+        fixtures_dir = os.path.join(directory, "fixtures")
+        os.makedirs(fixtures_dir)
+
+        if "ingest" in scenarios:
+            for size in sizes:
+                use_workdir(os.path.join(directory, f"ingest_{size}"))
+                pdf_path = fixture_pdf(fixtures_dir, size)
+                for phase in ("cold", "warm"):
+                    result = bench_ingest(fake, pdf_path, size, phase)
+                    results["ingest"].append(result)
+                    print(f"ingest {size:<6} {phase}: {result['seconds']:.2f}s, {result['chunks']} chunks", file=sys.stderr)
+
+        if "query" in scenarios or "throughput" in scenarios or "timeouts" in scenarios:
+            import app as app_module
+
+            app_module.ANSWER_CACHE_ENABLED = args.answer_cache
+            use_workdir(os.path.join(directory, "serve"))
+            os.environ["PDF_PATH"] = fixture_pdf(fixtures_dir, args.query_size)
+            app = app_module.create_app(role="writer")
+            rag = app.extensions["library"].get()
+            rag.start().join()
+            if not rag.ready:
+                raise RuntimeError(f"Ingestion failed: {rag.error}")
+
+            if "query" in scenarios:
+                client = app.test_client()
+                for mode in args.modes.split(","):
+                    for name, query in QUERIES.items():
+                        result = bench_query(fake, client, mode, name, query)
+                        results["query"].append(result)
+                        print(f"query  {mode:<5} {name:<10}: retrieval {result['retrieval_ms']}ms, "
+                              f"first token {result['ttft_ms']}ms, total {result['total_ms']}ms", file=sys.stderr)
+
+            if "throughput" in scenarios:
+                for concurrency in map(int, args.concurrency.split(",")):
+                    result = bench_throughput(app, concurrency, args.requests_per_client)
+                    results["throughput"].append(result)
+                    print(f"load   {concurrency:>3} clients: {result['requests_per_second']} req/s, "
+                          f"p50 {result['p50_ms']}ms, p95 {result['p95_ms']}ms, {result['errors']} errors", file=sys.stderr)
+
+            if "timeouts" in scenarios:
+                # Last, since the abandoned calls still finish in the background
+                for mode in ("full", "fast"):
+                    result = bench_timeouts(fake, rag, mode)
+                    results["timeouts"].append(result)
+                    print(f"timeout {mode:<5}: retrieval {result['retrieval_ms']}ms with "
+                          f"{result['slow_call_seconds']}s calls, dropped {', '.join(result['dropped_stages'])}",
+                          file=sys.stderr)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""
+Offline throughput benchmark for generate_embeddings.
+
+Embeds synthetic chunks with the FakeEmbedder (no network calls) and reports
+chunks per second for a cold cache and a warm cache (store reopened from disk).
+
+Usage (from the backend directory):
+    python benchmarks/bench_embeddings.py --chunks 2000 --latency 0.3
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("GEMINI_API_KEY", "offline-benchmark")
+
+import embeddings
+from embedding_store import EmbeddingStore
+from embeddings import FakeEmbedder, generate_embeddings, set_embedder
+
+
+def make_chunks(count, size=500):
+    words = [f"word{i % 997}" for i in range(size // 6)]
+    return [f"chunk {i} " + " ".join(words[i % 7:]) for i in range(count)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--chunks", type=int, default=2000)
+    parser.add_argument("--latency", type=float, default=0.3, help="simulated seconds per request")
+    parser.add_argument("--per-item-latency", type=float, default=0.002, help="simulated seconds per text")
+    parser.add_argument("--batch-size", type=int, default=embeddings.EMBED_BATCH_SIZE)
+    parser.add_argument("--workers", type=int, default=embeddings.EMBED_MAX_WORKERS)
+    args = parser.parse_args()
+
+    embeddings.EMBED_BATCH_SIZE = args.batch_size
+    embeddings.EMBED_MAX_WORKERS = args.workers
+    set_embedder(FakeEmbedder(latency=args.latency, per_item_latency=args.per_item_latency))
+
+    chunks = make_chunks(args.chunks)
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for label in ("cold", "warm"):
+            start = time.perf_counter()
+            generate_embeddings(chunks, store=EmbeddingStore(cache_dir))
+            elapsed = time.perf_counter() - start
+            print(f"{label}: {len(chunks)} chunks in {elapsed:.2f}s ({len(chunks) / elapsed:.0f} chunks/s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Recall and latency benchmark for the retrieval backends.
+
+Indexes synthetic clustered embeddings in Chroma and in every in-memory
+vector index, runs the same top-k queries against each, and reports recall
+against exact cosine search plus median and p95 query latency.
+
+Usage (from the backend directory):
+    python benchmarks/bench_retrieval.py --vectors 20000 --queries 200 --k 20
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import chromadb
+from vector_index import INDEX_CLASSES, normalize_rows
+
+
+def make_vectors(count, dim, clusters, rng):
+    """Normalized vectors grouped around random centers, like chunks of related topics."""
+    centers = rng.standard_normal((clusters, dim)).astype(np.float32)
+    labels = rng.integers(0, clusters, size=count)
+    return normalize_rows(centers[labels] + 0.6 * rng.standard_normal((count, dim)).astype(np.float32))
+
+
+def build_chroma(directory, ids, documents, metadatas, vectors):
+    client = chromadb.PersistentClient(path=directory)
+    # The default (L2) space, like the collections of embeddings.get_collection;
+    # on normalized vectors it ranks like cosine similarity
+    collection = client.create_collection(name="bench_chunks")
+    batch_size = client.get_max_batch_size()
+    for start in range(0, len(ids), batch_size):
+        end = start + batch_size
+        collection.add(
+            ids=ids[start:end], documents=documents[start:end],
+            metadatas=metadatas[start:end], embeddings=vectors[start:end].tolist()
+        )
+    return collection
+
+
+def run_queries(index, queries, k):
+    """Returns the retrieved IDs of every query and the per-query latencies in ms."""
+    retrieved = []
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        results = index.query(query_embeddings=[query.tolist()], n_results=k, include=["documents", "metadatas"])
+        latencies.append((time.perf_counter() - start) * 1000)
+        retrieved.append(results["ids"][0])
+    return retrieved, np.array(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--vectors", type=int, default=20000)
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--clusters", type=int, default=200)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    vectors = make_vectors(args.vectors, args.dim, args.clusters, rng)
+    queries = make_vectors(args.queries, args.dim, args.clusters, rng)
+    ids = [f"chunk-{i}" for i in range(args.vectors)]
+    documents = [f"document {i}" for i in range(args.vectors)]
+    metadatas = [{"page": i // 5 + 1, "tokens": 120} for i in range(args.vectors)]
+
+    # Ground truth: exact cosine search in float64
+    scores = queries.astype(np.float64) @ vectors.astype(np.float64).T
+    truth = [set(ids[row] for row in np.argsort(-row_scores)[:args.k]) for row_scores in scores]
+
+    print(f"{args.vectors} vectors x {args.dim} dims, {args.queries} queries, top-{args.k}")
+    print(f"{'backend':<12} {'build s':>8} {'recall':>8} {'p50 ms':>8} {'p95 ms':>8}")
+    with tempfile.TemporaryDirectory() as chroma_dir:
+        backends = [("chroma", lambda: build_chroma(chroma_dir, ids, documents, metadatas, vectors))]
+        for name, index_class in INDEX_CLASSES.items():
+            backends.append((name, lambda index_class=index_class: index_class(ids, documents, metadatas, vectors)))
+
+        for name, build in backends:
+            try:
+                start = time.perf_counter()
+                index = build()
+                build_time = time.perf_counter() - start
+            except ImportError as e:
+                print(f"{name:<12} skipped: {e}")
+                continue
+            retrieved, latencies = run_queries(index, queries, args.k)
+            recall = np.mean([len(truth_ids & set(found)) / args.k for truth_ids, found in zip(truth, retrieved)])
+            print(f"{name:<12} {build_time:>8.2f} {recall:>8.3f} {np.percentile(latencies, 50):>8.2f} {np.percentile(latencies, 95):>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
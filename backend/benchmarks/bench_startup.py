@@ -0,0 +1,169 @@
+"""
+Offline startup benchmark: how long a fresh server process takes to be useful.
+
+Each run starts a new Python process that serves a book already ingested
+into a temporary directory (as a gunicorn worker does, with the Gemini API
+replaced by fake_genai), and records, from the moment it was spawned:
+
+  interpreter      Python is up and runs the benchmark
+  import           `import app` is done
+  bind             the app is created and its HTTP server is listening
+  first_query      the first /api/query answer has been received
+
+plus the heavy dependencies already loaded after `import app`, which should
+stay empty: they are imported on first use. The medians over the runs are
+written as JSON (stdout, or --output), and a short summary to stderr.
+
+Usage (from the backend directory):
+    python benchmarks/bench_startup.py --runs 5 --output results.json
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Modules that used to be imported with the app and should now only be
+# loaded when a request needs them
+HEAVY_MODULES = ["chromadb", "langchain", "fitz", "PIL", "google.generativeai", "google.api_core"]
+
+QUERY = "Dijkstra shortest path algorithm"
+
+STAGES = ["interpreter_ms", "import_ms", "bind_ms", "first_query_ms"]
+
+
+def child(workdir, pdf_path, spawned, latency_scale):
+    """Runs in the measured process: imports, binds and answers one query."""
+    started = time.time()
+    import app as app_module
+    imported = time.time()
+    heavy = [name for name in HEAVY_MODULES if name in sys.modules]
+
+    # Everything these import is already loaded by the app, apart from the
+    # fake backend, which a real process would load on its first API call too
+    import fake_genai
+    import gemini_client
+    from bench_e2e import use_workdir
+    from werkzeug.serving import make_server
+
+    use_workdir(workdir)
+    os.environ["PDF_PATH"] = pdf_path
+    fake_genai.install({kind: seconds * latency_scale for kind, seconds in fake_genai.DEFAULT_LATENCY.items()})
+    gemini_client.GEMINI_RATE_LIMIT = 0
+
+    app = app_module.create_app(role="reader", start=True)
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    bound = time.time()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    request = urllib.request.Request(
+        f"http://127.0.0.1:{server.server_port}/api/query",
+        data=json.dumps({"query": QUERY}).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+    )
+    with urllib.request.urlopen(request, timeout=120) as response:
+        status = response.status
+        response.read()
+    answered = time.time()
+    server.shutdown()
+
+    print(json.dumps({
+        "interpreter_ms": round((started - spawned) * 1000, 1),
+        "import_ms": round((imported - spawned) * 1000, 1),
+        "bind_ms": round((bound - spawned) * 1000, 1),
+        "first_query_ms": round((answered - spawned) * 1000, 1),
+        "status": status,
+        "heavy_modules_at_import": heavy,
+    }))
+
+
+def ingest(workdir, pdf_path):
+    """Ingests and publishes the book once, in this process."""
+    import fake_genai
+    import gemini_client
+    from bench_e2e import use_workdir
+    from rag_system import RagSystem
+
+    fake_genai.install({kind: 0.0 for kind in fake_genai.DEFAULT_LATENCY})
+    gemini_client.GEMINI_RATE_LIMIT = 0
+    use_workdir(workdir)
+    os.environ["PDF_PATH"] = pdf_path
+    rag = RagSystem(role="writer")
+    rag.start().join()
+    if not rag.ready:
+        raise RuntimeError(f"Ingestion failed: {rag.error}")
+
+
+def run_once(workdir, pdf_path, latency_scale):
+    env = dict(os.environ, GEMINI_BACKEND="fake")
+    command = [sys.executable, os.path.abspath(__file__), "--child", workdir, pdf_path,
+               "--latency-scale", str(latency_scale), "--spawned", str(time.time())]
+    result = subprocess.run(command, env=env, capture_output=True, text=True, timeout=300)
+    if result.returncode != 0:
+        raise RuntimeError(f"Startup run failed:\n{result.stderr[-2000:]}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size", default="medium", help="fixture size of the served book")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--latency-scale", type=float, default=1.0, help="multiplies every simulated API latency")
+    parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+    parser.add_argument("--child", nargs=2, metavar=("WORKDIR", "PDF"), help=argparse.SUPPRESS)
+    parser.add_argument("--spawned", type=float, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    # Relative to where the benchmark was started, not to the temporary directory it runs in
+    if args.output:
+        args.output = os.path.abspath(args.output)
+
+    if args.child:
+        child(*args.child, args.spawned, args.latency_scale)
+        return
+
+    from fixtures import fixture_pdf
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        workdir = os.path.join(directory, "serve")
+        fixtures_dir = os.path.join(directory, "fixtures")
+        os.makedirs(fixtures_dir)
+        pdf_path = fixture_pdf(fixtures_dir, args.size)
+        ingest(workdir, pdf_path)
+        runs = []
+        for run in range(args.runs):
+            result = run_once(workdir, pdf_path, args.latency_scale)
+            runs.append(result)
+            print(f"run {run + 1}: import {result['import_ms']}ms, bind {result['bind_ms']}ms, "
+                  f"first query {result['first_query_ms']}ms", file=sys.stderr)
+
+    results = {
+        "benchmark": "startup",
+        "schema_version": 1,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "environment": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+        "config": {"size": args.size, "runs": args.runs, "latency_scale": args.latency_scale, "query": QUERY},
+        "median": {stage: round(statistics.median(run[stage] for run in runs), 1) for stage in STAGES},
+        "heavy_modules_at_import": sorted({name for run in runs for name in run["heavy_modules_at_import"]}),
+        "runs": runs,
+    }
+    print("median: " + ", ".join(f"{stage} {value}" for stage, value in results["median"].items()), file=sys.stderr)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,25 @@
+"""
+Offline Gemini backend for the benchmarks: the fake_gemini stand-in, with
+install() to swap it in for the real API.
+
+Import this module with GEMINI_BACKEND=fake set (so config.py accepts a
+missing key), then call install().
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("GEMINI_BACKEND", "fake")
+
+from fake_gemini import DEFAULT_LATENCY, FakeGenAI, FakeModel  # noqa: E402
+
+
+def install(latency=None, max_concurrency=None):
+    """Makes gemini_client use a new FakeGenAI and returns it."""
+    import embeddings
+    import gemini_client
+
+    fake = FakeGenAI(latency, max_concurrency=max_concurrency)
+    gemini_client.set_backend(fake)
+    embeddings.set_embedder(embeddings.GeminiEmbedder())
+    return fake
@@ -0,0 +1,72 @@
+"""
+Synthetic PDF fixtures for the offline benchmarks. Every page covers one
+topic: a few topic-specific terms mixed into common filler words, like a
+textbook chapter. Generation is deterministic for a given size and seed.
+"""
+import os
+import random
+
+# Named fixture sizes, in pages
+FIXTURE_SIZES = {"small": 10, "medium": 100, "large": 500}
+
+TOPICS = [
+    "Dijkstra shortest path algorithm link state routing",
+    "Bellman Ford distance vector routing count to infinity",
+    "TCP slow start congestion window threshold",
+    "TCP three way handshake SYN ACK sequence numbers",
+    "Ethernet CSMA CD collision detection backoff",
+    "IPv4 addressing subnet mask CIDR prefix",
+    "IPv6 header extension headers autoconfiguration",
+    "OSPF areas link state advertisements flooding",
+    "BGP autonomous systems path vector policies",
+    "DNS resolution recursive iterative resolvers caching",
+    "HTTP persistent connections pipelining cookies",
+    "Wireless 802.11 hidden terminal RTS CTS",
+    "Queueing theory Little law M/M/1 utilization",
+    "Error detection CRC checksum parity bits",
+    "Sliding window Go Back N selective repeat",
+    "Multiplexing TDM FDM statistical multiplexing",
+    "Network address translation port mapping",
+    "Spanning tree protocol bridges loops root election",
+    "MPLS labels forwarding equivalence classes",
+    "Quality of service token bucket leaky bucket shaping",
+]
+
+FILLER_WORDS = (
+    "the a of and to in is that for on with as by this are be from at an which it or can "
+    "network data packet node link host message protocol layer time rate transmission "
+    "system each when used between two receiver sender delay information service number "
+    "value example case first next must other also value traffic address control"
+).split()
+
+
+def make_book_pdf(path, pages, seed=0, words_per_paragraph=70, paragraphs=5):
+    """Writes a `pages`-page synthetic textbook PDF to `path`."""
+    # Imported here so bench_startup.py can import the benchmark helpers
+    # without loading PyMuPDF ahead of the app
+    import fitz
+
+    rnd = random.Random(seed)
+    doc = fitz.open()
+    for page_num in range(pages):
+        topic_words = TOPICS[(page_num // 3) % len(TOPICS)].split()
+        paragraphs_text = []
+        for _ in range(paragraphs):
+            words = [
+                rnd.choice(topic_words) if rnd.random() < 0.15 else rnd.choice(FILLER_WORDS)
+                for _ in range(words_per_paragraph)
+            ]
+            paragraphs_text.append(" ".join(words).capitalize() + ".")
+        page = doc.new_page()
+        page.insert_textbox(fitz.Rect(50, 50, 550, 800), f"Page {page_num + 1}\n" + "\n\n".join(paragraphs_text), fontsize=9)
+    doc.save(path)
+    doc.close()
+    return path
+
+
+def fixture_pdf(directory, size, seed=0):
+    """Returns the path of a named fixture in `directory`, generating it if needed."""
+    path = os.path.join(directory, f"book_{size}_{seed}.pdf")
+    if not os.path.exists(path):
+        make_book_pdf(path, FIXTURE_SIZES[size], seed=seed)
+    return path
@@ -5,10 +5,18 @@ load_dotenv()
 
 gemini_api_key = os.environ.get("GEMINI_API_KEY")
 
-if not gemini_api_key:
-    print("Error: the environment variable GEMINI_API_KEY is not set.")
-    
-    raise ValueError("GEMINI_API_KEY not found in environment variables.")
-    exit(1)
+# "fake" runs without an API key, against the local stand-in of the Gemini
+# API in fake_gemini.py (see gemini_client.py)
+gemini_backend = os.environ.get("GEMINI_BACKEND", "api")
 
 
+def require_api_key():
+    """
+    Returns the API key, or raises ValueError if it is not set. Checked when
+    the API is first used (gemini_client.get_backend), not at import, so
+    tools and tests can import the modules without a key.
+    """
+    if not gemini_api_key:
+        print("Error: the environment variable GEMINI_API_KEY is not set.")
+        raise ValueError("GEMINI_API_KEY not found in environment variables.")
+    return gemini_api_key
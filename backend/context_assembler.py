@@ -0,0 +1,179 @@
+import logging
+import os
+
+import numpy as np
+
+from embeddings import compute_chunk_hash, get_embedding_store
+from lexical import RRF_K
+from metrics import count_tokens_saved, timed
+from utils import estimate_tokens
+from vector_index import normalize_rows
+
+logger = logging.getLogger(__name__)
+
+# Builds the prompt context from the fused retrieval candidates instead of
+# packing them in rank order (see HyDERetriever.pack):
+#   - chunks are picked greedily by usefulness per token, where usefulness is
+#     the MMR score: CONTEXT_MMR_LAMBDA * relevance minus the rest times the
+#     similarity to the closest chunk already picked. The score only sets
+#     the order: picking goes on while chunks fit in the budget, even when
+#     their score is negative (a chunk found by a single ranked list is
+#     easily outweighed by ordinary topical similarity)
+#   - chunks at least CONTEXT_DUPLICATE_SIMILARITY similar to a picked chunk
+#     are dropped as near-duplicates, the only candidates left out on purpose
+#   - consecutive chunks of the same page are stitched back into one passage,
+#     without the text the splitter repeated between them
+CONTEXT_ASSEMBLY_ENABLED = os.environ.get("CONTEXT_ASSEMBLY_ENABLED", "1") != "0"
+CONTEXT_MMR_LAMBDA = float(os.environ.get("CONTEXT_MMR_LAMBDA", 0.7))
+CONTEXT_DUPLICATE_SIMILARITY = float(os.environ.get("CONTEXT_DUPLICATE_SIMILARITY", 0.95))
+
+# Tokens reserved for the base prompt and for the response, as in HyDERetriever.pack
+BASE_CONTEXT_TOKENS = 500
+RESPONSE_TOKENS = 500
+
+# Shortest repeated text recognised as splitter overlap between two chunks
+# (the splitter repeats up to chunk_overlap=50 characters)
+MIN_OVERLAP_CHARS = 8
+MAX_OVERLAP_CHARS = 200
+
+
+def overlap_length(first, second, max_chars=MAX_OVERLAP_CHARS):
+    """Length of the longest end of `first` that `second` starts with."""
+    for length in range(min(len(first), len(second), max_chars), MIN_OVERLAP_CHARS - 1, -1):
+        if first.endswith(second[:length]):
+            return length
+    return 0
+
+
+def is_neighbour(metadata, other):
+    return (
+        metadata.get("page") is not None
+        and metadata.get("page") == other.get("page")
+        and metadata.get("chunk_index") is not None
+        and other.get("chunk_index") is not None
+        and abs(metadata["chunk_index"] - other["chunk_index"]) == 1
+    )
+
+
+def lookup_embeddings(docs):
+    """
+    Normalized embeddings of the candidates from the embedding store, or None
+    when one of them is not stored (no API call is made for them).
+    """
+    store = get_embedding_store()
+    hashes = [compute_chunk_hash(doc) for doc in docs]
+    if not hashes or any(chunk_hash not in store for chunk_hash in hashes):
+        return None
+    return normalize_rows(store.get_many(hashes))
+
+
+def stitch(docs, metadatas):
+    """
+    Merges runs of consecutive chunks of the same page into one passage each,
+    in page order. A passage takes the position of its best ranked chunk.
+    Returns (passages, metadatas, overlap_tokens) where overlap_tokens is
+    the number of repeated tokens removed.
+    """
+    groups = []
+    for position, metadata in enumerate(metadatas):
+        adjacent = [group for group in groups if any(is_neighbour(metadata, metadatas[member]) for member in group)]
+        merged = [position]
+        for group in adjacent:
+            merged.extend(group)
+            groups.remove(group)
+        groups.append(merged)
+    groups.sort(key=min)
+
+    passages, passage_metadatas = [], []
+    overlap_tokens = 0
+    for group in groups:
+        members = sorted(group, key=lambda member: metadatas[member].get("chunk_index") or 0)
+        text = docs[members[0]]
+        repeated = 0
+        for previous, member in zip(members, members[1:]):
+            length = overlap_length(docs[previous], docs[member])
+            if length:
+                repeated += estimate_tokens(docs[member][:length])
+            text += docs[member][length:] if length else "\n" + docs[member]
+        overlap_tokens += repeated
+        passages.append(text)
+        passage_metadatas.append({
+            **metadatas[members[0]],
+            "chunks": len(members),
+            "tokens": sum(metadatas[member].get("tokens") or estimate_tokens(docs[member]) for member in members) - repeated,
+        })
+    return passages, passage_metadatas, overlap_tokens
+
+
+@timed("assemble_context")
+def assemble_context(candidate_docs, candidate_metadatas, max_tokens=8000, scores=None):
+    """
+    Selects and merges retrieval candidates (best first) into the documents
+    of the prompt. `scores` are the candidates' relevance scores, by default
+    reciprocal rank scores. Returns (docs, metadatas, report) where report
+    counts the candidates, the chunks selected and stitched, and the tokens
+    saved by removing splitter overlap and near-duplicate chunks.
+    """
+    count = len(candidate_docs)
+    metadatas = [metadata or {} for metadata in candidate_metadatas]
+    tokens = np.array([metadata.get("tokens") or estimate_tokens(doc) for doc, metadata in zip(candidate_docs, metadatas)],
+                      dtype=np.float32)
+    if scores is None:
+        scores = [1.0 / (RRF_K + rank) for rank in range(1, count + 1)]
+    relevance = np.asarray(scores, dtype=np.float32)
+    if count:
+        relevance = relevance / (relevance.max() or 1.0)
+
+    embeddings = lookup_embeddings(candidate_docs)
+    similarities = embeddings @ embeddings.T if embeddings is not None else np.zeros((count, count), dtype=np.float32)
+    # Neighbouring chunks share a topic but not text (the overlap is removed
+    # when they are stitched), so they don't count as redundant
+    for i in range(count):
+        for j in range(i + 1, count):
+            if is_neighbour(metadatas[i], metadatas[j]):
+                similarities[i, j] = similarities[j, i] = 0.0
+
+    budget = max_tokens - BASE_CONTEXT_TOKENS - RESPONSE_TOKENS
+    # Usefulness is divided by the size relative to an average chunk
+    token_scale = tokens / (tokens.mean() if count else 1.0)
+    selected = []
+    duplicates = []
+    remaining = set(range(count))
+    used = 0.0
+    while remaining:
+        candidates = np.array(sorted(remaining))
+        redundancy = similarities[np.ix_(candidates, selected)].max(axis=1) if selected else np.zeros(len(candidates))
+        for candidate in candidates[redundancy >= CONTEXT_DUPLICATE_SIMILARITY]:
+            duplicates.append(int(candidate))
+            remaining.discard(int(candidate))
+        usefulness = CONTEXT_MMR_LAMBDA * relevance[candidates] - (1 - CONTEXT_MMR_LAMBDA) * redundancy
+        # Smaller chunks go first at equal usefulness, whether it is positive or negative
+        scale = np.maximum(token_scale[candidates], 1e-6)
+        density = np.where(usefulness > 0, usefulness / scale, usefulness * scale)
+        density[(redundancy >= CONTEXT_DUPLICATE_SIMILARITY) | (used + tokens[candidates] > budget)] = -np.inf
+        if not np.isfinite(density).any():
+            break
+        best = int(candidates[int(np.argmax(density))])
+        selected.append(best)
+        remaining.discard(best)
+        used += tokens[best]
+
+    # Near-duplicates only cost tokens if rank order packing would have reached them
+    rank_order_end = int(np.searchsorted(np.cumsum(tokens), budget, side="right"))
+    duplicate_tokens = int(sum(tokens[i] for i in duplicates if i < rank_order_end))
+
+    selected.sort()
+    docs, selected_metadatas, overlap_tokens = stitch([candidate_docs[i] for i in selected], [metadatas[i] for i in selected])
+    count_tokens_saved("overlap", overlap_tokens)
+    count_tokens_saved("duplicate", duplicate_tokens)
+    report = {
+        "candidates": count,
+        "selected": len(selected),
+        "passages": len(docs),
+        "duplicates": len(duplicates),
+        "tokens": int(used) - overlap_tokens,
+        "tokens_saved": overlap_tokens + duplicate_tokens,
+    }
+    logger.info(f"Assembled {len(selected)} of {count} chunks into {len(docs)} passages "
+                f"({report['tokens']} tokens, {report['tokens_saved']} saved)")
+    return docs, selected_metadatas, report
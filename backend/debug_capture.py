@@ -0,0 +1,142 @@
+import itertools
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from collections import deque
+
+from embeddings import compute_chunk_hash
+
+logger = logging.getLogger(__name__)
+
+# Recent queries (prompt, retrieved chunk IDs, response) are kept in memory
+# for debugging. A sample of DEBUG_CAPTURE_SAMPLE_RATE of the queries is
+# captured; with DEBUG_CAPTURE_FLUSH=1, captures are also appended to
+# DEBUG_CAPTURE_FILE (JSON lines) by a background thread. Writing to disk is
+# off by default: the file would keep every user's query, prompt and answer.
+DEBUG_CAPTURE_ENABLED = os.environ.get("DEBUG_CAPTURE_ENABLED", "1") != "0"
+DEBUG_CAPTURE_SAMPLE_RATE = float(os.environ.get("DEBUG_CAPTURE_SAMPLE_RATE", 1.0))
+DEBUG_CAPTURE_SIZE = int(os.environ.get("DEBUG_CAPTURE_SIZE", 50))
+DEBUG_CAPTURE_FLUSH = os.environ.get("DEBUG_CAPTURE_FLUSH", "0") == "1"
+DEBUG_CAPTURE_FILE = os.environ.get(
+    "DEBUG_CAPTURE_FILE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "debug_captures.jsonl")
+)
+# The capture file is rotated to <file>.1 once it grows past this size
+DEBUG_CAPTURE_MAX_BYTES = int(os.environ.get("DEBUG_CAPTURE_MAX_BYTES", 20 * 1024 * 1024))
+
+# Captures waiting for the writer; when it falls behind, new ones are not written
+WRITE_QUEUE_SIZE = 200
+
+
+class DebugCapture:
+    """
+    Bounded ring buffer of recent query captures. record() only appends to
+    memory and hands the capture to a background writer, so requests never
+    wait on file I/O; the writer thread is started on first use.
+    """
+
+    def __init__(self, enabled=DEBUG_CAPTURE_ENABLED, sample_rate=DEBUG_CAPTURE_SAMPLE_RATE,
+                 size=DEBUG_CAPTURE_SIZE, flush=DEBUG_CAPTURE_FLUSH, path=None):
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.flush = flush
+        self.path = path or DEBUG_CAPTURE_FILE
+        self.dropped = 0
+        self._captures = deque(maxlen=size)
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+        self._writer = None
+
+    def settings(self):
+        return {
+            "enabled": self.enabled,
+            "sample_rate": self.sample_rate,
+            "size": self._captures.maxlen,
+            "flush": self.flush,
+            "path": self.path,
+            "captured": len(self._captures),
+            "dropped_writes": self.dropped,
+        }
+
+    def configure(self, enabled=None, sample_rate=None, flush=None):
+        """Changes the toggles at runtime; None leaves a setting unchanged."""
+        if enabled is not None:
+            self.enabled = bool(enabled)
+        if sample_rate is not None:
+            self.sample_rate = min(1.0, max(0.0, float(sample_rate)))
+        if flush is not None:
+            self.flush = bool(flush)
+        return self.settings()
+
+    def record(self, query, prompt, docs, response, **extra):
+        """Captures a query if capturing is on and it is sampled. Returns the capture id or None."""
+        if not self.enabled or random.random() >= self.sample_rate:
+            return None
+        capture = {
+            "id": next(self._ids),
+            "time": time.time(),
+            "query": query,
+            "doc_ids": [compute_chunk_hash(doc) for doc in docs],
+            "prompt": prompt,
+            "response": response,
+            **extra,
+        }
+        with self._lock:
+            self._captures.append(capture)
+        if self.flush:
+            self._enqueue(capture)
+        return capture["id"]
+
+    def recent(self, limit=None):
+        """Most recent captures first, without prompts and responses."""
+        with self._lock:
+            captures = list(self._captures)[::-1][:limit]
+        return [
+            {key: value for key, value in capture.items() if key not in ("prompt", "response")}
+            for capture in captures
+        ]
+
+    def get(self, capture_id):
+        with self._lock:
+            for capture in self._captures:
+                if capture["id"] == capture_id:
+                    return dict(capture)
+        return None
+
+    def _enqueue(self, capture):
+        if self._writer is None:
+            with self._lock:
+                if self._writer is None:
+                    self._writer = threading.Thread(target=self._write_loop, daemon=True, name="debug-capture-writer")
+                    self._writer.start()
+        try:
+            self._queue.put_nowait(capture)
+        except queue.Full:
+            self.dropped += 1
+
+    def _write_loop(self):
+        while True:
+            captures = [self._queue.get()]
+            # Write whatever else is already waiting in the same pass
+            while True:
+                try:
+                    captures.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._write(captures)
+            except Exception as e:
+                logger.error(f"Error writing debug captures: {e}")
+
+    def _write(self, captures):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        if os.path.exists(self.path) and os.path.getsize(self.path) > DEBUG_CAPTURE_MAX_BYTES:
+            os.replace(self.path, f"{self.path}.1")
+        with open(self.path, "a", encoding="utf-8") as f:
+            for capture in captures:
+                f.write(json.dumps(capture, ensure_ascii=False) + "\n")
@@ -0,0 +1,163 @@
+import glob
+import json
+import logging
+import os
+import re
+import struct
+import threading
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# File layout:
+#   embeddings.f32  rows of `dim` float32 values, appended in insertion order
+#   embeddings.idx  16 byte header (magic + dim), then one 32 byte sha256 digest per row
+# Vectors are always written before their index entry, so a crash can only
+# leave extra vector bytes behind, which are trimmed on the next open.
+VECTORS_FILE = "embeddings.f32"
+INDEX_FILE = "embeddings.idx"
+INDEX_MAGIC = b"CLRFEMB1"
+HEADER = struct.Struct("<8sI4x")
+DIGEST_SIZE = 32
+
+LEGACY_CACHE_FILE = re.compile(r"^[0-9a-f]{64}\.json$")
+
+
+class EmbeddingStore:
+    """
+    Append-only embedding cache backed by a single float32 matrix file.
+    The matrix is memory-mapped, so opening the store costs one read of the
+    compact hash index and vectors are paged in only when they are used.
+    """
+
+    def __init__(self, directory, readonly=False):
+        self.directory = directory
+        self.readonly = readonly
+        self.vectors_path = os.path.join(directory, VECTORS_FILE)
+        self.index_path = os.path.join(directory, INDEX_FILE)
+        self.dim = None
+        self.rows = {}
+        self._matrix = None
+        self._lock = threading.Lock()
+        if not readonly:
+            os.makedirs(directory, exist_ok=True)
+        self._open()
+
+    def _open(self):
+        if not os.path.exists(self.index_path):
+            return
+
+        with open(self.index_path, "rb") as f:
+            data = f.read()
+        magic, dim = HEADER.unpack_from(data)
+        if magic != INDEX_MAGIC:
+            raise ValueError(f"{self.index_path} is not an embedding index")
+        self.dim = dim
+
+        row_size = dim * 4
+        index_rows = (len(data) - HEADER.size) // DIGEST_SIZE
+        vectors_size = os.path.getsize(self.vectors_path) if os.path.exists(self.vectors_path) else 0
+        vector_rows = vectors_size // row_size
+        count = min(index_rows, vector_rows)
+
+        if not self.readonly and (index_rows != count or vectors_size != count * row_size):
+            logger.warning(f"Embedding store in {self.directory} was not closed cleanly, keeping {count} rows")
+            with open(self.index_path, "r+b") as f:
+                f.truncate(HEADER.size + count * DIGEST_SIZE)
+            with open(self.vectors_path, "ab") as f:
+                f.truncate(count * row_size)
+
+        self.rows = {
+            data[offset:offset + DIGEST_SIZE].hex(): row
+            for row, offset in enumerate(range(HEADER.size, HEADER.size + count * DIGEST_SIZE, DIGEST_SIZE))
+        }
+        self._map(count)
+
+    def _map(self, count):
+        if count:
+            self._matrix = np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(count, self.dim))
+        else:
+            self._matrix = np.empty((0, self.dim or 0), dtype=np.float32)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, chunk_hash):
+        return chunk_hash in self.rows
+
+    @property
+    def matrix(self):
+        """Read-only (rows, dim) view over every stored embedding."""
+        return self._matrix
+
+    def get(self, chunk_hash):
+        """Returns the embedding stored for a hash, or None."""
+        row = self.rows.get(chunk_hash)
+        return None if row is None else self._matrix[row]
+
+    def get_many(self, chunk_hashes):
+        """Returns a (len(chunk_hashes), dim) array; every hash must be stored."""
+        # Rows are looked up before the matrix is read (see add)
+        rows = [self.rows[h] for h in chunk_hashes]
+        return np.asarray(self._matrix[rows])
+
+    def add(self, items):
+        """Appends (hash, embedding) pairs. Hashes already stored are skipped."""
+        if self.readonly:
+            raise RuntimeError("Embedding store was opened read-only")
+
+        with self._lock:
+            new_items = {}
+            for chunk_hash, embedding in items:
+                if chunk_hash not in self.rows and chunk_hash not in new_items:
+                    new_items[chunk_hash] = embedding
+            if not new_items:
+                return 0
+
+            vectors = np.asarray(list(new_items.values()), dtype=np.float32)
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                with open(self.index_path, "wb") as f:
+                    f.write(HEADER.pack(INDEX_MAGIC, self.dim))
+            if vectors.shape[1] != self.dim:
+                raise ValueError(f"Expected {self.dim}-dim embeddings, got {vectors.shape[1]}")
+
+            with open(self.vectors_path, "ab") as f:
+                f.write(vectors.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            with open(self.index_path, "ab") as f:
+                f.write(b"".join(bytes.fromhex(h) for h in new_items))
+
+            # Readers don't take the lock: the matrix is remapped before the new
+            # rows are published, so every row they can see is in the matrix
+            start = len(self.rows)
+            self._map(start + len(new_items))
+            for offset, chunk_hash in enumerate(new_items):
+                self.rows[chunk_hash] = start + offset
+            return len(new_items)
+
+    def migrate_json_cache(self, json_dir, batch_size=1000):
+        """
+        Imports the legacy per-chunk `<sha256>.json` cache files. The JSON files
+        are left in place; hashes already in the store are skipped.
+        """
+        paths = [p for p in glob.glob(os.path.join(json_dir, "*.json")) if LEGACY_CACHE_FILE.match(os.path.basename(p))]
+        pending = [p for p in paths if os.path.basename(p)[:-5] not in self.rows]
+        if not pending:
+            return 0
+
+        logger.info(f"Migrating {len(pending)} JSON embeddings from {json_dir}...")
+        migrated = 0
+        for i in range(0, len(pending), batch_size):
+            items = []
+            for path in pending[i:i + batch_size]:
+                try:
+                    with open(path, "r") as f:
+                        items.append((os.path.basename(path)[:-5], json.load(f)["embedding"]))
+                except (OSError, ValueError, KeyError) as e:
+                    logger.warning(f"Skipping unreadable cache file {path}: {e}")
+            migrated += self.add(items)
+        logger.info(f"Migrated {migrated} embeddings into {self.vectors_path}")
+        return migrated
@@ -1,14 +1,23 @@
-import PyPDF2
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-import google.generativeai as genai
-import chromadb
-from chromadb.config import Settings
 import logging
+import multiprocessing
 import os
+import re
 import hashlib
 import json
-from config import gemini_api_key
-from tenacity import retry, stop_after_attempt, wait_exponential
+import threading
+import time
+import contextvars
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import numpy as np
+from embedding_store import EmbeddingStore
+from text_splitter import RecursiveCharacterTextSplitter
+from utils import compute_file_hash, estimate_tokens
+from metrics import timed, count_cache, count_retry
+import gemini_client
+
+# PyMuPDF and ChromaDB are imported by the functions using them, so importing
+# the app stays fast (see benchmarks/bench_startup.py)
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger(__name__)
@@ -23,191 +32,585 @@ def compute_chunk_hash(chunk):
     """Computes a unique hash for the chunk."""
     return hashlib.sha256(chunk.encode("utf-8")).hexdigest()
 
+# Pages are extracted by a pool of EXTRACTION_WORKERS processes, each
+# handling PAGES_PER_TASK consecutive pages at a time
+EXTRACTION_WORKERS = int(os.environ.get("EXTRACTION_WORKERS", os.cpu_count() or 1))
+PAGES_PER_TASK = 25
+
+def extract_pages(pdf_path, page_numbers):
+    """Extracts the text of the given pages (0-based) with PyMuPDF."""
+    import fitz
+    with fitz.open(pdf_path) as doc:
+        return [(page_num, doc[page_num].get_text()) for page_num in page_numbers]
+
+def iter_pdf_pages(pdf_path, pages=None):
+    """
+    Yields (page_number, text) for the pages of a PDF (0-based, all pages by
+    default) in page order. Large documents are split into page ranges that
+    are extracted in parallel by a process pool.
+    """
+    if pages is None:
+        import fitz
+        with fitz.open(pdf_path) as doc:
+            pages = range(len(doc))
+    pages = list(pages)
+    tasks = [pages[i:i + PAGES_PER_TASK] for i in range(0, len(pages), PAGES_PER_TASK)]
+    
+    if len(tasks) <= 1 or EXTRACTION_WORKERS <= 1:
+        for task in tasks:
+            yield from extract_pages(pdf_path, task)
+        return
+    
+    # Spawned, not forked: this runs in threads of the server (warm-up, background ingestion)
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=min(EXTRACTION_WORKERS, len(tasks)), mp_context=context) as executor:
+        for page_texts in executor.map(extract_pages, [pdf_path] * len(tasks), tasks):
+            yield from page_texts
+
 def extract_text_from_pdf(pdf_path):
     logger.info(f"Extracting text from PDF: {pdf_path}")
-    with open(pdf_path, "rb") as file:
-        reader = PyPDF2.PdfReader(file)
-        text = ""
-        for page in reader.pages:
-            text += page.extract_text()
+    text = "".join(page_text for _, page_text in iter_pdf_pages(pdf_path))
     logger.info("Text extraction complete.")
     return text
 
+text_splitter = RecursiveCharacterTextSplitter(
+    chunk_size=500,  
+    chunk_overlap=50,  
+    separators=["\n\n", "\n", " ", ""]
+)
+
 def chunk_text(text):
     logger.info("Splitting text into chunks...")
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=500,  
-        chunk_overlap=50,  
-        separators=["\n\n", "\n", " ", ""]
-    )
     chunks = text_splitter.split_text(text)
     logger.info(f"Text split into {len(chunks)} chunks.")
     return chunks
 
-genai.configure(api_key=gemini_api_key) 
+def chunk_pages(pages):
+    """
+    Splits (page_number, text) pairs into chunks one page at a time, so the
+    whole book is never held as a single string. Yields (chunk, metadata)
+    where metadata holds the 1-based page number and the chunk's position
+    within the page. Chunks never span two pages.
+    """
+    for page_num, page_text in pages:
+        for index, chunk in enumerate(text_splitter.split_text(page_text)):
+            yield chunk, {"page": page_num + 1, "chunk_index": index}
+
+EMBEDDING_MODEL = "models/text-embedding-004"
+EMBEDDING_DIM = 768
+
+# Cache misses are sent in multi-content requests of EMBED_BATCH_SIZE texts,
+# with at most EMBED_MAX_WORKERS requests in flight at the same time.
+EMBED_BATCH_SIZE = int(os.environ.get("EMBED_BATCH_SIZE", 100))
+EMBED_MAX_WORKERS = int(os.environ.get("EMBED_MAX_WORKERS", 4))
+
+class GeminiEmbedder:
+    """Embeds texts with the Gemini embedding API."""
+
+    def __init__(self, model=EMBEDDING_MODEL):
+        self.model = model
+
+    def embed_batch(self, texts):
+        """Embeds a list of texts with a single batch request."""
+        return gemini_client.embed(list(texts), model=self.model)
+
+    def embed_one(self, text):
+        return gemini_client.embed(text, model=self.model)
+
+class FakeEmbedder:
+    """
+    Deterministic local embedder, used to benchmark ingestion offline.
+    Every word is hashed into one of `dim` buckets, so texts that share words
+    get similar vectors. `latency` and `per_item_latency` (seconds) simulate
+    the round trip of a real request.
+    """
+
+    def __init__(self, dim=EMBEDDING_DIM, latency=0.0, per_item_latency=0.0):
+        self.dim = dim
+        self.latency = latency
+        self.per_item_latency = per_item_latency
+
+    def _embed(self, text):
+        vector = [0.0] * self.dim
+        for word in text.lower().split():
+            digest = hashlib.md5(word.encode("utf-8")).digest()
+            bucket = int.from_bytes(digest[:4], "little") % self.dim
+            vector[bucket] += 1.0 if digest[4] & 1 else -1.0
+        norm = sum(v * v for v in vector) ** 0.5 or 1.0
+        return [v / norm for v in vector]
+
+    def embed_batch(self, texts):
+        time.sleep(self.latency + self.per_item_latency * len(texts))
+        return [self._embed(text) for text in texts]
+
+    def embed_one(self, text):
+        return self.embed_batch([text])[0]
+
+_embedder = None
+
+def get_embedder():
+    """Returns the active embedder (Gemini unless EMBEDDER=fake is set)."""
+    global _embedder
+    if _embedder is None:
+        if os.environ.get("EMBEDDER", "gemini").lower() == "fake":
+            _embedder = FakeEmbedder()
+        else:
+            _embedder = GeminiEmbedder()
+    return _embedder
+
+def set_embedder(embedder):
+    """Replaces the active embedder, e.g. with a FakeEmbedder for benchmarks."""
+    global _embedder
+    _embedder = embedder
 
-@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
 def call_embed_api(chunk):
-    """Function with automatic retry to call the embedding API"""
-    result = genai.embed_content(
-        model="models/text-embedding-004",
-        content=chunk
-    )
-    return result
-
-def generate_embeddings(texts):
-    """Generates embeddings for all chunks using local cache."""
+    """Embeds a single chunk (gemini_client retries transient errors)"""
+    return get_embedder().embed_one(chunk)
+
+def embed_batch(batch):
+    """
+    Embeds a batch of texts with one request. gemini_client retries it with
+    backoff if the API is overloaded or unavailable, and raises if it still
+    fails: sending every text on its own would only multiply the requests.
+    If the request is rejected for any other reason, every text is sent on
+    its own so one bad item doesn't sink the batch.
+    """
+    try:
+        embeddings = get_embedder().embed_batch(batch)
+        if len(embeddings) == len(batch):
+            return embeddings
+        logger.warning(f"Batch request returned {len(embeddings)} embeddings for {len(batch)} texts")
+    except Exception as e:
+        if isinstance(e, gemini_client.error_types()[1]):
+            raise
+        logger.warning(f"Batch embedding of {len(batch)} texts failed ({e}), retrying item by item")
+    count_retry("embed_batch")
+    return [call_embed_api(text) for text in batch]
+
+_embedding_store = None
+_embedding_store_lock = threading.Lock()
+
+def get_embedding_store():
+    """Opens the shared embedding store, migrating the legacy JSON cache on first use."""
+    global _embedding_store
+    with _embedding_store_lock:
+        if _embedding_store is None:
+            store = EmbeddingStore(CACHE_DIR)
+            if len(store) == 0:
+                store.migrate_json_cache(CACHE_DIR)
+            _embedding_store = store
+        return _embedding_store
+
+def open_embedding_store_readonly():
+    """
+    Makes this process use the embedding store read-only (memory-mapped, no
+    writes), as web workers do while a separate ingestion process owns it.
+    """
+    global _embedding_store
+    with _embedding_store_lock:
+        _embedding_store = EmbeddingStore(CACHE_DIR, readonly=True)
+        return _embedding_store
+
+@timed("embed")
+def generate_embeddings(texts, store=None, progress=None, persist=True):
+    """
+    Generates embeddings for all chunks using the local embedding store.
+    Cache misses are embedded in batches by a pool of workers; the result is
+    a float32 matrix whose rows follow the order of `texts`. New embeddings
+    are added to the store, unless it was opened read-only or `persist` is
+    False.
+    `progress`, if given, is called with (texts_embedded, total_texts).
+    """
     logger.info("Generating embeddings for text chunks...")
+    if store is None:
+        store = get_embedding_store()
     
-    embeddings = []
-    new_embeddings_count = 0
-    
-    for i, chunk in enumerate(texts):
-        chunk_hash = compute_chunk_hash(chunk)
-        cache_file = os.path.join(CACHE_DIR, f"{chunk_hash}.json")
-        
-        # Check if the embedding is already in cache
-        if os.path.exists(cache_file):
-            logger.info(f"Embedding for chunk {i+1}/{len(texts)} found in cache")
-            with open(cache_file, 'r') as f:
-                cache_data = json.load(f)
-                embeddings.append(cache_data["embedding"])
-        else:
-            logger.info(f"Generating embedding for chunk {i+1}/{len(texts)}...")
-            # Use function with retry
-            result = call_embed_api(chunk) 
-            embedding = result['embedding']
-            embeddings.append(embedding)
-            new_embeddings_count += 1
-            
-            # Save to cache
-            cache_data = {
-                "chunk": chunk,
-                "embedding": embedding,
-                "hash": chunk_hash
+    hashes = [compute_chunk_hash(chunk) for chunk in texts]
+    
+    # Group cache misses by hash, so identical chunks are embedded only once
+    missing = {}
+    for i, chunk_hash in enumerate(hashes):
+        if chunk_hash not in store and chunk_hash not in missing:
+            missing[chunk_hash] = texts[i]
+    
+    pending = list(missing.items())
+    batches = [pending[i:i + EMBED_BATCH_SIZE] for i in range(0, len(pending), EMBED_BATCH_SIZE)]
+    occurrences = Counter(hashes)
+    embedded = len(texts) - sum(occurrences[chunk_hash] for chunk_hash in missing)
+    if progress:
+        progress(embedded, len(texts))
+    
+    computed = {}
+    if batches:
+        logger.info(f"Embedding {len(pending)} chunks in {len(batches)} batches ({EMBED_MAX_WORKERS} workers)...")
+        with ThreadPoolExecutor(max_workers=EMBED_MAX_WORKERS) as executor:
+            futures = {
+                # Each batch runs in a copy of this context, so it keeps the caller's API priority
+                executor.submit(contextvars.copy_context().run, embed_batch, [chunk for _, chunk in batch]): batch
+                for batch in batches
             }
-            with open(cache_file, 'w') as f:
-                json.dump(cache_data, f)
+            for done, future in enumerate(as_completed(futures), start=1):
+                batch = futures[future]
+                batch_embeddings = zip((chunk_hash for chunk_hash, _ in batch), future.result())
+                if store.readonly or not persist:
+                    computed.update(batch_embeddings)
+                else:
+                    # Save to cache
+                    store.add(batch_embeddings)
+                logger.info(f"Embedded batch {done}/{len(batches)}")
+                if progress:
+                    embedded += sum(occurrences[chunk_hash] for chunk_hash, _ in batch)
+                    progress(embedded, len(texts))
     
+    new_embeddings_count = sum(1 for chunk_hash in hashes if chunk_hash in missing)
+    count_cache("embedding", True, len(texts) - new_embeddings_count)
+    count_cache("embedding", False, new_embeddings_count)
     logger.info(f"Embeddings generated: {new_embeddings_count} new, {len(texts) - new_embeddings_count} from cache.")
-    return embeddings
+    if not texts:
+        return np.empty((0, store.dim or EMBEDDING_DIM), dtype=np.float32)
+    if computed:
+        return np.asarray([computed[h] if h in computed else store.get(h) for h in hashes], dtype=np.float32)
+    return store.get_many(hashes)
+
+def embed_queries(texts):
+    """
+    Embeds texts that are not book chunks (queries, rewritten queries,
+    hypothetical documents). Stored embeddings are reused, but new ones are
+    not added to the store: they are rarely needed again, and writing them
+    would grow the store and fsync on the request path.
+    """
+    return generate_embeddings(texts, persist=False)
+
+class QueryEmbedding:
+    """
+    The embedding of one request's query, computed on the first call and
+    returned by the next ones, so the answer cache lookup, the direct search
+    and the cache store share a single embedding request.
+    """
+
+    def __init__(self, query):
+        self.query = query
+        self._embedding = None
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        with self._lock:
+            if self._embedding is None:
+                self._embedding = embed_queries([self.query])[0]
+            return self._embedding
 
-def store_embeddings_in_chromadb(chunks, chunk_embeddings):
-    """Saves embeddings in ChromaDB with persistence and duplicate handling."""
+COLLECTION_NAME = "school_book_chunks"
+SYNC_STATE_FILE = os.path.join(PERSIST_DIR, "sync_state.json")
+
+# Written by the ingestion process once a book's collection is fully synced
+# (one file per book); web workers only open what they describe
+PUBLISHED_DIR = os.path.join(PERSIST_DIR, "published")
+
+# Number of IDs checked, and chunks written, per ChromaDB call
+SYNC_BATCH_SIZE = int(os.environ.get("SYNC_BATCH_SIZE", 1000))
+
+# With a limit, ChromaDB keeps only the segments of the most recently used
+# collections in memory (0 keeps every opened collection)
+CHROMA_MEMORY_LIMIT_MB = int(os.environ.get("CHROMA_MEMORY_LIMIT_MB", 0))
+
+_chroma_client = None
+# Several books may be loading at the same time
+_chroma_client_lock = threading.Lock()
+
+def get_chroma_client():
+    """Returns the shared ChromaDB client, persisted in PERSIST_DIR."""
+    global _chroma_client
+    with _chroma_client_lock:
+        if _chroma_client is None:
+            import chromadb
+            from chromadb.config import Settings
+            settings = Settings()
+            if CHROMA_MEMORY_LIMIT_MB > 0:
+                settings = Settings(chroma_segment_cache_policy="LRU",
+                                    chroma_memory_limit_bytes=CHROMA_MEMORY_LIMIT_MB * 1024 * 1024)
+            _chroma_client = chromadb.PersistentClient(path=PERSIST_DIR, settings=settings)
+        return _chroma_client
+
+def get_collection(name=COLLECTION_NAME):
+    return get_chroma_client().get_or_create_collection(name=name)
+
+def book_collection_name(book_id):
+    """
+    Name of the ChromaDB collection of a book: the book id restricted to the
+    characters ChromaDB accepts, plus a hash of the id so names never collide.
+    """
+    safe_id = re.sub(r"[^A-Za-z0-9_-]", "_", book_id)[:40]
+    return f"book_{safe_id}_{hashlib.sha256(book_id.encode('utf-8')).hexdigest()[:8]}"
+
+def compute_collection_fingerprint(ids, metadatas):
+    """Hashes the IDs and metadata of the chunks a collection should contain."""
+    digest = hashlib.sha256()
+    for chunk_id, metadata in sorted(zip(ids, metadatas), key=lambda item: item[0]):
+        digest.update(chunk_id.encode("utf-8"))
+        digest.update(json.dumps(metadata, sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()
+
+def load_sync_state():
+    if not os.path.exists(SYNC_STATE_FILE):
+        return {}
+    with open(SYNC_STATE_FILE, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+# Serializes the read-modify-write of the files shared by all books
+_shared_state_lock = threading.Lock()
+
+def save_sync_state(collection_name, fingerprint, count):
+    with _shared_state_lock:
+        state = load_sync_state()
+        state[collection_name] = {"fingerprint": fingerprint, "count": count}
+        write_json_atomic(SYNC_STATE_FILE, state)
+
+def published_index_path(book_id):
+    return os.path.join(PUBLISHED_DIR, f"{book_collection_name(book_id)}.json")
+
+def publish_index(book_id, pdf_path, file_hash, version, collection_name):
+    """Records the PDF version of a book whose chunks are now searchable in a collection."""
+    os.makedirs(PUBLISHED_DIR, exist_ok=True)
+    write_json_atomic(published_index_path(book_id), {
+        "book_id": book_id,
+        "pdf_path": os.path.abspath(pdf_path),
+        "file_hash": file_hash,
+        "version": version,
+        "collection": collection_name,
+        "published_at": time.time(),
+    })
+
+def load_published_index(book_id):
+    """Returns the last published index description of a book, or None if it was not published yet."""
+    path = published_index_path(book_id)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def find_existing_ids(collection, ids, batch_size=SYNC_BATCH_SIZE):
+    """Returns which of `ids` are in the collection, fetching IDs only, in batches."""
+    existing_ids = set()
+    for i in range(0, len(ids), batch_size):
+        result = collection.get(ids=ids[i:i + batch_size], include=[])
+        existing_ids.update(result["ids"])
+    return existing_ids
+
+def unique_chunk_rows(chunks, metadatas=None):
+    """
+    Removes duplicate chunks. Returns the chunk IDs (hashes), the row of each
+    ID in `chunks`, and the metadata stored with each ID.
+    """
+    if metadatas is None:
+        metadatas = [{}] * len(chunks)
+    unique_rows = {}
+    for row, chunk in enumerate(chunks):
+        unique_rows.setdefault(compute_chunk_hash(chunk), row)
+    rows = list(unique_rows.values())
+    full_metadatas = [
+        {"source": "pdf", "tokens": estimate_tokens(chunks[row]), **metadatas[row]}
+        for row in rows
+    ]
+    return list(unique_rows), rows, full_metadatas
+
+def store_embeddings_in_chromadb(chunks, chunk_embeddings, metadatas=None, changes=None, progress=None,
+                                 collection_name=COLLECTION_NAME):
+    """
+    Saves embeddings in ChromaDB with persistence and duplicate handling.
+    `metadatas` (one dict per chunk, e.g. page numbers) is stored with each chunk.
+    `changes` (as returned by process_pdf_with_images) lists the chunk IDs to
+    delete and those whose page metadata must be updated.
+    `progress`, if given, is called with (chunks_written, chunks_to_write).
+    
+    A fingerprint of the IDs and metadata is saved after every sync; when it
+    matches on the next start the collection is left untouched.
+    """
     logger.info("Storing embeddings in ChromaDB with persistence...")
+    collection = get_collection(collection_name)
     
-    # Use a persistent client
-    client = chromadb.Client(Settings(persist_directory=PERSIST_DIR))
-    collection = client.get_or_create_collection(name="school_book_chunks")
+    ids, rows, full_metadatas = unique_chunk_rows(chunks, metadatas)
     
-    # Calculate hash for each chunk
-    ids = [compute_chunk_hash(chunk) for chunk in chunks]
+    fingerprint = compute_collection_fingerprint(ids, full_metadatas)
+    state = load_sync_state().get(collection_name, {})
+    if state.get("fingerprint") == fingerprint and state.get("count") == collection.count():
+        logger.info(f"ChromaDB collection {collection_name} is up to date ({len(ids)} chunks), skipping sync.")
+        return collection
     
-    # Remove duplicates from the chunk list before trying to add them
-    unique_data = {}
-    for chunk, embedding, chunk_id in zip(chunks, chunk_embeddings, ids):
-        if chunk_id not in unique_data:
-            unique_data[chunk_id] = (chunk, embedding)
+    # Apply the changes since the previous version of the PDF
+    changes = changes or {}
+    removed_ids = changes.get("removed_ids", [])
+    for i in range(0, len(removed_ids), SYNC_BATCH_SIZE):
+        collection.delete(ids=removed_ids[i:i + SYNC_BATCH_SIZE])
+    if removed_ids:
+        logger.info(f"Deleted {len(removed_ids)} obsolete chunks from ChromaDB.")
     
-    # Retrieve existing IDs
-    existing_ids = set()
-    try:
-        result = collection.get()
-        if result and "ids" in result:
-            existing_ids = set(result["ids"])
-            logger.info(f"Found {len(existing_ids)} existing IDs in ChromaDB")
-    except Exception as e:
-        logger.warning(f"Error retrieving existing IDs: {e}")
-    
-    # Filter only new chunks
-    new_chunks = []
-    new_embeddings = []
-    new_ids = []
-    new_metadatas = []
-    
-    for chunk_id, (chunk, embedding) in unique_data.items():
-        if chunk_id not in existing_ids:
-            new_chunks.append(chunk)
-            new_embeddings.append(embedding)
-            new_ids.append(chunk_id)
-            new_metadatas.append({"source": "pdf"})
-    
-    # Add only new chunks
-    if new_chunks:
-        logger.info(f"Adding {len(new_chunks)} new chunks to ChromaDB.")
-        collection.add(
-            documents=new_chunks,
-            embeddings=new_embeddings,
-            metadatas=new_metadatas,
-            ids=new_ids
-        )
+    # New chunks and chunks whose metadata changed are upserted; the rest is skipped
+    existing_ids = find_existing_ids(collection, ids)
+    logger.info(f"Found {len(existing_ids)} of {len(ids)} chunks already in ChromaDB")
+    moved_ids = set(changes.get("moved_ids", []))
+    pending = [i for i, chunk_id in enumerate(ids) if chunk_id not in existing_ids or chunk_id in moved_ids]
+    
+    if pending:
+        logger.info(f"Writing {len(pending)} chunks to ChromaDB.")
+        batch_size = min(SYNC_BATCH_SIZE, get_chroma_client().get_max_batch_size())
+        for start in range(0, len(pending), batch_size):
+            batch = pending[start:start + batch_size]
+            collection.upsert(
+                ids=[ids[i] for i in batch],
+                documents=[chunks[rows[i]] for i in batch],
+                embeddings=[chunk_embeddings[rows[i]].tolist() for i in batch],
+                metadatas=[full_metadatas[i] for i in batch]
+            )
+            written = min(start + batch_size, len(pending))
+            logger.info(f"Written {written}/{len(pending)} chunks to ChromaDB.")
+            if progress:
+                progress(written, len(pending))
         logger.info("ChromaDB updated.")
     else:
         logger.info("No new chunks to add to ChromaDB.")
     
+    save_sync_state(collection_name, fingerprint, collection.count())
     return collection
 
-def process_pdf_with_images(pdf_path):
-    """Process a PDF by extracting text or loading it from cache."""
-    # Try to load chunks from cache
-    cached_chunks = get_pdf_cached_chunks(pdf_path)
-    if (cached_chunks):
-        logger.info(f"Using {len(cached_chunks)} chunks from cache")
-        return cached_chunks
+def process_pdf_with_images(pdf_path, progress=None):
+    """
+    Process a PDF by extracting text or loading it from its manifest.
     
-    # If there are no chunks in cache, extract the text
-    logger.info(f"No cache chunks found for {os.path.basename(pdf_path)}, proceeding with extraction")
-    text = extract_text_from_pdf(pdf_path)
-    text_chunks = chunk_text(text)
+    Manifests are keyed by the PDF's content hash and record a hash and the
+    chunks of every page. When the file at `pdf_path` changed since it was
+    last processed, only pages whose hash is not in the previous manifest
+    are re-extracted and re-chunked.
     
-    # Save chunks for future use
-    save_pdf_chunks(pdf_path, text_chunks)
+    Returns (chunks, metadatas, changes), where metadatas hold the page of
+    every chunk and changes lists the chunk IDs that disappeared
+    ("removed_ids") or moved to another page ("moved_ids") since the
+    previous version of the file, the hash of this one ("file_hash") and
+    its number of pages ("page_count").
+    
+    The manifest index still points at the previous version afterwards: the
+    caller advances it with update_manifest_index once the chunks are stored,
+    so a failed sync is retried against the same previous version.
+    """
+    pdf_filename = os.path.basename(pdf_path)
+    file_hash = compute_file_hash(pdf_path)
+    previous_hash = load_manifest_index().get(os.path.abspath(pdf_path))
+    previous = load_manifest(previous_hash) if previous_hash and previous_hash != file_hash else None
+    
+    manifest = load_manifest(file_hash)
+    if manifest:
+        logger.info(f"Found manifest for {pdf_filename}, loading {sum(len(p['chunks']) for p in manifest['pages'])} chunks from cache")
+    else:
+        manifest = build_manifest(pdf_path, file_hash, previous, progress=progress)
+        save_manifest(manifest)
     
-    return text_chunks
+    if progress:
+        progress(len(manifest["pages"]), len(manifest["pages"]))
+    chunks, metadatas = manifest_chunks(manifest)
+    changes = manifest_changes(previous, chunks, metadatas)
+    changes["file_hash"] = file_hash
+    changes["page_count"] = len(manifest["pages"])
+    return chunks, metadatas, changes
 
-import os
-import hashlib
-import json
-import pathlib
+def compute_page_hashes(pdf_path):
+    """Hashes the raw content stream of every page, without extracting text."""
+    import fitz
+    with fitz.open(pdf_path) as doc:
+        return [hashlib.sha256(page.read_contents()).hexdigest() for page in doc]
 
-# Add this new function
-def get_pdf_cached_chunks(pdf_path):
-    """Retrieves saved chunks for a specific PDF or returns None if they don't exist."""
-    pdf_filename = os.path.basename(pdf_path)
-    pdf_name = os.path.splitext(pdf_filename)[0]
-    pdf_hash = hashlib.md5(pdf_path.encode()).hexdigest()[:10]
+def build_manifest(pdf_path, file_hash, previous=None, progress=None):
+    """Extracts and chunks the pages of a PDF, reusing unchanged pages of `previous`."""
+    page_hashes = compute_page_hashes(pdf_path)
+    known_pages = {page["hash"]: page["chunks"] for page in previous["pages"]} if previous else {}
+    changed_pages = [i for i, page_hash in enumerate(page_hashes) if page_hash not in known_pages]
     
-    # Directory for chunks of this specific PDF
-    pdf_chunks_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pdf_chunks")
-    os.makedirs(pdf_chunks_dir, exist_ok=True)
+    if previous:
+        logger.info(f"{os.path.basename(pdf_path)} changed: re-extracting {len(changed_pages)} of {len(page_hashes)} pages")
+    else:
+        logger.info(f"No manifest found for {os.path.basename(pdf_path)}, proceeding with extraction")
     
-    chunks_file = os.path.join(pdf_chunks_dir, f"{pdf_name}_{pdf_hash}.json")
+    def extracted_pages():
+        for done, (page_num, page_text) in enumerate(iter_pdf_pages(pdf_path, pages=changed_pages), start=1):
+            if progress:
+                progress(len(page_hashes) - len(changed_pages) + done, len(page_hashes))
+            yield page_num, page_text
     
-    if os.path.exists(chunks_file):
-        logger.info(f"Found stored chunks for {pdf_filename}, loading from cache...")
-        with open(chunks_file, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    return None
+    new_chunks = {}
+    for chunk, metadata in chunk_pages(extracted_pages()):
+        new_chunks.setdefault(metadata["page"] - 1, []).append(chunk)
+    
+    pages = []
+    for page_num, page_hash in enumerate(page_hashes):
+        page_chunks = known_pages[page_hash] if page_hash in known_pages else new_chunks.get(page_num, [])
+        pages.append({"hash": page_hash, "chunks": page_chunks})
+    
+    logger.info(f"Extracted {sum(len(p) for p in new_chunks.values())} new chunks from {os.path.basename(pdf_path)}.")
+    return {"file_hash": file_hash, "pdf_name": os.path.basename(pdf_path), "pages": pages}
 
-# Add this new function
-def save_pdf_chunks(pdf_path, chunks):
-    """Saves chunks extracted from a specific PDF."""
-    pdf_filename = os.path.basename(pdf_path)
-    pdf_name = os.path.splitext(pdf_filename)[0]
-    pdf_hash = hashlib.md5(pdf_path.encode()).hexdigest()[:10]
+def manifest_chunks(manifest):
+    """Returns the chunks of a manifest and their page metadata."""
+    chunks = []
+    metadatas = []
+    for page_num, page in enumerate(manifest["pages"]):
+        for index, chunk in enumerate(page["chunks"]):
+            chunks.append(chunk)
+            metadatas.append({"page": page_num + 1, "chunk_index": index})
+    return chunks, metadatas
+
+def manifest_changes(previous, chunks, metadatas):
+    """Compares the chunks of the previous manifest of a file with the current ones."""
+    if not previous:
+        return {"removed_ids": [], "moved_ids": []}
     
-    # Directory for chunks of this specific PDF
-    pdf_chunks_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pdf_chunks")
-    os.makedirs(pdf_chunks_dir, exist_ok=True)
+    previous_pages = {}
+    for chunk, metadata in zip(*manifest_chunks(previous)):
+        previous_pages.setdefault(compute_chunk_hash(chunk), metadata)
     
-    chunks_file = os.path.join(pdf_chunks_dir, f"{pdf_name}_{pdf_hash}.json")
+    current_pages = {}
+    for chunk, metadata in zip(chunks, metadatas):
+        current_pages.setdefault(compute_chunk_hash(chunk), metadata)
     
-    logger.info(f"Saving {len(chunks)} chunks for {pdf_filename}...")
-    with open(chunks_file, 'w', encoding='utf-8') as f:
-        json.dump(chunks, f, ensure_ascii=False)
+    return {
+        "removed_ids": [chunk_id for chunk_id in previous_pages if chunk_id not in current_pages],
+        "moved_ids": [
+            chunk_id for chunk_id, metadata in current_pages.items()
+            if chunk_id in previous_pages and previous_pages[chunk_id] != metadata
+        ],
+    }
 
+MANIFEST_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pdf_chunks")
+MANIFEST_INDEX = os.path.join(MANIFEST_DIR, "index.json")
 
+def load_manifest(file_hash):
+    """Returns the manifest of a PDF content hash, or None if it doesn't exist."""
+    manifest_file = os.path.join(MANIFEST_DIR, f"{file_hash}.json")
+    if not os.path.exists(manifest_file):
+        return None
+    with open(manifest_file, 'r', encoding='utf-8') as f:
+        return json.load(f)
 
+def save_manifest(manifest):
+    os.makedirs(MANIFEST_DIR, exist_ok=True)
+    manifest_file = os.path.join(MANIFEST_DIR, f"{manifest['file_hash']}.json")
+    logger.info(f"Saving manifest for {manifest['pdf_name']}...")
+    write_json_atomic(manifest_file, manifest)
 
+def load_manifest_index():
+    """Returns the {absolute PDF path: content hash} map of processed files."""
+    if not os.path.exists(MANIFEST_INDEX):
+        return {}
+    with open(MANIFEST_INDEX, 'r', encoding='utf-8') as f:
+        return json.load(f)
 
+def update_manifest_index(pdf_path, file_hash):
+    os.makedirs(MANIFEST_DIR, exist_ok=True)
+    with _shared_state_lock:
+        index = load_manifest_index()
+        index[os.path.abspath(pdf_path)] = file_hash
+        write_json_atomic(MANIFEST_INDEX, index)
 
+def write_json_atomic(path, data):
+    """Writes JSON to a temporary file and renames it, so readers never see a partial file."""
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
@@ -1,41 +1,99 @@
-import fitz  # PyMuPDF
-import io
-from PIL import Image
+import logging
+import multiprocessing
 import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from utils import compute_file_hash
+from metrics import timed, count_cache
 
-def render_pdf_pages(pdf_path, output_dir="rendered_pages", pages=None):
+logger = logging.getLogger(__name__)
+
+# Rendered pages are kept in memory, keyed by (PDF content hash, page, format)
+RENDER_CACHE_SIZE = 32
+_render_cache = OrderedDict()
+_render_lock = threading.Lock()
+
+# Pages sent to the vision model are rendered as JPEG with their longer side
+# VISION_MAX_SIDE pixels long: enough to read figure labels, while larger
+# images only cost upload time (the model downscales them anyway)
+VISION_MAX_SIDE = int(os.environ.get("VISION_MAX_SIDE", 1536))
+VISION_JPEG_QUALITY = int(os.environ.get("VISION_JPEG_QUALITY", 85))
+
+# Processes rendering several pages in parallel; with 1 or less, pages are
+# rendered in the calling thread
+RENDER_WORKERS = int(os.environ.get("RENDER_WORKERS", min(4, os.cpu_count() or 1)))
+# The pool is started by the first multi-page query. RENDER_POOL_WARMUP=1
+# starts it with the server instead, which costs RENDER_WORKERS idle
+# processes in every server worker even if no image-mode query ever comes
+RENDER_POOL_WARMUP = os.environ.get("RENDER_POOL_WARMUP", "0") == "1"
+_render_pool = None
+_render_pool_lock = threading.Lock()
+
+def count_pages(pdf_path):
+    import fitz
+    with fitz.open(pdf_path) as doc:
+        return len(doc)
+
+def cached_render(key):
+    """Returns a rendered page from the memory cache, or None."""
+    with _render_lock:
+        if key in _render_cache:
+            _render_cache.move_to_end(key)
+            count_cache("page_render", True)
+            return _render_cache[key]
+    count_cache("page_render", False)
+    return None
+
+def store_render(key, image_bytes):
+    with _render_lock:
+        _render_cache[key] = image_bytes
+        while len(_render_cache) > RENDER_CACHE_SIZE:
+            _render_cache.popitem(last=False)
+
+def get_render_pool():
+    """Returns the shared pool of render processes, started on first use."""
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is None:
+            # Spawned, not forked: the server process runs threads
+            _render_pool = ProcessPoolExecutor(max_workers=RENDER_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        return _render_pool
+
+def warm_render_pool():
+    """Starts the render processes in the background, so the first multi-page query doesn't wait for them."""
+    if RENDER_WORKERS > 1:
+        pool = get_render_pool()
+        for _ in range(RENDER_WORKERS):
+            pool.submit(int)
+
+@timed("render_pages")
+def render_vision_images(pdf_path, page_nums, max_side=VISION_MAX_SIDE, quality=VISION_JPEG_QUALITY):
     """
-    Renders entire PDF pages as images.
-    
-    Args:
-        pdf_path: Path to the PDF file
-        output_dir: Directory where to save the rendered images
-        pages: List of page numbers to render (0-based), or None for all pages
+    Renders pages (0-based) for the vision model, see
+    page_renderer.render_vision_image.
+    Pages missing from the memory cache are rendered in parallel by the
+    render pool. Returns a list of JPEG bytes (None for missing pages) in
+    the order of `page_nums`.
     """
-    os.makedirs(output_dir, exist_ok=True)
-    
-    image_paths = []
-    doc = fitz.open(pdf_path)
-    
-    # If pages is None, render all pages
-    if pages is None:
-        pages = range(len(doc))
+    from page_renderer import render_vision_image
+    file_hash = compute_file_hash(pdf_path)
+    keys = [(file_hash, page_num, ("jpeg", max_side, quality)) for page_num in page_nums]
+    images = [cached_render(key) for key in keys]
+    missing = [i for i, image in enumerate(images) if image is None]
     
-    for page_num in pages:
-        if page_num < 0 or page_num >= len(doc):
-            continue
-            
-        page = doc[page_num]
-        
-        # Render page with increased resolution (zoom=2.0)
-        pix = page.get_pixmap(matrix=fitz.Matrix(2.0, 2.0))
-        
-        # Save the image
-        image_filename = f"page_{page_num+1}.png"
-        image_path = os.path.join(output_dir, image_filename)
-        pix.save(image_path)
-        
-        # Save the path and page number
-        image_paths.append((image_path, page_num))
+    rendered = None
+    if len(missing) > 1 and RENDER_WORKERS > 1:
+        try:
+            futures = [get_render_pool().submit(render_vision_image, pdf_path, page_nums[i], max_side, quality) for i in missing]
+            rendered = [future.result() for future in futures]
+        except Exception as e:
+            logger.warning(f"Parallel rendering failed ({e}), rendering in this process")
+    if rendered is None:
+        rendered = [render_vision_image(pdf_path, page_nums[i], max_side, quality) for i in missing]
     
-    return image_paths
\ No newline at end of file
+    for i, image_bytes in zip(missing, rendered):
+        images[i] = image_bytes
+        if image_bytes is not None:
+            store_render(keys[i], image_bytes)
+    return images
@@ -0,0 +1,110 @@
+"""
+Deterministic local stand-in for the Gemini API (the google.generativeai
+module), selected with GEMINI_BACKEND=fake or gemini_client.set_backend().
+It covers the calls the backend makes (embed_content,
+GenerativeModel.generate_content with text, streams or images, and
+count_tokens) and sleeps for a configurable latency to simulate the API.
+With `max_concurrency`, calls beyond that many in flight fail with a 429
+error, as the real API does when a quota is exceeded.
+"""
+import hashlib
+import threading
+import time
+from collections import Counter
+from types import SimpleNamespace
+
+from google.api_core.exceptions import ResourceExhausted
+
+# Simulated latencies in seconds: a fixed round trip per call, plus a cost
+# per embedded text or per generated word
+DEFAULT_LATENCY = {
+    "embed": 0.15,
+    "embed_per_item": 0.002,
+    "generate": 0.6,
+    "generate_per_word": 0.004,
+    "count_tokens": 0.1,
+    "vision": 2.0,
+}
+
+# Words in a generated answer, and in each streamed chunk
+ANSWER_WORDS = 150
+STREAM_CHUNK_WORDS = 12
+
+
+class FakeGenAI:
+    """Module-like object replacing `genai`; `calls` counts the calls made per kind."""
+
+    def __init__(self, latency=None, dim=768, max_concurrency=None):
+        from embeddings import FakeEmbedder
+
+        self.latency = dict(DEFAULT_LATENCY, **(latency or {}))
+        self.max_concurrency = max_concurrency
+        self.calls = Counter()
+        self.rejected = Counter()
+        self.in_flight = 0
+        self._calls_lock = threading.Lock()
+        self._embedder = FakeEmbedder(dim=dim)
+
+    def _record(self, kind, seconds):
+        with self._calls_lock:
+            if self.max_concurrency is not None and self.in_flight >= self.max_concurrency:
+                self.rejected[kind] += 1
+                raise ResourceExhausted("Resource has been exhausted (e.g. check quota).")
+            self.calls[kind] += 1
+            self.in_flight += 1
+        try:
+            if seconds > 0:
+                time.sleep(seconds)
+        finally:
+            with self._calls_lock:
+                self.in_flight -= 1
+
+    def configure(self, **kwargs):
+        pass
+
+    def embed_content(self, model, content, **kwargs):
+        texts = content if isinstance(content, list) else [content]
+        self._record("embed", self.latency["embed"] + self.latency["embed_per_item"] * len(texts))
+        vectors = [self._embedder._embed(text) for text in texts]
+        return {"embedding": vectors if isinstance(content, list) else vectors[0]}
+
+    def GenerativeModel(self, model_name="gemini-1.5-flash", **kwargs):
+        return FakeModel(self, model_name)
+
+
+class FakeModel:
+    def __init__(self, genai, model_name):
+        self.genai = genai
+        self.model_name = model_name
+
+    def _answer(self, prompt):
+        """A deterministic answer made of words of the prompt, chosen by its hash."""
+        words = prompt.split() or ["answer"]
+        seed = int.from_bytes(hashlib.md5(prompt.encode("utf-8")).digest()[:8], "little")
+        return " ".join(words[(seed + i * 7919) % len(words)] for i in range(ANSWER_WORDS))
+
+    def generate_content(self, contents, stream=False, **kwargs):
+        if isinstance(contents, list):
+            # [prompt, image]: a vision call
+            self.genai._record("vision", self.genai.latency["vision"])
+            return SimpleNamespace(text=self._answer(f"{contents[0]} image {getattr(contents[1], 'size', '')}"))
+
+        text = self._answer(contents)
+        latency = self.genai.latency
+        if not stream:
+            self.genai._record("generate", latency["generate"] + latency["generate_per_word"] * ANSWER_WORDS)
+            return SimpleNamespace(text=text)
+
+        self.genai._record("generate", latency["generate"])
+        return self._stream(text.split())
+
+    def _stream(self, words):
+        for start in range(0, len(words), STREAM_CHUNK_WORDS):
+            chunk = words[start:start + STREAM_CHUNK_WORDS]
+            time.sleep(self.genai.latency["generate_per_word"] * len(chunk))
+            yield SimpleNamespace(text=" ".join(chunk) + " ")
+
+    def count_tokens(self, contents):
+        self.genai._record("count_tokens", self.genai.latency["count_tokens"])
+        text = contents if isinstance(contents, str) else " ".join(map(str, contents))
+        return SimpleNamespace(total_tokens=max(1, round(len(text) / 4)))
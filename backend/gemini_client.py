@@ -0,0 +1,358 @@
+import contextvars
+import heapq
+import itertools
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from config import gemini_backend, require_api_key
+from metrics import count_api_call, count_retry, set_gemini_concurrency
+
+logger = logging.getLogger(__name__)
+
+# Single entry point for Gemini API calls. Every call goes through:
+#   - model handles created once per model name and reused
+#   - a token bucket shared by all call kinds (GEMINI_RATE_LIMIT per minute)
+#   - an adaptive concurrency limit: it grows slowly while calls succeed and
+#     is halved when the API answers 429 or latency degrades (AIMD)
+#   - a priority queue for the concurrency slots: interactive calls (queries)
+#     go before background ones (ingestion, page pre-description), which may
+#     only use GEMINI_BACKGROUND_SHARE of the slots
+#   - retries with exponential backoff for transient errors
+# The backend is google.generativeai, or the local fake_gemini stand-in with
+# GEMINI_BACKEND=fake; set_backend() swaps it at runtime.
+
+GENERATION_MODEL = "gemini-1.5-flash"
+
+# Requests per minute over all call kinds (0 for no limit), and the largest burst
+GEMINI_RATE_LIMIT = float(os.environ.get("GEMINI_RATE_LIMIT", 1000))
+GEMINI_BURST = int(os.environ.get("GEMINI_BURST", 50))
+
+# The limits in this module are enforced per process. The rate limit, burst
+# and concurrency bounds are budgets for the whole API key, divided among the
+# GEMINI_PROCESSES processes sharing it (gunicorn.conf.py sets it to the
+# number of workers unless it is set)
+GEMINI_PROCESSES = max(1, int(os.environ.get("GEMINI_PROCESSES", 1)))
+
+# Starting value and bounds of the adaptive concurrency limit, and the share
+# of it background calls may use
+GEMINI_INITIAL_CONCURRENCY = int(os.environ.get("GEMINI_INITIAL_CONCURRENCY", 8))
+GEMINI_MIN_CONCURRENCY = int(os.environ.get("GEMINI_MIN_CONCURRENCY", 2))
+GEMINI_MAX_CONCURRENCY = int(os.environ.get("GEMINI_MAX_CONCURRENCY", 32))
+GEMINI_BACKGROUND_SHARE = float(os.environ.get("GEMINI_BACKGROUND_SHARE", 0.75))
+
+# A call slower than this multiple of the usual latency of its kind counts as
+# a sign of overload (streamed calls are not measured). Kinds are per call
+# site (rewrite, hyde, answer, embed, embed_batch...), so short and long
+# calls are never compared with each other.
+LATENCY_TOLERANCE = 3.0
+# Calls faster than this (seconds) never count as slow, whatever the average:
+# tiny latencies (e.g. a local fake backend) vary by large factors
+LATENCY_FLOOR = 0.5
+# Weight of a new sample in the per-kind latency averages
+LATENCY_SMOOTHING = 0.1
+# After a decrease, further overload signals are ignored for this many
+# seconds, so a burst of 429s halves the limit only once
+DECREASE_COOLDOWN = 2.0
+
+# Attempts per call, and the backoff between them (seconds, doubled every
+# time, minus a random jitter of up to half so retries don't arrive together)
+GEMINI_MAX_ATTEMPTS = int(os.environ.get("GEMINI_MAX_ATTEMPTS", 3))
+RETRY_MIN_DELAY = 2.0
+RETRY_MAX_DELAY = 20.0
+
+INTERACTIVE = 0
+BACKGROUND = 1
+
+_priority = contextvars.ContextVar("gemini_priority", default=INTERACTIVE)
+
+_error_types = None
+
+
+def error_types():
+    """
+    Returns the (overload, transient) exception types; google.api_core is
+    imported on the first error rather than when the app starts.
+    """
+    global _error_types
+    if _error_types is None:
+        from google.api_core import exceptions as api_exceptions
+        overload = (api_exceptions.ResourceExhausted, api_exceptions.TooManyRequests)
+        _error_types = overload, overload + (
+            api_exceptions.ServiceUnavailable,
+            api_exceptions.InternalServerError,
+            api_exceptions.DeadlineExceeded,
+            api_exceptions.GatewayTimeout,
+            ConnectionError,
+            TimeoutError,
+        )
+    return _error_types
+
+
+@contextmanager
+def background():
+    """Runs the enclosed API calls (in this thread or context) at background priority."""
+    token = _priority.set(BACKGROUND)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class RateLimiter:
+    """Token bucket allowing `burst` calls at once, refilled at `per_minute` calls per minute."""
+
+    def __init__(self, per_minute, burst):
+        self.rate = per_minute / 60.0
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a call is allowed."""
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+
+class ConcurrencyLimiter:
+    """
+    Bounds the calls in flight. Waiting calls are admitted by priority, then
+    in arrival order. The limit follows additive increase / multiplicative
+    decrease: +1/limit per successful call, halved on overload.
+    """
+
+    def __init__(self, initial=GEMINI_INITIAL_CONCURRENCY, minimum=GEMINI_MIN_CONCURRENCY,
+                 maximum=GEMINI_MAX_CONCURRENCY, background_share=GEMINI_BACKGROUND_SHARE):
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.background_share = background_share
+        self.limit = float(min(self.maximum, max(minimum, initial)))
+        self.in_flight = 0
+        self.latencies = {}
+        self._waiters = []
+        self._order = itertools.count()
+        self._decreased_at = 0.0
+        self._lock = threading.Lock()
+        set_gemini_concurrency(self.limit)
+
+    def _capacity(self, priority):
+        slots = max(1, int(self.limit))
+        if priority == BACKGROUND:
+            slots = max(1, int(slots * self.background_share))
+        return slots
+
+    def ticket(self):
+        """Arrival number of a call; its retries keep it, so they don't go to the back of the queue."""
+        return next(self._order)
+
+    def acquire(self, priority=INTERACTIVE, ticket=None):
+        event = threading.Event()
+        with self._lock:
+            heapq.heappush(self._waiters, (priority, self.ticket() if ticket is None else ticket, event))
+            self._admit()
+        event.wait()
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+            self._admit()
+
+    def _admit(self):
+        while self._waiters and self.in_flight < self._capacity(self._waiters[0][0]):
+            _, _, event = heapq.heappop(self._waiters)
+            self.in_flight += 1
+            event.set()
+
+    def on_success(self, kind, seconds=None):
+        with self._lock:
+            if seconds is not None:
+                usual = self.latencies.get(kind)
+                # Slow samples update the average too, so it follows a lasting change of latency
+                self.latencies[kind] = seconds if usual is None else usual + LATENCY_SMOOTHING * (seconds - usual)
+                if usual is not None and seconds > max(LATENCY_FLOOR, LATENCY_TOLERANCE * usual):
+                    self._decrease(f"{kind} call took {seconds:.1f}s (usually {usual:.1f}s)")
+                    return
+            self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            set_gemini_concurrency(self.limit)
+            self._admit()
+
+    def on_overload(self, reason):
+        with self._lock:
+            self._decrease(reason)
+
+    def _decrease(self, reason):
+        now = time.monotonic()
+        if now - self._decreased_at < DECREASE_COOLDOWN:
+            return
+        self._decreased_at = now
+        self.limit = max(self.minimum, self.limit / 2)
+        set_gemini_concurrency(self.limit)
+        logger.warning(f"Gemini concurrency limit lowered to {int(self.limit)} ({reason})")
+
+    def status(self):
+        with self._lock:
+            return {"limit": int(self.limit), "in_flight": self.in_flight, "waiting": len(self._waiters)}
+
+
+_backend = None
+_models = {}
+_rate_limiter = None
+_concurrency = None
+_state_lock = threading.Lock()
+
+
+def get_backend():
+    """Returns the module-like API backend, imported and configured on first use."""
+    global _backend
+    with _state_lock:
+        if _backend is None:
+            if gemini_backend == "fake":
+                from fake_gemini import FakeGenAI
+                _backend = FakeGenAI()
+            else:
+                api_key = require_api_key()
+                import google.generativeai as genai
+                genai.configure(api_key=api_key)
+                _backend = genai
+        return _backend
+
+
+def set_backend(backend):
+    """Replaces the API backend (e.g. with a fake_gemini.FakeGenAI) and forgets its models."""
+    global _backend
+    with _state_lock:
+        _backend = backend
+        _models.clear()
+
+
+def get_model(model_name=GENERATION_MODEL):
+    """Returns the shared model handle of a model name."""
+    backend = get_backend()
+    with _state_lock:
+        if model_name not in _models:
+            _models[model_name] = backend.GenerativeModel(model_name)
+        return _models[model_name]
+
+
+def get_limiters():
+    """Returns the shared (rate limiter, concurrency limiter), created on first use."""
+    global _rate_limiter, _concurrency
+    with _state_lock:
+        if _rate_limiter is None:
+            # This process' share of the budgets of the API key
+            _rate_limiter = RateLimiter(GEMINI_RATE_LIMIT / GEMINI_PROCESSES, GEMINI_BURST // GEMINI_PROCESSES)
+            _concurrency = ConcurrencyLimiter(
+                initial=max(1, GEMINI_INITIAL_CONCURRENCY // GEMINI_PROCESSES),
+                minimum=max(1, GEMINI_MIN_CONCURRENCY // GEMINI_PROCESSES),
+                maximum=max(1, GEMINI_MAX_CONCURRENCY // GEMINI_PROCESSES),
+            )
+        return _rate_limiter, _concurrency
+
+
+@contextmanager
+def api_slot(kind, measure=True, ticket=None):
+    """Holds a concurrency slot and a rate limit token for one API call."""
+    rate_limiter, concurrency = get_limiters()
+    concurrency.acquire(_priority.get(), ticket)
+    try:
+        rate_limiter.acquire()
+        count_api_call(kind)
+        started = time.perf_counter()
+        yield
+        concurrency.on_success(kind, time.perf_counter() - started if measure else None)
+    finally:
+        concurrency.release()
+
+
+def with_retries(kind, func, *args, **kwargs):
+    """Calls func, retrying transient errors with exponential backoff."""
+    for attempt in range(1, GEMINI_MAX_ATTEMPTS + 1):
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            overload_errors, transient_errors = error_types()
+            if isinstance(e, overload_errors):
+                get_limiters()[1].on_overload(f"{kind} call rejected: {e}")
+            if attempt == GEMINI_MAX_ATTEMPTS or not isinstance(e, transient_errors):
+                raise
+            delay = min(RETRY_MAX_DELAY, RETRY_MIN_DELAY * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+            count_retry(kind)
+            logger.warning(f"Retrying {kind} call in {delay:.1f}s (attempt {attempt} failed: {e})")
+            time.sleep(delay)
+
+
+def call(kind, func, *args, **kwargs):
+    """Runs one API call (func) under the shared limits, with retries."""
+    ticket = get_limiters()[1].ticket()
+
+    def attempt():
+        with api_slot(kind, ticket=ticket):
+            return func(*args, **kwargs)
+    return with_retries(kind, attempt)
+
+
+def generate(contents, kind="generate", model_name=GENERATION_MODEL):
+    """Generates content (a prompt, or a list of prompt parts and images) and returns the text."""
+    model = get_model(model_name)
+    return call(kind, model.generate_content, contents).text
+
+
+def generate_stream(prompt, kind="generate", model_name=GENERATION_MODEL):
+    """
+    Yields the text of a streamed generation. The call holds a concurrency
+    slot until its first chunk arrives, not while the rest is read. Errors
+    before the first chunk are retried; later ones can't be (part of the
+    text was yielded already), so they are only reported to the limiter if
+    they are overload errors, then raised.
+    """
+    model = get_model(model_name)
+    ticket = get_limiters()[1].ticket()
+
+    def first_chunk():
+        with api_slot(kind, measure=False, ticket=ticket):
+            chunks = iter(model.generate_content(prompt, stream=True))
+            return chunks, next(chunks, None)
+    chunks, chunk = with_retries(kind, first_chunk)
+    while chunk is not None:
+        if chunk.text:
+            yield chunk.text
+        try:
+            chunk = next(chunks, None)
+        except Exception as e:
+            if isinstance(e, error_types()[0]):
+                get_limiters()[1].on_overload(f"{kind} stream interrupted: {e}")
+            logger.error(f"{kind} stream failed after its first chunk: {e}")
+            raise
+
+
+def embed(content, model):
+    """Embeds a text, or a list of texts with one request; returns the embedding(s)."""
+    backend = get_backend()
+    # Requests of many texts take longer: they have their own latency average
+    kind = "embed_batch" if isinstance(content, list) and len(content) > 1 else "embed"
+    return call(kind, backend.embed_content, model=model, content=content)["embedding"]
+
+
+def count_tokens(contents, model_name=GENERATION_MODEL):
+    model = get_model(model_name)
+    return call("count_tokens", model.count_tokens, contents).total_tokens
+
+
+def status():
+    """State of the shared limits, for /api/status."""
+    _, concurrency = get_limiters()
+    return concurrency.status()
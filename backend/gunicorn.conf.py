@@ -0,0 +1,22 @@
+import multiprocessing
+import os
+
+bind = os.environ.get("BIND", "0.0.0.0:5001")
+
+# Requests spend most of their time waiting on the Gemini API, so each
+# worker process also runs a few threads
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = "gthread"
+threads = int(os.environ.get("WEB_THREADS", 4))
+
+# The Gemini rate and concurrency limits are budgets for the API key, which
+# every worker enforces for itself: each one gets its share of them
+os.environ.setdefault("GEMINI_PROCESSES", str(workers))
+
+# Streamed answers keep a request open while the answer is generated
+timeout = int(os.environ.get("WEB_TIMEOUT", 120))
+graceful_timeout = 30
+
+# Every worker loads the app (and opens the index) after the fork: the
+# background threads that load the index don't survive a fork
+preload_app = False
@@ -0,0 +1,49 @@
+"""
+Single writer for the indexes: extracts, embeds and indexes PDFs, then
+publishes them for the web workers (see wsgi.py).
+
+    python ingest.py [path/to/book.pdf]   # one book (default: $PDF_PATH)
+    python ingest.py --all                # every new or changed book of $BOOKS_DIR
+    python ingest.py --watch              # the same, then again every CATALOG_SCAN_INTERVAL seconds
+"""
+import argparse
+import os
+import sys
+from embeddings import logger
+from library import Library
+from rag_system import RagSystem
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build and publish the index of a PDF.")
+    parser.add_argument("pdf_path", nargs="?", help="PDF to index (default: $PDF_PATH)")
+    parser.add_argument("--all", action="store_true", help="index every book of $BOOKS_DIR that is new or changed")
+    parser.add_argument("--watch", action="store_true", help="like --all, then keep watching $BOOKS_DIR for new books")
+    args = parser.parse_args()
+
+    if args.all or args.watch:
+        library = Library("writer")
+        if args.watch:
+            library.start_ingestion().join()
+        ingested = library.ingest_pending()
+        logger.info(f"Published the index of {len(ingested)} books")
+        return 0
+
+    if args.pdf_path:
+        os.environ["PDF_PATH"] = args.pdf_path
+
+    rag = RagSystem(role="writer", serve=False)
+    rag.start().join()
+    if not rag.ready:
+        logger.error(f"Ingestion failed: {rag.error}")
+        return 1
+
+    # Pre-described pages (PREDESCRIBE_PAGES=1) must finish before exiting
+    if rag.description_job is not None:
+        rag.description_job.join()
+    logger.info(f"Published index of {rag.pdf_path} ({len(rag.chunks)} chunks)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,157 @@
+import logging
+import math
+import os
+import re
+from collections import Counter, defaultdict
+
+import numpy as np
+
+from metrics import timed
+
+logger = logging.getLogger(__name__)
+
+LEXICAL_ENABLED = os.environ.get("LEXICAL_ENABLED", "1") != "0"
+
+# BM25 parameters: term frequency saturation and document length normalization
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+# The query pipeline skips the HyDE and rewrite LLM calls when the best BM25
+# match contains at least LEXICAL_SKIP_COVERAGE of the query terms (weighted
+# by IDF) and one of the matched terms is specific to the book, i.e. has an
+# IDF of at least LEXICAL_SKIP_MIN_IDF (it appears in few chunks).
+LEXICAL_SKIP_ENABLED = os.environ.get("LEXICAL_SKIP_ENABLED", "1") != "0"
+LEXICAL_SKIP_COVERAGE = float(os.environ.get("LEXICAL_SKIP_COVERAGE", 0.8))
+LEXICAL_SKIP_MIN_IDF = float(os.environ.get("LEXICAL_SKIP_MIN_IDF", 2.0))
+
+# Reciprocal rank fusion constant: a document ranked r in a list scores 1 / (RRF_K + r)
+RRF_K = 60
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+# Memory of one posting list besides its arrays: the term string, the dict
+# entries and the two array headers
+TERM_OVERHEAD_BYTES = 300
+
+# Question words and function words (English and Italian) that say nothing
+# about which chunk answers a question
+STOPWORDS = frozenset("""
+a an and are as at be by can do does explain for from how i in is it me of on or tell the this to
+what when where which who why with describe about between difference
+il lo la i gli le un uno una di del della dei delle da in con su per tra fra e ed o che
+chi cosa come dove quando quale quali perché è sono mi spiega spiegami descrivi differenza
+""".split())
+
+
+def tokenize(text):
+    """Lowercased word tokens of a text, without stopwords and single characters."""
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if len(token) > 1 and token not in STOPWORDS]
+
+
+class BM25Index:
+    """
+    Inverted index over the chunks of a book, scored with Okapi BM25.
+    Postings hold, for every term, the chunks containing it and the term
+    frequency in each, so a query only touches the chunks that match it.
+    """
+
+    def __init__(self, documents, metadatas=None, k1=BM25_K1, b=BM25_B):
+        self.documents = list(documents)
+        self.metadatas = list(metadatas) if metadatas is not None else [{} for _ in self.documents]
+        self.k1 = k1
+        self.b = b
+
+        postings = defaultdict(lambda: ([], []))
+        lengths = np.zeros(len(self.documents), dtype=np.float32)
+        for row, document in enumerate(self.documents):
+            tokens = tokenize(document)
+            lengths[row] = len(tokens)
+            for term, frequency in Counter(tokens).items():
+                rows, frequencies = postings[term]
+                rows.append(row)
+                frequencies.append(frequency)
+
+        count = len(self.documents)
+        self.postings = {
+            term: (np.array(rows, dtype=np.int32), np.array(frequencies, dtype=np.float32))
+            for term, (rows, frequencies) in postings.items()
+        }
+        self.idf = {
+            term: math.log(1 + (count - len(rows) + 0.5) / (len(rows) + 0.5))
+            for term, (rows, _) in self.postings.items()
+        }
+        average_length = lengths.mean() if count else 0.0
+        # Per-chunk part of the BM25 denominator
+        self.length_norms = k1 * (1 - b + b * lengths / (average_length or 1.0))
+        logger.info(f"Built BM25 index over {count} chunks ({len(self.postings)} terms)")
+
+    def __len__(self):
+        return len(self.documents)
+
+    def memory_usage(self):
+        """Approximate bytes taken by the postings (documents are shared with the RAG system)."""
+        postings = sum(rows.nbytes + frequencies.nbytes for rows, frequencies in self.postings.values())
+        return postings + len(self.postings) * TERM_OVERHEAD_BYTES + self.length_norms.nbytes
+
+    def scores(self, terms):
+        """BM25 score of every chunk for a list of query terms."""
+        scores = np.zeros(len(self.documents), dtype=np.float32)
+        for term in set(terms):
+            if term not in self.postings:
+                continue
+            rows, frequencies = self.postings[term]
+            scores[rows] += self.idf[term] * frequencies * (self.k1 + 1) / (frequencies + self.length_norms[rows])
+        return scores
+
+    @timed("lexical_search")
+    def search(self, query, k=20):
+        """
+        Returns (docs, metadatas, confidence) for the k best matching chunks.
+        confidence describes how well the best chunk matches the query terms:
+        {"coverage", "max_idf", "confident"}; see LEXICAL_SKIP_COVERAGE.
+        """
+        terms = list(dict.fromkeys(tokenize(query)))
+        confidence = {"coverage": 0.0, "max_idf": 0.0, "confident": False}
+        if not terms or not self.documents:
+            return [], [], confidence
+
+        scores = self.scores(terms)
+        matched = np.flatnonzero(scores)
+        if len(matched) == 0:
+            return [], [], confidence
+        if len(matched) > k:
+            matched = matched[np.argpartition(-scores[matched], k - 1)[:k]]
+        ranked = matched[np.argsort(-scores[matched], kind="stable")]
+
+        # Terms that never occur in the book count as the rarest possible
+        unknown_idf = math.log(1 + (len(self.documents) + 0.5) / 0.5)
+        top_terms = set(tokenize(self.documents[ranked[0]]))
+        weights = {term: self.idf.get(term, unknown_idf) for term in terms}
+        matched_terms = [term for term in terms if term in top_terms]
+        coverage = sum(weights[term] for term in matched_terms) / sum(weights.values())
+        max_idf = max((weights[term] for term in matched_terms), default=0.0)
+        confidence = {
+            "coverage": round(coverage, 3),
+            "max_idf": round(max_idf, 3),
+            "confident": coverage >= LEXICAL_SKIP_COVERAGE and max_idf >= LEXICAL_SKIP_MIN_IDF,
+        }
+        return [self.documents[row] for row in ranked], [self.metadatas[row] for row in ranked], confidence
+
+
+def reciprocal_rank_fusion(ranked_lists, rrf_k=RRF_K, with_scores=False):
+    """
+    Fuses ranked (docs, metadatas) lists into one, scoring every document by
+    the sum of 1 / (rrf_k + rank) over the lists it appears in. Ties keep the
+    order in which documents were first seen. With `with_scores`, the fused
+    scores are returned as a third list.
+    """
+    scores = {}
+    metadatas = {}
+    for docs, doc_metadatas in ranked_lists:
+        for rank, (doc, metadata) in enumerate(zip(docs, doc_metadatas), start=1):
+            scores[doc] = scores.get(doc, 0.0) + 1.0 / (rrf_k + rank)
+            metadatas.setdefault(doc, metadata)
+    fused = sorted(scores, key=scores.get, reverse=True)
+    if with_scores:
+        return fused, [metadatas[doc] for doc in fused], [scores[doc] for doc in fused]
+    return fused, [metadatas[doc] for doc in fused]
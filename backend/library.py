@@ -0,0 +1,238 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from embeddings import load_published_index
+from rag_system import RagSystem
+from utils import compute_file_hash, get_book_id
+
+logger = logging.getLogger(__name__)
+
+# The library is every PDF in BOOKS_DIR, plus the book at $PDF_PATH. Books
+# are opened on first use (each in its own ChromaDB collection) and the
+# least recently used ones are closed once the loaded books take more than
+# LIBRARY_MEMORY_MB (checked whenever a book is looked up). Writer
+# processes also ingest new and changed books in the background, one at a
+# time, rescanning BOOKS_DIR every CATALOG_SCAN_INTERVAL seconds. A lookup
+# of a book missing from the catalog rescans it too (so a book just copied
+# there is found right away), at most every CATALOG_RESCAN_INTERVAL seconds.
+BOOKS_DIR = os.environ.get("BOOKS_DIR")
+LIBRARY_MEMORY_MB = int(os.environ.get("LIBRARY_MEMORY_MB", 1024))
+CATALOG_SCAN_INTERVAL = float(os.environ.get("CATALOG_SCAN_INTERVAL", 60))
+CATALOG_RESCAN_INTERVAL = float(os.environ.get("CATALOG_RESCAN_INTERVAL", 5))
+BACKGROUND_INGESTION = os.environ.get("BACKGROUND_INGESTION", "1") != "0"
+
+
+def book_name(book_id):
+    return book_id.replace("_", " ").title()
+
+
+def scan_catalog(books_dir=None, pdf_path=None):
+    """Returns {book_id: {"id", "name", "path"}} for the PDFs of books_dir and pdf_path."""
+    paths = []
+    if books_dir and os.path.isdir(books_dir):
+        with os.scandir(books_dir) as entries:
+            paths.extend(entry.path for entry in entries if entry.is_file() and entry.name.lower().endswith(".pdf"))
+    elif books_dir:
+        logger.warning(f"Books directory {books_dir} does not exist")
+    if pdf_path and os.path.exists(pdf_path):
+        paths.append(pdf_path)
+
+    catalog = {}
+    for path in sorted(paths):
+        book_id = get_book_id(path)
+        catalog[book_id] = {"id": book_id, "name": book_name(book_id), "path": os.path.abspath(path)}
+    return catalog
+
+
+class Library:
+    """
+    Catalog of the available books and LRU of the loaded ones. get() returns
+    the RagSystem of a book, starting to load it if needed; `on_evict` is
+    called with the id of every book closed to stay within the memory budget
+    (e.g. to drop its cached answers).
+    """
+
+    def __init__(self, role="writer", books_dir=BOOKS_DIR, pdf_path=None, memory_budget_mb=LIBRARY_MEMORY_MB,
+                 on_evict=None):
+        self.role = role
+        self.books_dir = books_dir
+        self.pdf_path = pdf_path or os.environ.get("PDF_PATH")
+        self.memory_budget = memory_budget_mb * 1024 * 1024
+        self.on_evict = on_evict
+        self.evictions = 0
+        self._catalog = {}
+        self._scanned_at = None
+        self._loaded = OrderedDict()
+        self._lock = threading.Lock()
+        self._ingesting = None
+        # Content hash of the PDF of books whose ingestion failed, not retried until the file changes
+        self._failed = {}
+        self._ingestion_thread = None
+        self._stop = threading.Event()
+
+    def catalog(self, refresh=False):
+        """
+        Returns the catalog, rescanning the books directory when it is older
+        than CATALOG_SCAN_INTERVAL (CATALOG_RESCAN_INTERVAL with `refresh`).
+        """
+        max_age = CATALOG_RESCAN_INTERVAL if refresh else CATALOG_SCAN_INTERVAL
+        with self._lock:
+            if self._scanned_at is None or time.monotonic() - self._scanned_at > max_age:
+                self._catalog = scan_catalog(self.books_dir, self.pdf_path)
+                self._scanned_at = time.monotonic()
+            return self._catalog
+
+    def default_book_id(self):
+        """The book of $PDF_PATH, or else the first one of the catalog (None if it is empty)."""
+        catalog = self.catalog()
+        if self.pdf_path and get_book_id(self.pdf_path) in catalog:
+            return get_book_id(self.pdf_path)
+        return next(iter(catalog), None)
+
+    def get(self, book_id=None):
+        """
+        Returns the RagSystem of a book (the default one if book_id is None),
+        started in the background if it wasn't loaded. Raises KeyError for a
+        book that is not in the catalog.
+        """
+        book_id = book_id or self.default_book_id()
+        with self._lock:
+            rag = self._loaded.get(book_id)
+            if rag is not None:
+                self._loaded.move_to_end(book_id)
+        if rag is None:
+            book = self.catalog().get(book_id) or self.catalog(refresh=True).get(book_id)
+            if book is None:
+                raise KeyError(book_id)
+            with self._lock:
+                rag = self._loaded.get(book_id)
+                if rag is None:
+                    rag = self._loaded[book_id] = RagSystem(self.role, pdf_path=book["path"])
+                    logger.info(f"Loading book {book_id} ({len(self._loaded)} loaded)")
+        rag.start()
+        self._evict(keep=book_id)
+        return rag
+
+    def peek(self, book_id=None):
+        """Returns the RagSystem of a loaded book, or None, without loading it."""
+        book_id = book_id or self.default_book_id()
+        with self._lock:
+            return self._loaded.get(book_id)
+
+    def _evict(self, keep):
+        """
+        Closes least recently used books until the loaded ones fit in the
+        memory budget, and forgets books that failed to load (a new lookup
+        starts them again).
+        """
+        evicted = []
+        with self._lock:
+            for book_id in [book_id for book_id, rag in self._loaded.items() if rag.state == "error" and book_id != keep]:
+                del self._loaded[book_id]
+            usage = {book_id: rag.memory_usage() for book_id, rag in self._loaded.items()}
+            total = sum(usage.values())
+            # Books still loading stay: a client is waiting for them
+            for book_id, rag in list(self._loaded.items()):
+                if total <= self.memory_budget:
+                    break
+                if book_id == keep or rag.state == "initializing":
+                    continue
+                del self._loaded[book_id]
+                total -= usage[book_id]
+                evicted.append((book_id, usage[book_id]))
+            self.evictions += len(evicted)
+        for book_id, size in evicted:
+            logger.info(f"Closed book {book_id} ({size / 1024 / 1024:.1f} MB) to stay within the memory budget")
+            if self.on_evict is not None:
+                self.on_evict(book_id)
+
+    def book_status(self, book_id=None):
+        """Status of a book: the loaded RagSystem's, or an idle one. Raises KeyError for an unknown book."""
+        book_id = book_id or self.default_book_id()
+        rag = self.peek(book_id)
+        if rag is None:
+            book = self.catalog().get(book_id)
+            if book is None:
+                raise KeyError(book_id)
+            rag = RagSystem(self.role, pdf_path=book["path"])
+        return rag.status()
+
+    def books(self):
+        """The catalog as a list (the default book first), with whether each book is indexed and loaded."""
+        catalog = self.catalog()
+        default = self.default_book_id()
+        with self._lock:
+            loaded = {book_id: rag.state for book_id, rag in self._loaded.items()}
+        return [
+            {**book, "indexed": load_published_index(book_id) is not None, "state": loaded.get(book_id, "idle")}
+            for book_id, book in sorted(catalog.items(), key=lambda item: item[0] != default)
+        ]
+
+    def status(self):
+        with self._lock:
+            loaded = list(self._loaded.items())
+        return {
+            "books": len(self.catalog()),
+            "loaded": [book_id for book_id, _ in loaded],
+            "memory_mb": round(sum(rag.memory_usage() for _, rag in loaded) / 1024 / 1024, 1),
+            "memory_budget_mb": round(self.memory_budget / 1024 / 1024, 1),
+            "evictions": self.evictions,
+            "ingesting": self._ingesting,
+        }
+
+    def needs_ingestion(self, book):
+        """True when a book was never published or its PDF changed since (and it didn't fail to ingest)."""
+        file_hash = compute_file_hash(book["path"])
+        if self._failed.get(book["id"]) == file_hash:
+            return False
+        published = load_published_index(book["id"])
+        return published is None or published["file_hash"] != file_hash
+
+    def ingest_pending(self, stop=None):
+        """
+        Ingests and publishes, one at a time, the catalog's books that need it
+        and are not loaded (a loaded book is ingested by its own RagSystem).
+        Returns the ids of the books ingested.
+        """
+        ingested = []
+        for book_id, book in self.catalog(refresh=True).items():
+            if stop is not None and stop.is_set():
+                break
+            if self.peek(book_id) is not None or not self.needs_ingestion(book):
+                continue
+            self._ingesting = book_id
+            logger.info(f"Ingesting book {book_id}")
+            rag = RagSystem("writer", pdf_path=book["path"], serve=False)
+            rag.start().join()
+            self._ingesting = None
+            if rag.ready:
+                ingested.append(book_id)
+                if rag.description_job is not None:
+                    rag.description_job.join()
+            else:
+                self._failed[book_id] = compute_file_hash(book["path"])
+                logger.error(f"Ingestion of {book_id} failed: {rag.error}")
+        return ingested
+
+    def start_ingestion(self, interval=CATALOG_SCAN_INTERVAL):
+        """Starts ingesting new and changed books in a background thread, rescanning every `interval` seconds."""
+        if self._ingestion_thread is not None:
+            return self._ingestion_thread
+
+        def run():
+            while not self._stop.is_set():
+                try:
+                    self.ingest_pending(self._stop)
+                except Exception as e:
+                    logger.error(f"Background ingestion failed: {e}", exc_info=True)
+                self._stop.wait(interval)
+
+        self._ingestion_thread = threading.Thread(target=run, daemon=True, name="library-ingestion")
+        self._ingestion_thread.start()
+        return self._ingestion_thread
+
+    def stop_ingestion(self):
+        self._stop.set()
@@ -0,0 +1,181 @@
+import contextvars
+import functools
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds (seconds) of the latency histogram buckets
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 25.0, 60.0)
+
+# Stage timings of the request being handled, when it asked for a breakdown
+_request_timings = contextvars.ContextVar("request_timings", default=None)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+class Counter:
+    """Monotonic counter with labels."""
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self.values = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        with self._lock:
+            self.values[tuple(sorted(labels.items()))] += amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{format_labels(labels)} {value:g}")
+        return lines
+
+
+class Gauge:
+    """Value that can go up and down, with labels."""
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def set(self, value, **labels):
+        with self._lock:
+            self.values[tuple(sorted(labels.items()))] = value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        with self._lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{format_labels(labels)} {value:g}")
+        return lines
+
+
+class Histogram:
+    """Latency histogram with labels, cumulative buckets as in Prometheus."""
+
+    def __init__(self, name, documentation, buckets=DURATION_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = buckets
+        self.series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self.series.setdefault(key, {"buckets": [0] * len(self.buckets), "count": 0, "sum": 0.0})
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["buckets"][i] += 1
+            series["count"] += 1
+            series["sum"] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labels, series in sorted(self.series.items()):
+                for bound, count in zip(self.buckets, series["buckets"]):
+                    lines.append(f"{self.name}_bucket{format_labels(labels + (('le', f'{bound:g}'),))} {count}")
+                lines.append(f"{self.name}_bucket{format_labels(labels + (('le', '+Inf'),))} {series['count']}")
+                lines.append(f"{self.name}_sum{format_labels(labels)} {series['sum']:.6f}")
+                lines.append(f"{self.name}_count{format_labels(labels)} {series['count']}")
+        return lines
+
+
+STAGE_DURATION = Histogram("clarifai_stage_duration_seconds", "Duration of pipeline stages.")
+REQUEST_DURATION = Histogram("clarifai_request_duration_seconds", "Duration of API requests.")
+CACHE_REQUESTS = Counter("clarifai_cache_requests_total", "Cache lookups by cache and result.")
+API_CALLS = Counter("clarifai_api_calls_total", "Gemini API calls by kind.")
+API_RETRIES = Counter("clarifai_api_retries_total", "Gemini API calls retried after a failure, by kind.")
+CONTEXT_TOKENS_SAVED = Counter("clarifai_context_tokens_saved_total", "Prompt tokens saved by context assembly, by reason.")
+GEMINI_CONCURRENCY = Gauge("clarifai_gemini_concurrency_limit", "Current adaptive limit of concurrent Gemini API calls.")
+
+METRICS = [STAGE_DURATION, REQUEST_DURATION, CACHE_REQUESTS, API_CALLS, API_RETRIES, CONTEXT_TOKENS_SAVED, GEMINI_CONCURRENCY]
+
+
+def record_stage(stage, seconds):
+    """Records a stage duration in the histogram and in the current request's breakdown."""
+    STAGE_DURATION.observe(seconds, stage=stage)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings.append({"stage": stage, "ms": round(seconds * 1000, 1)})
+    logger.info(f"Stage {stage} took {seconds * 1000:.0f} ms")
+
+
+@contextmanager
+def span(stage):
+    """Times the enclosed block as a stage."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start)
+
+
+def timed(stage):
+    """Decorator timing every call of a function as a stage."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count_cache(cache, hit, amount=1):
+    if amount:
+        CACHE_REQUESTS.inc(amount, cache=cache, result="hit" if hit else "miss")
+
+
+def count_api_call(kind):
+    API_CALLS.inc(kind=kind)
+
+
+def count_retry(kind):
+    API_RETRIES.inc(kind=kind)
+
+
+def set_gemini_concurrency(limit):
+    GEMINI_CONCURRENCY.set(limit)
+
+
+def count_tokens_saved(reason, amount):
+    if amount:
+        CONTEXT_TOKENS_SAVED.inc(amount, reason=reason)
+
+
+def observe_request(endpoint, seconds):
+    REQUEST_DURATION.observe(seconds, endpoint=endpoint)
+
+
+def start_request_timings(enabled=True):
+    """
+    Starts collecting a stage breakdown for the current request and returns
+    its list, or clears the previous request's (server threads are reused)
+    and returns None when `enabled` is false.
+    """
+    timings = [] if enabled else None
+    _request_timings.set(timings)
+    return timings
+
+
+def render_metrics():
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,18 @@
+import fitz  # PyMuPDF
+
+# Runs in the render worker processes (see extract_images.get_render_pool),
+# so it only imports PyMuPDF
+
+
+def render_vision_image(pdf_path, page_num, max_side, quality):
+    """
+    Renders a PDF page (0-based) to JPEG bytes whose longer side is max_side
+    pixels. Returns None if the page does not exist.
+    """
+    with fitz.open(pdf_path) as doc:
+        if page_num < 0 or page_num >= len(doc):
+            return None
+        page = doc[page_num]
+        zoom = max_side / max(page.rect.width, page.rect.height)
+        pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom))
+        return pix.tobytes("jpeg", jpg_quality=quality)
@@ -0,0 +1,305 @@
+import asyncio
+import contextvars
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from embeddings import logger, embed_queries
+from retrieval import rewrite_query, HyDERetriever
+from lexical import LEXICAL_SKIP_ENABLED, reciprocal_rank_fusion
+from context_assembler import CONTEXT_ASSEMBLY_ENABLED, assemble_context
+
+# Pipeline modes:
+#   sync  the original sequential pipeline (rewrite -> HyDE -> embed -> search)
+#   full  rewrite, HyDE and a direct query search run concurrently; every
+#         stage that finishes within its timeout contributes documents
+#   fast  same stages, but as soon as the HyDE search is done the slower
+#         stages are dropped; if HyDE fails or times out, the direct query
+#         search is used instead
+# In "full" and "fast" mode, the vector results are fused with the BM25
+# results of the query by reciprocal rank. When the BM25 match is confident
+# (see lexical.LEXICAL_SKIP_COVERAGE), the rewrite and HyDE stages are
+# skipped and only the direct query search runs.
+# The candidates are then turned into the prompt documents by
+# context_assembler (unless CONTEXT_ASSEMBLY_ENABLED=0, which packs them in
+# rank order).
+PIPELINE_MODES = ("sync", "full", "fast")
+DEFAULT_PIPELINE_MODE = os.environ.get("QUERY_PIPELINE_MODE", "full")
+
+# Batches of queries (retrieve_documents_batch) run their rewrite and HyDE
+# calls on at most BATCH_CONCURRENCY threads; API callers answer them with
+# the same bound
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", 8))
+
+# Per-stage timeouts in seconds
+STAGE_TIMEOUTS = {
+    "rewrite": float(os.environ.get("REWRITE_TIMEOUT", 15)),
+    "hyde": float(os.environ.get("HYDE_TIMEOUT", 20)),
+    "embed": float(os.environ.get("EMBED_TIMEOUT", 10)),
+    "search": float(os.environ.get("SEARCH_TIMEOUT", 10)),
+}
+
+# Stages run on this long-lived pool rather than on asyncio's default
+# executor: asyncio.run() waits for the default executor's threads before
+# returning, so a stage that timed out (or was dropped by the "fast" race)
+# would still hold up the query until its API call came back. Abandoned
+# calls finish in the background and keep their worker until then.
+STAGE_WORKERS = int(os.environ.get("STAGE_WORKERS", 64))
+_stage_executor = ThreadPoolExecutor(max_workers=STAGE_WORKERS, thread_name_prefix="query-stage")
+
+
+async def run_stage(name, func, *args, timeouts=None):
+    """Runs a blocking stage in a worker thread, bounded by the stage timeout."""
+    timeout = (timeouts or STAGE_TIMEOUTS).get(name)
+    loop = asyncio.get_running_loop()
+    # Like asyncio.to_thread, run the stage in a copy of the caller's context
+    call = functools.partial(contextvars.copy_context().run, func, *args)
+    return await asyncio.wait_for(loop.run_in_executor(_stage_executor, call), timeout)
+
+
+async def search_text(retriever, text, k, timeouts=None):
+    """Embeds a text and searches the collection with it."""
+    embedding = (await run_stage("embed", embed_queries, [text], timeouts=timeouts))[0]
+    return await run_stage("search", retriever.search, embedding, k, timeouts=timeouts)
+
+
+async def rewrite_branch(retriever, query, k, timeouts=None, on_stage=None):
+    rewritten_query = await run_stage("rewrite", rewrite_query, query, timeouts=timeouts)
+    if on_stage:
+        on_stage("retrieving")
+    docs, metadatas = await search_text(retriever, rewritten_query, k, timeouts=timeouts)
+    return rewritten_query, docs, metadatas
+
+
+async def hyde_branch(retriever, query, k, timeouts=None, on_stage=None):
+    hypothetical_doc = await run_stage("hyde", retriever.generate_hypothetical_document, query, timeouts=timeouts)
+    if on_stage:
+        on_stage("retrieving")
+    docs, metadatas = await search_text(retriever, hypothetical_doc, k, timeouts=timeouts)
+    return hypothetical_doc, docs, metadatas
+
+
+async def direct_branch(retriever, query, k, timeouts=None, embed_query=None):
+    if embed_query is None:
+        docs, metadatas = await search_text(retriever, query, k, timeouts=timeouts)
+    else:
+        embedding = await run_stage("embed", embed_query, timeouts=timeouts)
+        docs, metadatas = await run_stage("search", retriever.search, embedding, k, timeouts=timeouts)
+    return None, docs, metadatas
+
+
+def source_pages(metadatas):
+    """Returns the sorted page numbers the selected chunks come from."""
+    return sorted({metadata["page"] for metadata in metadatas if metadata.get("page")})
+
+
+def select_context(retriever, candidate_docs, candidate_metadatas, max_tokens, scores=None):
+    """Returns (docs, metadatas, report) of the documents that go into the prompt."""
+    if CONTEXT_ASSEMBLY_ENABLED:
+        return assemble_context(candidate_docs, candidate_metadatas, max_tokens=max_tokens, scores=scores)
+    docs, metadatas = retriever.pack(candidate_docs, candidate_metadatas, max_tokens=max_tokens)
+    return docs, metadatas, None
+
+
+def stage_reporter(on_stage):
+    """Wraps an on_stage callback so each stage name is reported only once."""
+    reported = set()
+
+    def report(stage):
+        if on_stage is not None and stage not in reported:
+            reported.add(stage)
+            on_stage(stage)
+    return report
+
+
+async def run_query_pipeline(query, collection, mode=None, max_tokens=8000, k=20, timeouts=None, on_stage=None,
+                             lexical_index=None, embed_query=None):
+    """
+    Retrieves the documents for a query, overlapping the LLM and search stages.
+    Returns (similar_docs, info) where info holds the rewritten query, the
+    hypothetical document, the names of the stages that were dropped or
+    skipped, the BM25 confidence and the context assembly report.
+    on_stage, if given, is called with "rewriting" and then "retrieving".
+    embed_query, if given, returns the query embedding (e.g. an
+    embeddings.QueryEmbedding shared with the answer cache).
+    """
+    mode = mode or DEFAULT_PIPELINE_MODE
+    retriever = HyDERetriever(collection)
+    report = stage_reporter(on_stage)
+
+    lexical_results = None
+    lexical_confidence = None
+    if lexical_index is not None:
+        lexical_docs, lexical_metadatas, lexical_confidence = lexical_index.search(query, k)
+        lexical_results = (lexical_docs, lexical_metadatas)
+    skip_llm = LEXICAL_SKIP_ENABLED and bool(lexical_confidence and lexical_confidence["confident"])
+
+    tasks = {}
+    if skip_llm:
+        logger.info(f"Confident lexical match ({lexical_confidence}), skipping rewrite and HyDE")
+        report("retrieving")
+    else:
+        report("rewriting")
+        tasks["hyde"] = asyncio.create_task(hyde_branch(retriever, query, k, timeouts, report))
+        tasks["rewrite"] = asyncio.create_task(rewrite_branch(retriever, query, k, timeouts, report))
+    tasks["direct"] = asyncio.create_task(direct_branch(retriever, query, k, timeouts, embed_query))
+
+    if mode == "fast" and "hyde" in tasks:
+        # Race: stop waiting for the other stages once the HyDE search is settled
+        await asyncio.wait([tasks["hyde"]])
+        if tasks["hyde"].exception() is not None:
+            # HyDE failed or timed out: fall back to the direct query search
+            await asyncio.wait([tasks["direct"]])
+        for task in tasks.values():
+            if not task.done():
+                task.cancel()
+    await asyncio.gather(*tasks.values(), return_exceptions=True)
+
+    results = {}
+    dropped = []
+    for name, task in tasks.items():
+        if task.cancelled():
+            dropped.append(name)
+        elif task.exception() is not None:
+            error = task.exception()
+            reason = "timed out" if isinstance(error, asyncio.TimeoutError) else f"failed: {error}"
+            logger.warning(f"Query stage '{name}' {reason}")
+            dropped.append(name)
+        else:
+            results[name] = task.result()
+
+    if not results and not (lexical_results and lexical_results[0]):
+        raise RuntimeError("All retrieval stages failed")
+    if dropped:
+        logger.info(f"Dropped query stages: {', '.join(dropped)}")
+
+    # Fuse the ranked lists; on ties, HyDE results come first
+    ranked_lists = [results[name][1:] for name in ("hyde", "rewrite", "direct") if name in results]
+    if lexical_results is not None:
+        ranked_lists.append(lexical_results)
+    candidate_docs, candidate_metadatas, scores = reciprocal_rank_fusion(ranked_lists, with_scores=True)
+
+    similar_docs, selected_metadatas, context = select_context(
+        retriever, candidate_docs, candidate_metadatas, max_tokens, scores=scores
+    )
+    info = {
+        "pages": source_pages(selected_metadatas),
+        "rewritten_query": results["rewrite"][0] if "rewrite" in results else None,
+        "hypothetical_doc": results["hyde"][0] if "hyde" in results else None,
+        "dropped_stages": dropped,
+        "skipped_stages": ["hyde", "rewrite"] if skip_llm else [],
+        "lexical": lexical_confidence,
+        "context": context,
+    }
+    return similar_docs, info
+
+
+def retrieve_documents(query, collection, mode=None, max_tokens=8000, k=20, on_stage=None, lexical_index=None,
+                       embed_query=None):
+    """
+    Synchronous entry point used by the Flask views. `lexical_index` (a
+    lexical.BM25Index) enables hybrid retrieval; the "sync" mode ignores it,
+    as it ignores `embed_query` (see run_query_pipeline).
+    """
+    mode = mode or DEFAULT_PIPELINE_MODE
+    if mode not in PIPELINE_MODES:
+        raise ValueError(f"Unknown pipeline mode '{mode}', expected one of {', '.join(PIPELINE_MODES)}")
+
+    if mode == "sync":
+        report = stage_reporter(on_stage)
+        report("rewriting")
+        rewritten_query = rewrite_query(query)
+        logger.info(f"Rewritten Query: {rewritten_query}")
+        report("retrieving")
+        retriever = HyDERetriever(collection)
+        hypothetical_doc = retriever.generate_hypothetical_document(rewritten_query)
+        hypothetical_embedding = embed_queries([hypothetical_doc])[0]
+        candidate_docs, candidate_metadatas = retriever.search(hypothetical_embedding, k=k)
+        similar_docs, selected_metadatas, context = select_context(
+            retriever, candidate_docs, candidate_metadatas, max_tokens
+        )
+        return similar_docs, {
+            "pages": source_pages(selected_metadatas),
+            "rewritten_query": rewritten_query,
+            "hypothetical_doc": hypothetical_doc,
+            "dropped_stages": [],
+            "skipped_stages": [],
+            "lexical": None,
+            "context": context,
+        }
+
+    similar_docs, info = asyncio.run(
+        run_query_pipeline(query, collection, mode=mode, max_tokens=max_tokens, k=k, on_stage=on_stage,
+                           lexical_index=lexical_index, embed_query=embed_query)
+    )
+    logger.info(f"Rewritten Query: {info['rewritten_query']}")
+    return similar_docs, info
+
+
+def retrieve_documents_batch(queries, collection, max_tokens=8000, k=20, lexical_index=None,
+                             concurrency=BATCH_CONCURRENCY, query_embeddings=None):
+    """
+    Retrieves the documents of several queries like the "full" mode, sharing
+    the work between them: the rewritten queries, hypothetical documents and
+    queries are embedded in one call and searched with one multi-vector
+    query. `query_embeddings`, if given, are the embeddings of `queries`
+    (already computed for the answer cache), which are not embedded again.
+    Returns a (similar_docs, info) pair per query, in order.
+    """
+    retriever = HyDERetriever(collection)
+    lexical_results = []
+    for query in queries:
+        lexical_results.append(lexical_index.search(query, k) if lexical_index is not None else None)
+    skip_llm = [
+        LEXICAL_SKIP_ENABLED and bool(lexical and lexical[2]["confident"])
+        for lexical in lexical_results
+    ]
+
+    # LLM stages of every query, on a bounded pool
+    texts = {}
+    dropped = {i: [] for i in range(len(queries))}
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {}
+        for i, query in enumerate(queries):
+            if not skip_llm[i]:
+                futures[(i, "hyde")] = executor.submit(retriever.generate_hypothetical_document, query)
+                futures[(i, "rewrite")] = executor.submit(rewrite_query, query)
+        for (i, name), future in futures.items():
+            try:
+                texts[(i, name)] = future.result()
+            except Exception as e:
+                logger.warning(f"Query stage '{name}' failed for batch query {i}: {e}")
+                dropped[i].append(name)
+    for i, query in enumerate(queries):
+        texts[(i, "direct")] = query
+
+    keys = sorted(texts, key=lambda key: (key[0], ("hyde", "rewrite", "direct").index(key[1])))
+    known = {}
+    if query_embeddings is not None:
+        known = {(i, "direct"): embedding for i, embedding in enumerate(query_embeddings)}
+    to_embed = [key for key in keys if key not in known]
+    if to_embed:
+        known.update(zip(to_embed, embed_queries([texts[key] for key in to_embed])))
+    embeddings = np.asarray([known[key] for key in keys], dtype=np.float32)
+    searches = dict(zip(keys, retriever.search_many(embeddings, k=k)))
+
+    retrieved = []
+    for i, query in enumerate(queries):
+        ranked_lists = [searches[(i, name)] for name in ("hyde", "rewrite", "direct") if (i, name) in searches]
+        if lexical_results[i] is not None:
+            ranked_lists.append(lexical_results[i][:2])
+        candidate_docs, candidate_metadatas, scores = reciprocal_rank_fusion(ranked_lists, with_scores=True)
+        similar_docs, selected_metadatas, context = select_context(
+            retriever, candidate_docs, candidate_metadatas, max_tokens, scores=scores
+        )
+        retrieved.append((similar_docs, {
+            "pages": source_pages(selected_metadatas),
+            "rewritten_query": texts.get((i, "rewrite")),
+            "hypothetical_doc": texts.get((i, "hyde")),
+            "dropped_stages": dropped[i],
+            "skipped_stages": ["hyde", "rewrite"] if skip_llm[i] else [],
+            "lexical": lexical_results[i][2] if lexical_results[i] is not None else None,
+            "context": context,
+        }))
+    logger.info(f"Retrieved documents for a batch of {len(queries)} queries ({len(keys)} searches)")
+    return retrieved
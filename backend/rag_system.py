@@ -0,0 +1,277 @@
+import os
+import threading
+import time
+from collections import defaultdict
+from embeddings import logger, generate_embeddings, compute_chunk_hash, EMBEDDING_DIM
+from embeddings import store_embeddings_in_chromadb, process_pdf_with_images, book_collection_name
+from embeddings import load_manifest, manifest_chunks, open_embedding_store_readonly
+from embeddings import publish_index, load_published_index, unique_chunk_rows, update_manifest_index
+from analyze_images import start_page_description_job
+from utils import ensure_token_calibration, get_book_id
+from vector_index import RETRIEVAL_BACKEND, READER_RETRIEVAL_BACKEND, VectorIndex, build_vector_index
+from lexical import LEXICAL_ENABLED, BM25Index
+import gemini_client
+
+# Seconds a query waits for the RAG system to become ready before failing
+READY_TIMEOUT = float(os.environ.get("READY_TIMEOUT", 30))
+
+# "writer" builds the index itself (development server, ingest.py);
+# "reader" only opens the index published by a writer (production workers)
+RAG_ROLES = ("writer", "reader")
+
+# Seconds between checks for a published index while a reader waits for it,
+# and seconds after which it gives up (the next lookup of the book waits again)
+INDEX_POLL_INTERVAL = float(os.environ.get("INDEX_POLL_INTERVAL", 2))
+INDEX_WAIT_TIMEOUT = float(os.environ.get("INDEX_WAIT_TIMEOUT", READY_TIMEOUT))
+
+# One writer at a time per book in this process (e.g. background ingestion
+# and a query loading the same book)
+_book_locks = defaultdict(threading.Lock)
+_book_locks_lock = threading.Lock()
+
+def book_lock(book_id):
+    with _book_locks_lock:
+        return _book_locks[book_id]
+
+
+class RagSystem:
+    """
+    Holds one indexed book (collection, chunks, PDF path) and builds it once.
+    start() runs the extract -> embed -> index cycle in a background thread;
+    concurrent callers share that single run. Progress is exposed through
+    status() so clients can poll it.
+
+    A "reader" never ingests: it waits for the index published by a writer
+    process and opens it, with the embedding store mapped read-only. It
+    never uses Chroma (see vector_index.READER_RETRIEVAL_BACKEND).
+
+    `collection` is what retrieval searches: the Chroma collection, or an
+    in-memory vector index when `retrieval_backend` is not "chroma" (by
+    default RETRIEVAL_BACKEND, or READER_RETRIEVAL_BACKEND for a reader).
+    `lexical_index` is the BM25 index of the chunks (None if disabled).
+
+    The book is the PDF at `pdf_path` (default: $PDF_PATH). With
+    `serve=False` a writer only ingests and publishes it, without building
+    the in-memory search indexes (background ingestion, ingest.py).
+    """
+
+    def __init__(self, role="writer", retrieval_backend=None, pdf_path=None, serve=True):
+        if role not in RAG_ROLES:
+            raise ValueError(f"Unknown RAG role: {role}")
+        if retrieval_backend is None:
+            retrieval_backend = READER_RETRIEVAL_BACKEND if role == "reader" else RETRIEVAL_BACKEND
+        if role == "reader" and retrieval_backend == "chroma":
+            raise ValueError("Readers can't search Chroma, which the ingestion process writes to; use an in-memory backend")
+        self.role = role
+        self.retrieval_backend = retrieval_backend
+        self.serve = serve
+        self.collection = None
+        self.lexical_index = None
+        self.chunks = None
+        self.page_count = None
+        self.pdf_path = pdf_path or os.environ.get("PDF_PATH")
+        self.book_id = get_book_id(self.pdf_path) if self.pdf_path else None
+        self.collection_version = None
+        self.state = "idle"  # idle, initializing, ready, error
+        self.stage = None
+        self.error = None
+        self.progress = {
+            "pages_extracted": 0,
+            "pages_total": 0,
+            "chunks_embedded": 0,
+            "chunks_total": 0,
+            "chunks_indexed": 0,
+            "chunks_to_index": 0,
+        }
+        self.stage_timings = {}
+        self.started_at = None
+        self.ready_at = None
+        self._stage_started = None
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._thread = None
+        self.description_job = None
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    def start(self):
+        """Starts initialization in the background, unless it is running or done."""
+        with self._lock:
+            if self.state in ("initializing", "ready"):
+                return self._thread
+            self.state = "initializing"
+            self.error = None
+            self.stage = None
+            self.stage_timings = {}
+            self.started_at = time.time()
+            self._thread = threading.Thread(target=self._run, daemon=True, name="rag-warmup")
+            self._thread.start()
+            return self._thread
+
+    def wait_until_ready(self, timeout=READY_TIMEOUT):
+        """
+        Starts initialization if needed (retrying after a failure) and waits
+        up to `timeout` seconds for it. Returns True once ready.
+        """
+        if self.ready:
+            return True
+        self.start()
+        deadline = time.monotonic() + timeout
+        while not self._ready.wait(min(0.5, max(0.0, deadline - time.monotonic()))):
+            if self.state == "error" or time.monotonic() >= deadline:
+                return False
+        return True
+
+    def _enter_stage(self, stage):
+        """Moves to a new stage (None when done), recording how long the previous one took."""
+        now = time.perf_counter()
+        if self.stage is not None:
+            self.stage_timings[self.stage] = round(now - self._stage_started, 3)
+        self.stage = stage
+        self._stage_started = now
+
+    def _set_progress(self, done_key, total_key):
+        def update(done, total):
+            self.progress[done_key] = done
+            self.progress[total_key] = total
+        return update
+
+    def _run(self):
+        try:
+            if self.role == "reader":
+                self._open_published()
+            else:
+                # Ingestion API calls leave room for queries of other books or processes
+                with gemini_client.background():
+                    self._initialize()
+            with self._lock:
+                self.state = "ready"
+                self._enter_stage(None)
+                self.ready_at = time.time()
+            self._ready.set()
+            logger.info(f"RAG system of {self.book_id} ready in {self.ready_at - self.started_at:.1f}s")
+        except Exception as e:
+            logger.error(f"RAG system initialization of {self.book_id} failed: {e}", exc_info=True)
+            with self._lock:
+                self.state = "error"
+                self.error = str(e)
+
+    def _initialize(self):
+        """Initialize the RAG system with the book's PDF"""
+        if not self.pdf_path:
+            raise ValueError("The PDF_PATH environment variable is not set.")
+        with book_lock(self.book_id):
+            self._ingest(self.pdf_path)
+
+    def _ingest(self, pdf_path):
+        # Step 1: Extract and chunk text
+        logger.info(f"Starting process for PDF: {pdf_path}")
+        self._enter_stage("extracting")
+        chunks, chunk_metadatas, chunk_changes = process_pdf_with_images(
+            pdf_path, progress=self._set_progress("pages_extracted", "pages_total")
+        )
+        ensure_token_calibration(chunks)
+
+        # Step 2: Generate embeddings
+        self._enter_stage("embedding")
+        chunk_embeddings = generate_embeddings(
+            chunks, progress=self._set_progress("chunks_embedded", "chunks_total")
+        )
+
+        # Step 3: Store embeddings in ChromaDB
+        self._enter_stage("indexing")
+        collection = store_embeddings_in_chromadb(
+            chunks, chunk_embeddings, chunk_metadatas, chunk_changes,
+            progress=self._set_progress("chunks_indexed", "chunks_to_index"),
+            collection_name=book_collection_name(self.book_id)
+        )
+        # Only now is this version of the PDF the base of the next incremental sync
+        update_manifest_index(pdf_path, chunk_changes["file_hash"])
+
+        # Cached answers are only valid for the chunks they were generated from
+        self.collection_version = compute_chunk_hash("\n".join(chunks))
+        self.chunks = chunks
+        self.page_count = chunk_changes["page_count"]
+        if self.serve:
+            self.collection = self._build_indexes(chunks, chunk_metadatas, lambda: chunk_embeddings) or collection
+        publish_index(self.book_id, pdf_path, chunk_changes["file_hash"], self.collection_version, collection.name)
+
+        # Optionally describe every page in the background, so image-mode
+        # queries only need a cache lookup
+        if os.environ.get("PREDESCRIBE_PAGES") == "1":
+            self.description_job = start_page_description_job(pdf_path)
+
+    def _open_published(self):
+        """Waits for a writer to publish the book's index, then opens it without modifying it."""
+        if not self.book_id:
+            raise ValueError("The PDF_PATH environment variable is not set.")
+        self._enter_stage("waiting_for_index")
+        published = load_published_index(self.book_id)
+        if published is None:
+            logger.info(f"Waiting for the ingestion process to publish the index of {self.book_id}...")
+        deadline = time.monotonic() + INDEX_WAIT_TIMEOUT
+        while published is None:
+            if time.monotonic() >= deadline:
+                raise RuntimeError(f"The index of {self.book_id} has not been published yet, run ingest.py")
+            time.sleep(INDEX_POLL_INTERVAL)
+            published = load_published_index(self.book_id)
+
+        self._enter_stage("loading")
+        manifest = load_manifest(published["file_hash"])
+        if manifest is None:
+            raise RuntimeError(f"Manifest {published['file_hash']} of the published index is missing")
+        chunks, chunk_metadatas = manifest_chunks(manifest)
+        open_embedding_store_readonly()
+
+        self.collection_version = published["version"]
+        self.pdf_path = published["pdf_path"]
+        self.chunks = chunks
+        self.page_count = len(manifest["pages"])
+        # Every chunk embedding was stored by the writer, so this makes no API calls
+        self.collection = self._build_indexes(chunks, chunk_metadatas, lambda: generate_embeddings(chunks))
+        logger.info(f"Opened published index of {os.path.basename(self.pdf_path)} ({len(chunks)} chunks)")
+
+    def _build_indexes(self, chunks, chunk_metadatas, get_embeddings):
+        """
+        Builds the BM25 index and the in-memory vector index. Returns the
+        vector index, or None to search Chroma; `get_embeddings` is only
+        called when the vector index is needed.
+        """
+        self._enter_stage("building_index")
+        ids, rows, metadatas = unique_chunk_rows(chunks, chunk_metadatas)
+        documents = [chunks[row] for row in rows]
+        self.lexical_index = BM25Index(documents, metadatas) if LEXICAL_ENABLED else None
+        if self.retrieval_backend == "chroma":
+            return None
+        return build_vector_index(self.retrieval_backend, ids, documents, metadatas, get_embeddings()[rows])
+
+    def memory_usage(self):
+        """Approximate bytes this book keeps in memory: chunk texts and search indexes."""
+        if not self.chunks:
+            return 0
+        size = sum(len(chunk) for chunk in self.chunks)
+        if self.lexical_index is not None:
+            size += self.lexical_index.memory_usage()
+        if isinstance(self.collection, VectorIndex):
+            size += self.collection.memory_usage()
+        elif self.serve:
+            # ChromaDB loads the collection's vectors once it is searched
+            size += len(self.chunks) * EMBEDDING_DIM * 4
+        return size
+
+    def status(self):
+        """Returns a JSON-serializable snapshot of the initialization state."""
+        return {
+            "book_id": self.book_id,
+            "role": self.role,
+            "retrieval_backend": self.retrieval_backend,
+            "state": self.state,
+            "ready": self.ready,
+            "stage": self.stage,
+            "error": self.error,
+            "progress": dict(self.progress),
+            "timings": dict(self.stage_timings),
+            "elapsed": round((self.ready_at or time.time()) - self.started_at, 1) if self.started_at else None,
+        }
@@ -1,22 +1,23 @@
 from embeddings import logger
-import google.generativeai as genai
-from embeddings import generate_embeddings
+from utils import estimate_tokens
+from metrics import timed, span
+import gemini_client
 
+@timed("rewrite")
 def rewrite_query(original_query):
     logger.info("Rewriting query...")
-    
+
     query_rewrite_template = """You are an AI assistant tasked with reformulating user queries to improve retrieval in a RAG system.
     Given the original query, rewrite it to be more specific, detailed, and likely to retrieve relevant information.
     Original query: {original_query}
     Rewritten query:"""
 
     # Use Gemini to rewrite the query
-    model = genai.GenerativeModel("gemini-1.5-flash")
-
-    # Generate and return our response
-    response = model.generate_content(query_rewrite_template.format(original_query=original_query))
+    rewritten_query = gemini_client.generate(
+        query_rewrite_template.format(original_query=original_query), kind="rewrite"
+    )
     logger.info("Query rewritten.")
-    return response.text
+    return rewritten_query
 
 
 class HyDERetriever:
@@ -24,56 +25,76 @@ class HyDERetriever:
         self.collection = collection
         self.chunk_size = chunk_size
 
+    @timed("hyde")
     def generate_hypothetical_document(self, query):
         logger.info("Generating hypothetical document...")
 
         hyde_prompt = """Given the question '{query}', generate a hypothetical document that directly answers this question. The document should be detailed and in-depth.
         The document size should be approximately {chunk_size} characters."""
 
-        model = genai.GenerativeModel("gemini-1.5-flash")
-        response = model.generate_content(hyde_prompt.format(query=query, chunk_size=self.chunk_size))
+        hypothetical_doc = gemini_client.generate(
+            hyde_prompt.format(query=query, chunk_size=self.chunk_size), kind="hyde"
+        )
         logger.info("Hypothetical document generated.")
-        return response.text
-
-    def retrieve(self, query, max_tokens=8000, k=20):  
-        logger.info("Retrieving relevant documents using HyDE...")
-        hypothetical_doc = self.generate_hypothetical_document(query)
-        hypothetical_embedding = generate_embeddings([hypothetical_doc])[0]
-        
-        # Retrieve more documents than might be needed
+        return hypothetical_doc
+
+    def search(self, embedding, k=20):
+        """Returns the k nearest documents to an embedding, with their metadata."""
+        return self.search_many([embedding], k=k)[0]
+
+    @timed("vector_search")
+    def search_many(self, embeddings, k=20):
+        """Searches with several embeddings in one query; returns a (docs, metadatas) pair per embedding."""
         results = self.collection.query(
-            query_embeddings=[hypothetical_embedding],
-            n_results=k
+            query_embeddings=[embedding.tolist() for embedding in embeddings],
+            n_results=k,
+            include=["documents", "metadatas"]
         )
-        candidate_docs = results["documents"][0]
-        
-        # Calculate how much space we have for documents in the context
-        from utils import count_tokens
-        
-        # Consider the base prompt 
-        base_context_tokens = 500  
-        
-        # Select documents until reaching the token limit
+        searches = []
+        for i, candidate_docs in enumerate(results["documents"]):
+            candidate_metadatas = results["metadatas"][i] if results.get("metadatas") else [None] * len(candidate_docs)
+            searches.append((candidate_docs, candidate_metadatas))
+        return searches
+
+    def pack(self, candidate_docs, candidate_metadatas, max_tokens=8000):
+        """
+        Selects documents in rank order until the token budget is used up.
+        Returns the selected documents and their metadata.
+        """
+        # Consider the base prompt
+        base_context_tokens = 500
+
+        # Select documents until reaching the token limit, using the token
+        # counts stored at ingest time (estimated locally for older chunks)
         selected_docs = []
+        selected_metadatas = []
         current_tokens = base_context_tokens
-        
-        for doc in candidate_docs:
-            doc_tokens = count_tokens(doc)
+
+        for doc, metadata in zip(candidate_docs, candidate_metadatas):
+            doc_tokens = (metadata or {}).get("tokens") or estimate_tokens(doc)
             if current_tokens + doc_tokens > max_tokens - 500:  # 500 token buffer for the response
                 break
             selected_docs.append(doc)
+            selected_metadatas.append(metadata or {})
             current_tokens += doc_tokens
-        
+
         logger.info(f"Retrieved {len(selected_docs)} relevant documents within token budget. Total tokens: {current_tokens}")
-        return selected_docs, hypothetical_doc
+        return selected_docs, selected_metadatas
 
 
+@timed("generate")
 def generate_response(query, context):
     logger.info("Generating response...")
     prompt = f"Context: {context}\n\nQuestion: {query}\n\nAnswer:"
-    model = genai.GenerativeModel("gemini-1.5-flash")
-    response = model.generate_content(prompt)
+    response = gemini_client.generate(prompt, kind="answer")
     logger.info("Response generated.")
-    return response.text
+    return response
 
 
+def generate_response_stream(query, context):
+    """Same as generate_response, but yields the answer text as it is generated."""
+    logger.info("Generating streamed response...")
+    prompt = f"Context: {context}\n\nQuestion: {query}\n\nAnswer:"
+    with span("generate"):
+        yield from gemini_client.generate_stream(prompt, kind="answer")
+    logger.info("Streamed response generated.")
@@ -0,0 +1,101 @@
+import numpy as np
+
+import answer_cache
+from answer_cache import AnswerCache, normalize_query
+
+
+def vector(*values):
+    return np.array(values, dtype=np.float32)
+
+
+def test_normalize_query_ignores_case_spacing_and_trailing_punctuation():
+    assert normalize_query("  What   is BGP?! ") == "what is bgp"
+    assert normalize_query("What is BGP") == normalize_query("what is bgp ?")
+
+
+def test_normalize_query_keeps_inner_punctuation():
+    assert normalize_query("What is C++?") == "what is c++"
+    assert normalize_query("What is C++?") != normalize_query("What is C?")
+    assert normalize_query("Is 3.5 > 3?") == "is 3.5 > 3"
+
+
+def test_exact_hit_does_not_embed():
+    cache = AnswerCache()
+    cache.put("book", "v1", "What is BGP?", vector(1, 0), "BGP is a routing protocol")
+
+    def embed():
+        raise AssertionError("an exact hit must not embed the query")
+
+    entry, match = cache.get("book", "v1", "what is  bgp", embed)
+    assert match == "exact"
+    assert entry["response"] == "BGP is a routing protocol"
+
+
+def test_semantic_hit_above_threshold_only():
+    cache = AnswerCache(threshold=0.9)
+    cache.put("book", "v1", "What is BGP?", vector(1, 0), "answer")
+
+    entry, match = cache.get("book", "v1", "Explain BGP", lambda: vector(0.95, 0.05))
+    assert match == "semantic"
+    assert entry["response"] == "answer"
+    assert cache.get("book", "v1", "What is OSPF?", lambda: vector(0, 1)) == (None, None)
+
+
+def test_lookups_are_scoped_per_book():
+    cache = AnswerCache()
+    cache.put("book-a", "v1", "What is BGP?", vector(1, 0), "answer")
+    assert cache.get("book-b", "v1", "What is BGP?", lambda: vector(1, 0)) == (None, None)
+
+
+def test_extra_fields_are_kept():
+    cache = AnswerCache()
+    cache.put("book", "v1", "What is BGP?", vector(1, 0), "answer", tokens=42, pages=[3])
+    entry, _ = cache.get("book", "v1", "What is BGP?")
+    assert entry["tokens"] == 42
+    assert entry["pages"] == [3]
+
+
+def test_entries_expire_after_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(answer_cache.time, "time", lambda: now[0])
+    cache = AnswerCache(ttl=60)
+    cache.put("book", "v1", "What is BGP?", vector(1, 0), "answer")
+
+    now[0] += 59
+    assert cache.get("book", "v1", "What is BGP?")[1] == "exact"
+    now[0] += 2
+    assert cache.get("book", "v1", "What is BGP?") == (None, None)
+    assert len(cache) == 0
+
+
+def test_new_collection_version_drops_the_book_answers():
+    cache = AnswerCache()
+    cache.put("book", "v1", "What is BGP?", vector(1, 0), "old answer")
+    cache.put("other", "v1", "What is BGP?", vector(1, 0), "other answer")
+
+    assert cache.get("book", "v2", "What is BGP?", lambda: vector(1, 0)) == (None, None)
+    assert len(cache) == 1
+    assert cache.get("other", "v1", "What is BGP?")[1] == "exact"
+
+
+def test_invalidate_drops_only_that_book():
+    cache = AnswerCache()
+    cache.put("book", "v1", "What is BGP?", vector(1, 0), "answer")
+    cache.put("other", "v1", "What is BGP?", vector(1, 0), "answer")
+
+    cache.invalidate("book")
+    assert cache.get("book", "v1", "What is BGP?") == (None, None)
+    assert cache.get("other", "v1", "What is BGP?")[1] == "exact"
+
+
+def test_least_recently_used_entries_are_evicted():
+    cache = AnswerCache(max_entries=2)
+    cache.put("book", "v1", "first", vector(1, 0), "1")
+    cache.put("book", "v1", "second", vector(0, 1), "2")
+    cache.get("book", "v1", "first")
+    cache.put("book", "v1", "third", vector(1, 1), "3")
+
+    assert len(cache) == 2
+    assert cache.get("book", "v1", "second") == (None, None)
+    assert cache.get("book", "v1", "first")[1] == "exact"
+    assert cache.get("book", "v1", "third")[1] == "exact"
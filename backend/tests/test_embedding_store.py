@@ -0,0 +1,92 @@
+import os
+
+import numpy as np
+import pytest
+
+from embedding_store import EmbeddingStore, INDEX_FILE, VECTORS_FILE
+
+
+def chunk_hash(i):
+    return f"{i:064x}"
+
+
+def items(start, count, dim=4):
+    return [(chunk_hash(i), np.full(dim, i, dtype=np.float32)) for i in range(start, start + count)]
+
+
+def test_add_and_get(tmp_path):
+    store = EmbeddingStore(str(tmp_path))
+    assert store.add(items(0, 3)) == 3
+
+    assert len(store) == 3
+    assert chunk_hash(1) in store
+    np.testing.assert_array_equal(store.get(chunk_hash(2)), np.full(4, 2))
+    assert store.get(chunk_hash(9)) is None
+    np.testing.assert_array_equal(store.get_many([chunk_hash(2), chunk_hash(0)])[:, 0], [2, 0])
+
+
+def test_add_skips_stored_and_repeated_hashes(tmp_path):
+    store = EmbeddingStore(str(tmp_path))
+    store.add(items(0, 2))
+    assert store.add(items(1, 2) + items(2, 1)) == 1
+    assert len(store) == 3
+    assert store.matrix.shape == (3, 4)
+
+
+def test_add_rejects_other_dimensions(tmp_path):
+    store = EmbeddingStore(str(tmp_path))
+    store.add(items(0, 1, dim=4))
+    with pytest.raises(ValueError):
+        store.add(items(1, 1, dim=3))
+
+
+def test_reopen_keeps_rows(tmp_path):
+    EmbeddingStore(str(tmp_path)).add(items(0, 3))
+
+    store = EmbeddingStore(str(tmp_path))
+    assert len(store) == 3
+    assert store.dim == 4
+    np.testing.assert_array_equal(store.get(chunk_hash(1)), np.full(4, 1))
+
+
+def test_reopen_trims_vectors_written_without_their_index_entry(tmp_path):
+    EmbeddingStore(str(tmp_path)).add(items(0, 2))
+    # A crash between the two writes of add leaves extra vector bytes behind
+    with open(tmp_path / VECTORS_FILE, "ab") as f:
+        f.write(np.ones(6, dtype=np.float32).tobytes())
+
+    store = EmbeddingStore(str(tmp_path))
+    assert len(store) == 2
+    assert os.path.getsize(tmp_path / VECTORS_FILE) == 2 * 4 * 4
+    store.add(items(2, 1))
+    np.testing.assert_array_equal(EmbeddingStore(str(tmp_path)).get(chunk_hash(2)), np.full(4, 2))
+
+
+def test_readonly_store_reads_but_does_not_write(tmp_path):
+    EmbeddingStore(str(tmp_path)).add(items(0, 2))
+    index_size = os.path.getsize(tmp_path / INDEX_FILE)
+
+    store = EmbeddingStore(str(tmp_path), readonly=True)
+    np.testing.assert_array_equal(store.get(chunk_hash(1)), np.full(4, 1))
+    with pytest.raises(RuntimeError):
+        store.add(items(2, 1))
+    assert os.path.getsize(tmp_path / INDEX_FILE) == index_size
+
+
+def test_readonly_store_of_a_missing_directory_is_empty(tmp_path):
+    store = EmbeddingStore(str(tmp_path / "missing"), readonly=True)
+    assert len(store) == 0
+    assert not (tmp_path / "missing").exists()
+
+
+def test_migrate_json_cache(tmp_path):
+    cache_dir = tmp_path / "json"
+    cache_dir.mkdir()
+    (cache_dir / f"{chunk_hash(7)}.json").write_text('{"embedding": [1, 2, 3]}')
+    (cache_dir / f"{chunk_hash(8)}.json").write_text("not json")
+    (cache_dir / "manifest.json").write_text("{}")
+
+    store = EmbeddingStore(str(tmp_path / "store"))
+    assert store.migrate_json_cache(str(cache_dir)) == 1
+    np.testing.assert_array_equal(store.get(chunk_hash(7)), [1, 2, 3])
+    assert store.migrate_json_cache(str(cache_dir)) == 0
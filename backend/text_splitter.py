@@ -0,0 +1,94 @@
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+# Built-in replacement for langchain's RecursiveCharacterTextSplitter, so the
+# app doesn't import langchain (about half a second) to split text. It follows
+# the same algorithm with the settings used here (keep_separator=True,
+# literal separators, length in characters, whitespace stripped) and yields
+# the same chunks, so chunk hashes of existing caches and indexes stay valid.
+
+
+def split_on(text, separator):
+    """Splits text on a literal separator kept at the start of each piece ("" splits into characters)."""
+    if not separator:
+        return list(text)
+    parts = re.split(f"({re.escape(separator)})", text)
+    splits = [parts[0]] + [parts[i] + parts[i + 1] for i in range(1, len(parts) - 1, 2)]
+    return [s for s in splits if s != ""]
+
+
+class RecursiveCharacterTextSplitter:
+    """
+    Splits text on the first of `separators` it contains, merging the pieces
+    into chunks of up to chunk_size characters that repeat up to
+    chunk_overlap characters of the previous chunk. Pieces still too long are
+    split again on the next separators.
+    """
+
+    def __init__(self, chunk_size=4000, chunk_overlap=200, separators=None):
+        if chunk_overlap > chunk_size:
+            raise ValueError(
+                f"Got a larger chunk overlap ({chunk_overlap}) than chunk size ({chunk_size}), should be smaller."
+            )
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.separators = separators or ["\n\n", "\n", " ", ""]
+
+    def split_text(self, text):
+        return self._split(text, self.separators)
+
+    def _split(self, text, separators):
+        separator = separators[-1]
+        remaining = []
+        for i, candidate in enumerate(separators):
+            if candidate == "":
+                separator = candidate
+                break
+            if candidate in text:
+                separator = candidate
+                remaining = separators[i + 1:]
+                break
+
+        chunks = []
+        short = []
+        for piece in split_on(text, separator):
+            if len(piece) < self.chunk_size:
+                short.append(piece)
+                continue
+            if short:
+                chunks.extend(self._merge(short))
+                short = []
+            if remaining:
+                chunks.extend(self._split(piece, remaining))
+            else:
+                chunks.append(piece)
+        if short:
+            chunks.extend(self._merge(short))
+        return chunks
+
+    def _merge(self, pieces):
+        """Joins consecutive pieces into chunks, starting each chunk with the end of the previous one."""
+        chunks = []
+        current = []
+        total = 0
+        for piece in pieces:
+            length = len(piece)
+            if total + length > self.chunk_size:
+                if total > self.chunk_size:
+                    logger.warning(f"Created a chunk of size {total}, which is longer than the specified {self.chunk_size}")
+                if current:
+                    chunk = "".join(current).strip()
+                    if chunk:
+                        chunks.append(chunk)
+                    # Drop pieces from the start until what is left fits as overlap
+                    while total > self.chunk_overlap or (total + length > self.chunk_size and total > 0):
+                        total -= len(current[0])
+                        current = current[1:]
+            current.append(piece)
+            total += length
+        chunk = "".join(current).strip()
+        if chunk:
+            chunks.append(chunk)
+        return chunks
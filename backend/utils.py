@@ -1,10 +1,118 @@
-import google.generativeai as genai
+import hashlib
+import json
+import logging
+import os
+import re
+from metrics import timed
+import gemini_client
 
+logger = logging.getLogger(__name__)
+
+CALIBRATION_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "token_calibration.json")
+
+# estimate_tokens models the token count as a linear function of the number of
+# characters and of "pieces" (words and punctuation marks). Until it is
+# calibrated against the API, it falls back to ~4 characters per token.
+DEFAULT_TOKEN_WEIGHTS = {"chars": 0.25, "pieces": 0.0}
+PIECE_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+_token_weights = None
+
+@timed("count_tokens")
 def count_tokens(text, model_name="gemini-1.5-flash"):
     """
     Counts tokens using the official Google API for Gemini's tokenizer.
     Provides an accurate count specific to the model being used.
     """
-    model = genai.GenerativeModel(model_name)
-    response = model.count_tokens(text)
-    return response.total_tokens
\ No newline at end of file
+    return gemini_client.count_tokens(text, model_name)
+
+def get_token_weights():
+    """Returns the estimator weights, loading the saved calibration if there is one."""
+    global _token_weights
+    if _token_weights is None:
+        weights = dict(DEFAULT_TOKEN_WEIGHTS)
+        if os.path.exists(CALIBRATION_FILE):
+            try:
+                with open(CALIBRATION_FILE, "r") as f:
+                    weights.update(json.load(f)["weights"])
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning(f"Ignoring unreadable token calibration: {e}")
+        _token_weights = weights
+    return _token_weights
+
+def estimate_tokens(text):
+    """
+    Estimates the number of tokens in a text locally, without API calls.
+    Use count_tokens when an exact count is needed.
+    """
+    if not text:
+        return 0
+    weights = get_token_weights()
+    pieces = len(PIECE_PATTERN.findall(text))
+    return max(1, round(weights["chars"] * len(text) + weights["pieces"] * pieces))
+
+def calibrate_token_estimator(samples):
+    """
+    Fits the estimator weights against count_tokens on a few sample texts
+    (least squares on characters and pieces) and saves them to CALIBRATION_FILE.
+    """
+    global _token_weights
+    rows = []
+    for text in samples:
+        if text:
+            rows.append((len(text), len(PIECE_PATTERN.findall(text)), count_tokens(text)))
+    if not rows:
+        return get_token_weights()
+
+    # Solve the 2x2 normal equations for tokens = a * chars + b * pieces
+    scc = sum(c * c for c, _, _ in rows)
+    spp = sum(p * p for _, p, _ in rows)
+    scp = sum(c * p for c, p, _ in rows)
+    sct = sum(c * t for c, _, t in rows)
+    spt = sum(p * t for _, p, t in rows)
+    det = scc * spp - scp * scp
+    a = (sct * spp - spt * scp) / det if det else 0.0
+    b = (spt * scc - sct * scp) / det if det else 0.0
+    if a < 0 or b < 0:
+        # Degenerate fit: fall back to a plain characters-per-token ratio
+        a, b = sum(t for _, _, t in rows) / sum(c for c, _, _ in rows), 0.0
+
+    weights = {"chars": a, "pieces": b}
+    os.makedirs(os.path.dirname(CALIBRATION_FILE), exist_ok=True)
+    with open(CALIBRATION_FILE, "w") as f:
+        json.dump({"weights": weights, "samples": len(rows)}, f)
+    logger.info(f"Token estimator calibrated on {len(rows)} samples: {weights}")
+    _token_weights = weights
+    return weights
+
+def ensure_token_calibration(texts, sample_size=20):
+    """Calibrates the estimator on evenly spaced texts if no calibration was saved yet."""
+    if os.path.exists(CALIBRATION_FILE) or not texts:
+        return get_token_weights()
+    step = max(1, len(texts) // sample_size)
+    try:
+        return calibrate_token_estimator(texts[::step][:sample_size])
+    except Exception as e:
+        logger.warning(f"Token calibration failed, using default estimate: {e}")
+        return get_token_weights()
+
+_file_hashes = {}
+
+def compute_file_hash(path):
+    """
+    Computes the sha256 of a file's contents. Results are remembered per
+    (path, size, mtime), so unchanged files are only read once.
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _file_hashes:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+        _file_hashes[key] = digest.hexdigest()
+    return _file_hashes[key]
+
+def get_book_id(path):
+    """Book ids are the PDF file name without extension."""
+    return os.path.splitext(os.path.basename(path))[0]
@@ -0,0 +1,186 @@
+import logging
+import os
+from abc import ABC, abstractmethod
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Where HyDERetriever searches: "chroma" (the persisted collection), "numpy"
+# (exact search over a float32 matrix), "numpy-int8" (exact search over an
+# int8-quantized matrix, 4x smaller) or "hnsw" (approximate, needs hnswlib)
+RETRIEVAL_BACKENDS = ("chroma", "numpy", "numpy-int8", "hnsw")
+RETRIEVAL_BACKEND = os.environ.get("RETRIEVAL_BACKEND", "chroma")
+
+# Readers (web workers) never open Chroma: ChromaDB doesn't support several
+# processes on one persistent directory, and the ingestion process writes to
+# it. They search an in-memory index built from the read-only memory-mapped
+# embedding store instead: RETRIEVAL_BACKEND if it names one, else "numpy".
+# The index is a normalized copy of the book's rows, not a view of the store
+# (which holds the vectors of every book, as the API returned them), so each
+# worker keeps its own: chunks x EMBEDDING_DIM x 4 bytes per book and worker
+# for "numpy" and "hnsw", a quarter of that for "numpy-int8". It counts
+# towards LIBRARY_MEMORY_MB, which is a budget per worker.
+READER_RETRIEVAL_BACKEND = RETRIEVAL_BACKEND if RETRIEVAL_BACKEND != "chroma" else "numpy"
+
+# HNSW graph parameters: links per node, and candidate list sizes used while
+# building and searching (higher is slower but more accurate)
+HNSW_M = int(os.environ.get("HNSW_M", 16))
+HNSW_EF_CONSTRUCTION = int(os.environ.get("HNSW_EF_CONSTRUCTION", 200))
+HNSW_EF_SEARCH = int(os.environ.get("HNSW_EF_SEARCH", 100))
+
+
+def normalize_rows(matrix):
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+class VectorIndex(ABC):
+    """
+    In-memory cosine similarity index over the chunks of a book.
+    query() takes the same arguments as a Chroma collection's and returns
+    results in the same shape, so HyDERetriever can search either one.
+    Distances are cosine distances (1 - cosine similarity).
+    """
+
+    def __init__(self, ids, documents, metadatas, name="vector_index"):
+        self.name = name
+        self.ids = list(ids)
+        self.documents = list(documents)
+        self.metadatas = list(metadatas)
+
+    def count(self):
+        return len(self.ids)
+
+    @abstractmethod
+    def memory_usage(self):
+        """Bytes taken by the vectors (documents and metadata are shared with the RAG system)."""
+
+    @abstractmethod
+    def search(self, query_matrix, k):
+        """Returns (rows, similarities) arrays of shape (queries, k), best match first."""
+
+    def query(self, query_embeddings, n_results=10, include=("documents", "metadatas", "distances")):
+        results = {"ids": [], "documents": None, "metadatas": None, "distances": None}
+        for field in include:
+            if field in ("documents", "metadatas", "distances"):
+                results[field] = []
+
+        k = min(n_results, self.count())
+        if k == 0:
+            for field, values in results.items():
+                if values is not None:
+                    values.extend([] for _ in query_embeddings)
+            return results
+
+        rows, similarities = self.search(normalize_rows(np.atleast_2d(query_embeddings)), k)
+        for query_rows, query_similarities in zip(rows, similarities):
+            results["ids"].append([self.ids[row] for row in query_rows])
+            if results["documents"] is not None:
+                results["documents"].append([self.documents[row] for row in query_rows])
+            if results["metadatas"] is not None:
+                results["metadatas"].append([self.metadatas[row] for row in query_rows])
+            if results["distances"] is not None:
+                results["distances"].append([float(1.0 - s) for s in query_similarities])
+        return results
+
+
+def top_k(scores, k):
+    """Row indices and values of the k highest scores of every row, sorted."""
+    if k < scores.shape[1]:
+        candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        candidates = np.tile(np.arange(scores.shape[1]), (scores.shape[0], 1))
+    candidate_scores = np.take_along_axis(scores, candidates, axis=1)
+    order = np.argsort(-candidate_scores, axis=1)
+    return np.take_along_axis(candidates, order, axis=1), np.take_along_axis(candidate_scores, order, axis=1)
+
+
+class NumpyIndex(VectorIndex):
+    """Exact search: one matrix product against every normalized embedding."""
+
+    def __init__(self, ids, documents, metadatas, embeddings, name="numpy"):
+        super().__init__(ids, documents, metadatas, name=name)
+        self.matrix = normalize_rows(embeddings)
+
+    def memory_usage(self):
+        return self.matrix.nbytes
+
+    def search(self, query_matrix, k):
+        return top_k(query_matrix @ self.matrix.T, k)
+
+
+class QuantizedNumpyIndex(VectorIndex):
+    """
+    Exact search over int8 embeddings, each row scaled by its largest
+    absolute value. Uses a quarter of the float32 memory, at the cost of
+    slightly slower queries and scores off by well under 1%.
+    """
+
+    def __init__(self, ids, documents, metadatas, embeddings, name="numpy-int8"):
+        super().__init__(ids, documents, metadatas, name=name)
+        matrix = normalize_rows(embeddings)
+        self.scales = np.abs(matrix).max(axis=1) / 127.0
+        self.scales[self.scales == 0] = 1.0
+        self.matrix = np.round(matrix / self.scales[:, None]).astype(np.int8)
+
+    # Rows converted back to float32 at a time, so the copy stays in cache
+    BLOCK_ROWS = 2048
+
+    def memory_usage(self):
+        return self.matrix.nbytes + self.scales.nbytes
+
+    def search(self, query_matrix, k):
+        scores = np.empty((len(query_matrix), len(self.matrix)), dtype=np.float32)
+        for start in range(0, len(self.matrix), self.BLOCK_ROWS):
+            block = self.matrix[start:start + self.BLOCK_ROWS].astype(np.float32)
+            scores[:, start:start + len(block)] = query_matrix @ block.T
+        return top_k(scores * self.scales, k)
+
+
+class HnswIndex(VectorIndex):
+    """Approximate search with an HNSW graph (hnswlib), for large corpora."""
+
+    def __init__(self, ids, documents, metadatas, embeddings, name="hnsw",
+                 m=HNSW_M, ef_construction=HNSW_EF_CONSTRUCTION, ef_search=HNSW_EF_SEARCH):
+        try:
+            import hnswlib
+        except ImportError as e:
+            raise ImportError("The hnsw retrieval backend needs hnswlib: pip install hnswlib") from e
+
+        super().__init__(ids, documents, metadatas, name=name)
+        matrix = normalize_rows(embeddings)
+        self.ef_search = ef_search
+        self.m = m
+        self.graph = hnswlib.Index(space="ip", dim=matrix.shape[1])
+        self.graph.init_index(max_elements=max(1, len(matrix)), M=m, ef_construction=ef_construction)
+        if len(matrix):
+            self.graph.add_items(matrix, np.arange(len(matrix)))
+
+    def memory_usage(self):
+        # Every element holds its vector and up to 2 * M links of 4 bytes
+        return self.graph.get_current_count() * (self.graph.dim * 4 + 2 * self.m * 4)
+
+    def search(self, query_matrix, k):
+        self.graph.set_ef(max(self.ef_search, k))
+        rows, distances = self.graph.knn_query(query_matrix, k=k)
+        # hnswlib's "ip" distance is 1 - inner product
+        return rows.astype(np.int64), 1.0 - distances
+
+
+INDEX_CLASSES = {
+    "numpy": NumpyIndex,
+    "numpy-int8": QuantizedNumpyIndex,
+    "hnsw": HnswIndex,
+}
+
+
+def build_vector_index(backend, ids, documents, metadatas, embeddings):
+    """Builds the in-memory index of a retrieval backend other than "chroma"."""
+    if backend not in INDEX_CLASSES:
+        raise ValueError(f"Unknown retrieval backend: {backend} (expected one of {', '.join(RETRIEVAL_BACKENDS)})")
+    index = INDEX_CLASSES[backend](ids, documents, metadatas, embeddings, name=backend)
+    logger.info(f"Built {backend} vector index over {index.count()} chunks")
+    return index
@@ -0,0 +1,18 @@
+"""
+Production entry point. Each worker serves the indexes published by the
+ingestion process (ingest.py) and never ingests itself; it keeps the books
+it is asked about loaded while they fit in LIBRARY_MEMORY_MB. Workers never
+open ChromaDB, which the ingestion process writes to: they search in-memory
+indexes built from the read-only embedding store.
+
+
+    python ingest.py --watch      # or: python ingest.py path/to/book.pdf
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+After a loaded book is re-indexed, send SIGHUP to the gunicorn master so
+the workers reload it.
+"""
+import os
+from app import create_app
+
+app = create_app(role=os.environ.get("RAG_ROLE", "reader"), start=True)
@@ -11,6 +11,32 @@ import 'katex/dist/katex.min.css'; // Import KaTeX CSS styles
 
 const API_BASE_URL = 'http://127.0.0.1:5001'; // Use the new port
 
+// Labels shown while the backend reports its progress
+const STAGE_LABELS = {
+  analyzing_image: 'Analyzing the page...',
+  rewriting: 'Understanding your question...',
+  retrieving: 'Searching the book...',
+  generating: 'Writing the answer...'
+};
+
+// How often to poll /api/status while the book is being indexed
+const STATUS_POLL_INTERVAL = 1000;
+
+// Describes the backend indexing progress, e.g. "Embedding chunks (120/800)..."
+const describeIndexing = (status) => {
+  const { progress } = status;
+  switch (status.stage) {
+    case 'extracting':
+      return `Reading the book (${progress.pages_extracted}/${progress.pages_total} pages)...`;
+    case 'embedding':
+      return `Embedding chunks (${progress.chunks_embedded}/${progress.chunks_total})...`;
+    case 'indexing':
+      return `Indexing chunks (${progress.chunks_indexed}/${progress.chunks_to_index})...`;
+    default:
+      return 'Preparing the book...';
+  }
+};
+
 function App() {
   // Add theme state
   const [isDarkMode, setIsDarkMode] = useState(false);
@@ -27,6 +53,8 @@ function App() {
   const [showChat, setShowChat] = useState(false);
   const [initialized, setInitialized] = useState(false);
   const [isImageMode, setIsImageMode] = useState(false); // Add a new state for image mode
+  const [streamStage, setStreamStage] = useState(null); // Current backend stage while streaming
+  const [indexingStatus, setIndexingStatus] = useState(null); // Backend indexing progress, null once ready
 
   const sidebarRef = useRef(null);
 
@@ -105,6 +133,23 @@ function App() {
     });
   };
 
+  // Polls the backend until the selected book is indexed, updating the progress shown
+  const waitForIndexing = async (bookId) => {
+    while (true) {
+      const { data } = await axios.get(`${API_BASE_URL}/api/status`, { params: { book_id: bookId }, timeout: 3000 });
+      if (data.ready) {
+        setIndexingStatus(null);
+        return;
+      }
+      if (data.state === 'error') {
+        setIndexingStatus(null);
+        throw new Error(data.error || 'Indexing failed');
+      }
+      setIndexingStatus(describeIndexing(data));
+      await new Promise((resolve) => setTimeout(resolve, STATUS_POLL_INTERVAL));
+    }
+  };
+
   const fetchAndSelectDefaultBook = async () => {
     try {
       setLoading(true);
@@ -117,14 +162,20 @@ function App() {
         // Automatically select the first book
         const defaultBook = response.data.books[0];
         
-        // Send the request to load the default book
-        await axios.post(`${API_BASE_URL}/api/select-book`, {
+        // Send the request to load the default book; indexing continues
+        // in the background on the server
+        const selectResponse = await axios.post(`${API_BASE_URL}/api/select-book`, {
           book_id: defaultBook.id
         });
         
         setSelectedBook(defaultBook);
         setInitialized(true);
         setError(null);
+        
+        if (!selectResponse.data.ready) {
+          setLoading(false);
+          await waitForIndexing(defaultBook.id);
+        }
       } else {
         setError('No books available on the server');
       }
@@ -155,6 +206,12 @@ function App() {
 
   // Add this new function to extract page number from a query
   const extractPageNumber = (query) => {
+    // Page ranges ("pages 12-16", "pages 12 to 16") are sent as "12-16"
+    const rangeMatch = query.match(/(?:pages?|pp\.?)\s*(\d+)\s*(?:-|–|to)\s*(\d+)/i);
+    if (rangeMatch) {
+      return `${rangeMatch[1]}-${rangeMatch[2]}`;
+    }
+
     // Specific patterns with higher priority
     const specificPatterns = [
       /page\s+(\d+)/i,
@@ -293,33 +350,93 @@ function App() {
 
   // Remove the handlePageSubmit function which is no longer needed
 
-  // Modify sendQueryToBackend to better handle the response when a page is needed
+  // Parse a Server-Sent Events stream and call onEvent(event, data) for each event
+  const readEventStream = async (response, onEvent) => {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+
+    while (true) {
+      const { value, done } = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, { stream: true });
+
+      // Events are separated by a blank line
+      let separatorIndex;
+      while ((separatorIndex = buffer.indexOf('\n\n')) >= 0) {
+        const rawEvent = buffer.slice(0, separatorIndex);
+        buffer = buffer.slice(separatorIndex + 2);
+
+        let event = 'message';
+        let data = '';
+        for (const line of rawEvent.split('\n')) {
+          if (line.startsWith('event:')) event = line.slice(6).trim();
+          else if (line.startsWith('data:')) data += line.slice(5).trim();
+        }
+        onEvent(event, data ? JSON.parse(data) : {});
+      }
+    }
+  };
+
+  // Send the query to the streaming endpoint and render the answer as it arrives
   const sendQueryToBackend = async (query, page = null) => {
+    setStreamStage('connecting');
     try {
-      const response = await axios.post(`${API_BASE_URL}/api/query`, {
-        query,
-        page_number: page,
-        is_image_mode: isImageMode
+      const response = await fetch(`${API_BASE_URL}/api/query/stream`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({
+          query,
+          book_id: selectedBook?.id,
+          page_number: page,
+          is_image_mode: isImageMode
+        })
       });
-      
-      if (response.data.status === 'success') {
-        setMessages(prev => [...prev, { type: 'bot', content: response.data.response }]);
-      } else if (response.data.status === 'page_required') {
-        // Instead of showing the separate input, add a message to the chat
-        setMessages(prev => [...prev, { 
-          type: 'bot', 
-          content: "📖 I need a little help: could you tell me the page number of the image you would like to analyze? Thank you!" 
-        }]);
-        setShowPageInput(true);
-      } else {
-        throw new Error(response.data.message || 'Unknown error');
+
+      if (!response.ok) {
+        const errorData = await response.json().catch(() => ({}));
+        throw new Error(errorData.message || `Server error ${response.status}`);
       }
+
+      let botMessageAdded = false;
+      await readEventStream(response, (event, data) => {
+        if (event === 'stage') {
+          setStreamStage(data.stage);
+        } else if (event === 'token') {
+          // The first token replaces the loading indicator with the bot message
+          if (!botMessageAdded) {
+            botMessageAdded = true;
+            setStreamStage(null);
+            setMessages(prev => [...prev, { type: 'bot', content: data.text }]);
+          } else {
+            setMessages(prev => {
+              const updated = [...prev];
+              const last = updated[updated.length - 1];
+              updated[updated.length - 1] = { ...last, content: last.content + data.text };
+              return updated;
+            });
+          }
+        } else if (event === 'done') {
+          console.log(`Prompt tokens: ${data.tokenCount}`);
+        } else if (event === 'page_required') {
+          // Instead of showing the separate input, add a message to the chat
+          setMessages(prev => [...prev, { 
+            type: 'bot', 
+            content: "📖 I need a little help: could you tell me the page number of the image you would like to analyze? Thank you!" 
+          }]);
+          setShowPageInput(true);
+        } else if (event === 'error') {
+          throw new Error(data.message || 'Unknown error');
+        }
+      });
     } catch (error) {
       console.error('API Error:', error);
       setMessages(prev => [...prev, { 
         type: 'error', 
         content: `Error: ${error.message}` 
       }]);
+    } finally {
+      setStreamStage(null);
     }
   };
 
@@ -438,6 +555,9 @@ function App() {
                 Ask any exam question and get instant, accurate answers to help you prepare for your exams.
                 <br />ClarifAI uses AI to provide comprehensive explanations tailored to your studies.
               </p>
+              {indexingStatus && !error && (
+                <p className="indexing-status">{indexingStatus}</p>
+              )}
               {error && (
                 <div className="init-error">
                   <p>{error}</p>
@@ -526,13 +646,14 @@ function App() {
                   </div>
                 ))
               )}
-              {loading && (
+              {loading && streamStage !== null && (
                 <div className="message bot loading">
                   <div className="loading-indicator">
                     <div className="dot"></div>
                     <div className="dot"></div>
                     <div className="dot"></div>
                   </div>
+                  <span className="stage-label">{STAGE_LABELS[streamStage] || 'Thinking...'}</span>
                 </div>
               )}
             </div>